@@ -0,0 +1,95 @@
+import os
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait after the last item of an album before saving it
+ALBUM_WINDOW = float(os.environ.get('ALBUM_WINDOW', 1.0))
+
+# Telegram albums never hold more than this many items
+MAX_ALBUM_SIZE = 10
+
+class _PendingAlbum:
+    """Items of one album received so far."""
+    
+    def __init__(self, user_id: int, category: str):
+        self.user_id = user_id
+        self.category = category
+        self.messages: List[Any] = []
+        self.timer: Optional[threading.Timer] = None
+
+class AlbumAggregator:
+    """Collects the separate updates of an album so it can be saved in one pass.
+    
+    Telegram delivers an album as one message per item, all sharing a
+    media_group_id. Items are held per (user, media_group_id) until no new
+    item arrived for ALBUM_WINDOW seconds or the album is full, then
+    `on_album(user_id, category, messages)` gets all of them at once.
+    """
+    
+    def __init__(self, on_album: Callable[[int, str, List[Any]], None], window: float = ALBUM_WINDOW):
+        self.on_album = on_album
+        self.window = window
+        self._albums: Dict[Tuple[int, str], _PendingAlbum] = {}
+        self._lock = threading.Lock()
+    
+    def add(self, user_id: int, category: str, message) -> None:
+        """Hold an album item until the rest of its album has arrived."""
+        if self.window <= 0 or not message.media_group_id:
+            self.on_album(user_id, category, [message])
+            return
+        
+        key = (user_id, message.media_group_id)
+        with self._lock:
+            album = self._albums.get(key)
+            if album is None:
+                album = self._albums[key] = _PendingAlbum(user_id, category)
+            album.messages.append(message)
+            if album.timer is not None:
+                album.timer.cancel()
+                album.timer = None
+            
+            full = len(album.messages) >= MAX_ALBUM_SIZE
+            if not full:
+                album.timer = threading.Timer(self.window, self._flush, args=(key, album))
+                album.timer.daemon = True
+                album.timer.start()
+        
+        if full:
+            self._flush(key, album)
+    
+    def flush_user(self, user_id: int) -> None:
+        """Hand over a user's pending albums now, e.g. before their next single file."""
+        with self._lock:
+            albums = [(key, album) for key, album in self._albums.items() if key[0] == user_id]
+        
+        for key, album in albums:
+            self._flush(key, album)
+    
+    def flush_all(self) -> None:
+        """Hand over every pending album now, e.g. before shutting down."""
+        with self._lock:
+            albums = list(self._albums.items())
+        
+        for key, album in albums:
+            self._flush(key, album)
+    
+    def _flush(self, key: Tuple[int, str], album: _PendingAlbum) -> None:
+        """Pass a collected album on, unless another caller already did."""
+        # on_album only queues the work, so it is called under the lock: a
+        # flush_user() that finds nothing pending can rely on the album
+        # being queued already
+        with self._lock:
+            if self._albums.get(key) is not album:
+                return
+            del self._albums[key]
+            if album.timer is not None:
+                album.timer.cancel()
+                album.timer = None
+            
+            try:
+                self.on_album(album.user_id, album.category, album.messages)
+            except Exception:
+                logger.exception(f"Error handing over album {key[1]} of user {album.user_id}")
@@ -1,27 +1,62 @@
 import os
 import logging
+import shlex
 import sys
+import threading
+from queue import Queue
+from typing import Any, Dict
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, BotCommand
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, CallbackQueryHandler, ConversationHandler
+from telegram.ext import Updater, JobQueue, CommandHandler, MessageHandler, Filters, CallbackContext, CallbackQueryHandler, ConversationHandler, InlineQueryHandler
+from telegram.error import TimedOut
+from telegram.utils.helpers import escape_markdown
+from telegram.utils.request import Request
 from dotenv import load_dotenv
 
+import callbacks
 import database as db
+import delivery
+import inline
+import profiler
+import tracing
+from album import AlbumAggregator
+from callbacks import CallbackRouter
+from debounce import confirmation_editor
+from instrumentation import instrument_handlers, start_metrics_export
+from keyboards import build_category_keyboard, keyboard_cache
+from dispatch import ConcurrentDispatcher, DISPATCH_LANES, BACKGROUND_LANES, run_in_background
+from outbound import ThrottledBot
+from persistence import MongoPersistence, MONGO_PERSISTENCE
+from sharding import SHARD_WORKERS, run_sharded
+from webhook import serve_webhook
 from healthcheck import run_health_server
 
 # Load environment variables
 load_dotenv()
 
-# Enable logging
+# Enable logging; lines logged while an update is handled carry its trace id.
+# database.py configures logging on import too, so replace its handler.
 logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+    format='%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s',
+    level=logging.INFO,
+    force=True
 )
 logger = logging.getLogger(__name__)
 
 # Add console output for better debugging
 console_handler = logging.StreamHandler(sys.stdout)
-console_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+console_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s'))
 logger.addHandler(console_handler)
+for handler in logging.getLogger().handlers + [console_handler]:
+    handler.addFilter(tracing.TraceIdFilter())
+
+# Reuse the channel message of a file the user has stored before instead of forwarding it again
+DEDUP_UPLOADS = os.environ.get('DEDUP_UPLOADS', 'true').lower() == 'true'
+
+# Number of matches shown per page of /search results
+SEARCH_PAGE_SIZE = 10
+
+# Telegram user ids allowed to run admin commands such as /profile, comma separated
+ADMIN_USER_IDS = {int(user_id) for user_id in os.environ.get('ADMIN_USER_IDS', '').split(',') if user_id.strip()}
 
 # Conversation states
 CHOOSING_CATEGORY, CREATE_CATEGORY, WAITING_FOR_CATEGORY_NAME, CHOOSING_FILE, MAIN_MENU = range(5)
@@ -32,6 +67,7 @@ def set_bot_commands(updater):
         BotCommand("start", "Start the bot"),
         BotCommand("menu", "Open the main menu"),
         BotCommand("files", "Browse your stored files"),
+        BotCommand("search", "Search your files by name"),
         BotCommand("categories", "Manage your categories"),
         BotCommand("delete", "Delete a category"),
         BotCommand("help", "Show help information"),
@@ -129,6 +165,8 @@ def help_command(update: Update, context: CallbackContext) -> None:
         '• `/start` - Start the bot and see the welcome message\n'
         '• `/menu` - Open the main menu with all options\n'
         '• `/files` - Browse all your stored files by category\n'
+        '• `/search` - Search your files by name, e.g. `/search report type:document`\n'
+        f'• `@{context.bot.username} query` - Send your files in any chat\n'
         '• `/categories` - Manage your file categories\n'
         '• `/delete` - Delete unwanted categories\n'
         '• `/help` - Show this help information\n\n'
@@ -178,6 +216,8 @@ def help_from_query(update: Update, context: CallbackContext) -> int:
         '• `/start` - Start the bot and see the welcome message\n'
         '• `/menu` - Open the main menu with all options\n'
         '• `/files` - Browse all your stored files by category\n'
+        '• `/search` - Search your files by name, e.g. `/search report type:document`\n'
+        f'• `@{context.bot.username} query` - Send your files in any chat\n'
         '• `/categories` - Manage your file categories\n'
         '• `/delete` - Delete unwanted categories\n'
         '• `/help` - Show this help information\n\n'
@@ -219,24 +259,83 @@ def get_back_to_menu_button():
     """Get a keyboard with just a back button."""
     return InlineKeyboardMarkup([[InlineKeyboardButton("« Back to Menu", callback_data="back_to_menu")]])
 
+# Category keyboards by the callback action of their page buttons:
+# (action of the category buttons, rows below the categories)
+CATEGORY_KEYBOARDS = {
+    'category_list': ('category', [
+        [InlineKeyboardButton("➕ Create New Category", callback_data='create_new_category')],
+        [InlineKeyboardButton("« Back to Menu", callback_data='back_to_menu')],
+    ]),
+    'delete_list': ('delete', [
+        [InlineKeyboardButton("« Back to Menu", callback_data='back_to_menu')],
+    ]),
+}
+
+def get_category_keyboard(user_id: int, kind: str, page: int = 1) -> InlineKeyboardMarkup:
+    """Return a page of one of the CATEGORY_KEYBOARDS for a user.
+    
+    Keyboards are cached per category list version, so they are only
+    rebuilt after the user created or deleted a category.
+    """
+    version, categories = db.get_category_list(user_id)
+    select_action, footer = CATEGORY_KEYBOARDS[kind]
+    return keyboard_cache.get_or_build(
+        (user_id, kind, page, version),
+        lambda: build_category_keyboard(categories, select_action, kind, page, footer)
+    )
+
+def answer_only(update: Update, context: CallbackContext) -> None:
+    """Answer a button that only shows information, such as a page number."""
+    update.callback_query.answer()
+
+def handle_category_list_page(update: Update, context: CallbackContext) -> None:
+    """Show another page of a category keyboard, keeping the message text."""
+    query = update.callback_query
+    query.answer()
+    
+    try:
+        action, (page,) = callbacks.decode(query.data)
+    except ValueError:
+        return
+    
+    user_id = update.effective_user.id
+    if action == 'browse_list':
+        reply_markup = get_browse_keyboard(db.get_category_stats(user_id), page)
+    else:
+        reply_markup = get_category_keyboard(user_id, action, page)
+    query.edit_message_reply_markup(reply_markup=reply_markup)
+
+def decode_category_callback(update: Update):
+    """Decode callback data whose first argument is a category id.
+    
+    Returns:
+        Tuple containing (action, category_id, category_name, remaining_args);
+        category_name is None if the category no longer exists or the data
+        is not in the current format, e.g. on a button sent by an older version
+    """
+    try:
+        action, args = callbacks.decode(update.callback_query.data)
+    except ValueError:
+        return None, None, None, ()
+    if not args:
+        return action, None, None, ()
+    
+    category_name = db.get_category_name(update.effective_user.id, args[0])
+    return action, args[0], category_name, args[1:]
+
+def show_missing_category(update: Update, context: CallbackContext) -> int:
+    """Tell the user that a button refers to a category that is gone."""
+    update.callback_query.edit_message_text(
+        "⚠️ This category no longer exists.",
+        reply_markup=get_back_to_menu_button()
+    )
+    return MAIN_MENU
+
 def show_categories_from_query(update: Update, context: CallbackContext) -> int:
     """Show categories from a callback query."""
     query = update.callback_query
     user_id = update.effective_user.id
-    categories = db.get_user_categories(user_id)
-    
-    buttons = []
-    # Add existing categories
-    for category in categories:
-        buttons.append([InlineKeyboardButton(category, callback_data=f'category_{category}')])
-    
-    # Add option to create a new category
-    buttons.append([InlineKeyboardButton("➕ Create New Category", callback_data='create_new_category')])
-    
-    # Add back button
-    buttons.append([InlineKeyboardButton("« Back to Menu", callback_data='back_to_menu')])
-    
-    reply_markup = InlineKeyboardMarkup(buttons)
+    reply_markup = get_category_keyboard(user_id, 'category_list')
     
     query.edit_message_text(
         '📋 *Your Categories*\n\nSelect a category or create a new one:',
@@ -249,20 +348,7 @@ def show_categories_from_query(update: Update, context: CallbackContext) -> int:
 def show_categories(update: Update, context: CallbackContext) -> int:
     """Show the user's categories and option to create a new one."""
     user_id = update.effective_user.id
-    categories = db.get_user_categories(user_id)
-    
-    buttons = []
-    # Add existing categories
-    for category in categories:
-        buttons.append([InlineKeyboardButton(category, callback_data=f'category_{category}')])
-    
-    # Add option to create a new category
-    buttons.append([InlineKeyboardButton("➕ Create New Category", callback_data='create_new_category')])
-    
-    # Add back button
-    buttons.append([InlineKeyboardButton("« Back to Menu", callback_data='back_to_menu')])
-    
-    reply_markup = InlineKeyboardMarkup(buttons)
+    reply_markup = get_category_keyboard(user_id, 'category_list')
     
     update.message.reply_text(
         '📋 *Your Categories*\n\nSelect a category or create a new one:',
@@ -289,7 +375,9 @@ def handle_category_selection(update: Update, context: CallbackContext) -> int:
         return WAITING_FOR_CATEGORY_NAME
     
     # User selected an existing category
-    category_name = query.data.replace('category_', '')
+    _, category_id, category_name, _ = decode_category_callback(update)
+    if category_name is None:
+        return show_missing_category(update, context)
     context.user_data['current_category'] = category_name
     
     query.edit_message_text(
@@ -297,7 +385,7 @@ def handle_category_selection(update: Update, context: CallbackContext) -> int:
              f"Send me files to add to this category, or use the buttons below.",
         parse_mode='Markdown',
         reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("📂 View Files", callback_data=f'browse_{category_name}')],
+            [InlineKeyboardButton("📂 View Files", callback_data=callbacks.encode('browse', category_id))],
             [InlineKeyboardButton("✅ Done", callback_data='done')],
             [InlineKeyboardButton("« Back to Categories", callback_data='back_to_categories')]
         ])
@@ -325,6 +413,162 @@ def create_new_category(update: Update, context: CallbackContext) -> int:
     context.user_data['current_category'] = category_name
     return CHOOSING_FILE
 
+def get_file_details(message) -> Dict[str, Any]:
+    """Return the type and Telegram file attributes of a media message.
+    
+    The keys match the fields stored for a file: file_type, file_name,
+    file_id, file_unique_id, file_size and mime_type (None when unknown).
+    """
+    media = None
+    file_type = "unknown"
+    
+    if message.photo:
+        file_type = "photo"
+        media = message.photo[-1]
+    elif message.video:
+        file_type = "video"
+        media = message.video
+    elif message.document:
+        file_type = "document"
+        media = message.document
+    elif message.audio:
+        file_type = "audio"
+        media = message.audio
+    elif message.voice:
+        file_type = "voice"
+        media = message.voice
+    elif message.animation:
+        file_type = "animation"
+        media = message.animation
+    
+    details = {"file_type": file_type}
+    for attribute in ("file_name", "file_id", "file_unique_id", "file_size", "mime_type"):
+        details[attribute] = getattr(media, attribute, None)
+    return details
+
+def find_stored_copies(user_id: int, files) -> Dict[str, int]:
+    """Return the channel message ids of files the user has stored before, by file_unique_id."""
+    if not DEDUP_UPLOADS:
+        return {}
+    try:
+        return db.find_stored_message_ids(user_id, [f["file_unique_id"] for f in files])
+    except Exception as e:
+        # Deduplication only saves work; without it the file is simply forwarded again
+        logger.error(f"Error looking up stored copies for user {user_id}: {e}")
+        return {}
+
+def store_file(message, user_id: int, category: str) -> None:
+    """Forward a received file to the storage channel and record it in the database."""
+    try:
+        file_details = get_file_details(message)
+        
+        # A file the user stored before is already in the channel, reuse that message
+        stored = find_stored_copies(user_id, [file_details])
+        if file_details["file_unique_id"] in stored:
+            message_id = stored[file_details["file_unique_id"]]
+        else:
+            # Forward the message to the channel
+            channel_id = os.getenv("CHANNEL_ID")
+            message_id = message.forward(chat_id=channel_id).message_id
+        
+        # Queue the file info for a batched database write
+        db.buffer_file_for_category(
+            user_id=user_id,
+            category=category,
+            message_id=message_id,
+            **file_details
+        )
+        inline.result_cache.invalidate(user_id)
+    except Exception as e:
+        logger.error(f"Error saving file for user {user_id}: {e}")
+        message.reply_text(f"❌ Failed to save this file to '{category}'. Please send it again.")
+
+def forward_items(messages, channel_id) -> list:
+    """Forward messages to the storage channel one request each.
+    
+    Returns:
+        The new message id of every message, or None where forwarding failed
+    """
+    message_ids = []
+    for message in messages:
+        try:
+            message_ids.append(message.forward(chat_id=channel_id).message_id)
+        except Exception as e:
+            logger.error(f"Error forwarding message {message.message_id} of user {message.chat_id}: {e}")
+            message_ids.append(None)
+    return message_ids
+
+def store_album(messages, user_id: int, category: str) -> None:
+    """Forward the items of an album to the storage channel in one request and record them together."""
+    messages = sorted(messages, key=lambda m: m.message_id)
+    bot = messages[0].bot
+    channel_id = os.getenv("CHANNEL_ID")
+    files = [get_file_details(message) for message in messages]
+    
+    # Only items the user has not stored before need to go to the channel
+    stored = find_stored_copies(user_id, files)
+    new_messages = [
+        message for message, file_details in zip(messages, files)
+        if file_details["file_unique_id"] not in stored
+    ]
+    
+    forwarded_ids = None
+    if new_messages:
+        try:
+            forwarded_ids = bot.forward_messages(
+                chat_id=channel_id,
+                from_chat_id=messages[0].chat_id,
+                message_ids=[m.message_id for m in new_messages]
+            )
+        except TimedOut as e:
+            # The request may still have been carried out, so forwarding the items again could store them twice
+            logger.error(f"Batch forward of album timed out for user {user_id}: {e}")
+            messages[0].reply_text(f"❌ Failed to save this album to '{category}'. Please send it again.")
+            return
+        except Exception as e:
+            # Telegram refused the whole request, e.g. a Bot API server without forwardMessages
+            logger.warning(f"Batch forward of album failed for user {user_id}, forwarding items one by one: {e}")
+        
+        if forwarded_ids is not None and len(forwarded_ids) != len(new_messages):
+            # Telegram skips messages it cannot forward without saying which, so the
+            # ids that came back cannot be matched to items; remove those copies and
+            # forward item by item, which tells exactly which items failed
+            logger.warning(f"Batch forward of album forwarded {len(forwarded_ids)} of {len(new_messages)} items for user {user_id}, forwarding items one by one")
+            for message_id in forwarded_ids:
+                try:
+                    bot.delete_message(chat_id=channel_id, message_id=message_id)
+                except Exception as e:
+                    logger.error(f"Error removing forwarded message {message_id} from the channel: {e}")
+            forwarded_ids = None
+        
+        if forwarded_ids is None:
+            forwarded_ids = forward_items(new_messages, channel_id)
+    
+    forwarded = iter(forwarded_ids or [])
+    for file_details in files:
+        unique_id = file_details["file_unique_id"]
+        file_details["message_id"] = stored[unique_id] if unique_id in stored else next(forwarded)
+    
+    failed = sum(1 for file_details in files if file_details["message_id"] is None)
+    files = [file_details for file_details in files if file_details["message_id"] is not None]
+    if failed:
+        messages[0].reply_text(f"❌ Failed to save {failed} file(s) of this album to '{category}'. Please send them again.")
+    if not files:
+        return
+    
+    try:
+        # Queue the whole album as one batch for the database
+        db.buffer_files_for_category(user_id, category, files)
+        inline.result_cache.invalidate(user_id)
+    except Exception as e:
+        logger.error(f"Error saving album for user {user_id}: {e}")
+        messages[0].reply_text(f"❌ Failed to save this album to '{category}'. Please send it again.")
+
+# Album items are collected here and saved with one forward and one write
+album_aggregator = AlbumAggregator(
+    lambda user_id, category, messages: run_in_background(user_id, store_album, messages, user_id, category)
+)
+
 def save_file(update: Update, context: CallbackContext) -> int:
     """Save a file to the selected category."""
     user_id = update.effective_user.id
@@ -335,17 +579,7 @@ def save_file(update: Update, context: CallbackContext) -> int:
         category = context.user_data['current_category']
     else:
         # If not in a flow, show categories to select from
-        keyboard = []
-        categories = db.get_user_categories(user_id)
-        
-        # Create inline keyboard with categories
-        buttons = []
-        for category in categories:
-            buttons.append([InlineKeyboardButton(category, callback_data=f'category_{category}')])
-        
-        buttons.append([InlineKeyboardButton("➕ Create New Category", callback_data='create_new_category')])
-        
-        reply_markup = InlineKeyboardMarkup(buttons)
+        reply_markup = get_category_keyboard(user_id, 'category_list')
         
         update.message.reply_text(
             '📂 *Store File*\n\nPlease select a category for this file:',
@@ -358,52 +592,19 @@ def save_file(update: Update, context: CallbackContext) -> int:
         context.user_data['pending_file_chat_id'] = update.message.chat.id
         return CHOOSING_CATEGORY
     
-    # Forward the message to the channel
-    channel_id = os.getenv("CHANNEL_ID")
-    forwarded_msg = message.forward(chat_id=channel_id)
-    
-    # Determine the file type
-    file_type = None
-    file_name = None
-    
-    if message.photo:
-        file_type = "photo"
-    elif message.video:
-        file_type = "video"
-        if message.video.file_name:
-            file_name = message.video.file_name
-    elif message.document:
-        file_type = "document"
-        if message.document.file_name:
-            file_name = message.document.file_name
-    elif message.audio:
-        file_type = "audio"
-        if message.audio.file_name:
-            file_name = message.audio.file_name
-    elif message.voice:
-        file_type = "voice"
-    elif message.animation:
-        file_type = "animation"
-        if message.animation.file_name:
-            file_name = message.animation.file_name
+    # Forward and record the file in the background, in the order it was received;
+    # albums are collected first so that all their items are saved together
+    if message.media_group_id:
+        album_aggregator.add(user_id, category, message)
     else:
-        file_type = "unknown"
-    
-    # Save file info to the database
-    db.add_file_to_category(
-        user_id=user_id,
-        category=category,
-        message_id=forwarded_msg.message_id,
-        file_type=file_type,
-        file_name=file_name
-    )
+        album_aggregator.flush_user(user_id)
+        run_in_background(user_id, store_file, message, user_id, category)
     
     # Track number of files uploaded in this session
     if 'files_uploaded' not in context.user_data:
         context.user_data['files_uploaded'] = 0
     context.user_data['files_uploaded'] += 1
     
-    # Update existing confirmation message if it exists, otherwise send a new one
     confirmation_text = f"✅ *{context.user_data['files_uploaded']} file(s) saved* to category '*{category}*'!\n\n"
     confirmation_text += f"Send more files or use the buttons below."
     
@@ -412,20 +613,19 @@ def save_file(update: Update, context: CallbackContext) -> int:
         [InlineKeyboardButton("« Back to Categories", callback_data='back_to_categories')]
     ])
     
-    if 'last_confirmation_message_id' in context.user_data and context.user_data['last_confirmation_message_id']:
-        try:
-            # Try to edit the existing confirmation message
-            context.bot.edit_message_text(
-                chat_id=update.effective_chat.id,
-                message_id=context.user_data['last_confirmation_message_id'],
-                text=confirmation_text,
-                parse_mode='Markdown',
-                reply_markup=reply_markup
-            )
-            return CHOOSING_FILE
-        except Exception as e:
-            logger.error(f"Error updating confirmation message: {e}")
-            # If editing fails, we'll send a new message below
+    # Coalesce edits of the existing confirmation message, otherwise send a new one
+    chat_id = update.effective_chat.id
+    confirmation_message_id = context.user_data.get('last_confirmation_message_id')
+    if confirmation_message_id and not confirmation_editor.has_failed(chat_id, confirmation_message_id):
+        confirmation_editor.update(
+            context.bot,
+            chat_id,
+            confirmation_message_id,
+            confirmation_text,
+            parse_mode='Markdown',
+            reply_markup=reply_markup
+        )
+        return CHOOSING_FILE
     
     # Send a new confirmation message and track its ID
     sent_message = update.message.reply_text(
@@ -434,6 +634,7 @@ def save_file(update: Update, context: CallbackContext) -> int:
         reply_markup=reply_markup
     )
     context.user_data['last_confirmation_message_id'] = sent_message.message_id
+    confirmation_editor.track(chat_id, sent_message.message_id, confirmation_text)
     
     return CHOOSING_FILE
 
@@ -446,11 +647,16 @@ def handle_file_menu(update: Update, context: CallbackContext) -> int:
         if 'current_category' in context.user_data:
             del context.user_data['current_category']
         
+        # Write the files of this upload session once its saves are done
+        album_aggregator.flush_user(update.effective_user.id)
+        run_in_background(update.effective_user.id, db.flush_pending_files, update.effective_user.id)
+        
         # Reset file upload counter
         if 'files_uploaded' in context.user_data:
             del context.user_data['files_uploaded']
         
-        # Clear last confirmation message ID
+        # Clear last confirmation message ID; it is about to show another screen
+        confirmation_editor.discard(update.effective_chat.id)
         if 'last_confirmation_message_id' in context.user_data:
             del context.user_data['last_confirmation_message_id']
         
@@ -466,32 +672,22 @@ def handle_file_menu(update: Update, context: CallbackContext) -> int:
         if 'current_category' in context.user_data:
             del context.user_data['current_category']
         
+        # Write the files of this upload session once its saves are done
+        album_aggregator.flush_user(update.effective_user.id)
+        run_in_background(update.effective_user.id, db.flush_pending_files, update.effective_user.id)
+        
         # Reset file upload counter
         if 'files_uploaded' in context.user_data:
             del context.user_data['files_uploaded']
         
-        # Clear last confirmation message ID
+        # Clear last confirmation message ID; it is about to show another screen
+        confirmation_editor.discard(update.effective_chat.id)
         if 'last_confirmation_message_id' in context.user_data:
             del context.user_data['last_confirmation_message_id']
         
         # Show categories
         return show_categories_from_query(update, context)
     
-    # Handle "Back to Browse" button
-    elif query.data.startswith('browse_'):
-        category_name = query.data.replace('browse_', '')
-        
-        # Reset file upload counter
-        if 'files_uploaded' in context.user_data:
-            del context.user_data['files_uploaded']
-        
-        # Clear last confirmation message ID
-        if 'last_confirmation_message_id' in context.user_data:
-            del context.user_data['last_confirmation_message_id']
-        
-        # Go back to browsing the category
-        return handle_browse_selection(update, context)
-    
     return CHOOSING_FILE
 
 def done(update: Update, context: CallbackContext) -> int:
@@ -499,11 +695,16 @@ def done(update: Update, context: CallbackContext) -> int:
     if 'current_category' in context.user_data:
         del context.user_data['current_category']
     
+    # Write the files of this upload session once its saves are done
+    album_aggregator.flush_user(update.effective_user.id)
+    run_in_background(update.effective_user.id, db.flush_pending_files, update.effective_user.id)
+    
     # Reset file upload counter
     if 'files_uploaded' in context.user_data:
         del context.user_data['files_uploaded']
     
-    # Clear last confirmation message ID
+    # Show the final count on the confirmation message, then stop tracking it
+    confirmation_editor.flush(update.effective_chat.id)
     if 'last_confirmation_message_id' in context.user_data:
         del context.user_data['last_confirmation_message_id']
     
@@ -515,13 +716,22 @@ def done(update: Update, context: CallbackContext) -> int:
     
     return MAIN_MENU
 
+def get_browse_keyboard(category_stats, page: int = 1):
+    """Return a page of the browse keyboard with a file count on each category button.
+    
+    The counts change with every upload, so unlike get_category_keyboard()
+    this keyboard is built anew each time.
+    """
+    items = [(f"{category['name']} ({category['file_count']})", category['cid']) for category in category_stats]
+    return build_category_keyboard(items, 'browse', 'browse_list', page, CATEGORY_KEYBOARDS['category_list'][1])
+
 def browse_files_from_query(update: Update, context: CallbackContext) -> int:
     """Browse files by category from a callback query."""
     query = update.callback_query
     user_id = update.effective_user.id
-    categories = db.get_user_categories(user_id)
+    category_stats = db.get_category_stats(user_id)
     
-    if not categories:
+    if not category_stats:
         # If no categories exist, suggest creating one
         query.edit_message_text(
             "📂 *Browse Files*\n\nYou don't have any categories yet. Would you like to create one?",
@@ -533,20 +743,7 @@ def browse_files_from_query(update: Update, context: CallbackContext) -> int:
         )
         return CHOOSING_CATEGORY
     
-    buttons = []
-    for category in categories:
-        # Get file count for this category
-        files = db.get_files_in_category(user_id, category)
-        file_count = len(files)
-        buttons.append([InlineKeyboardButton(f"{category} ({file_count})", callback_data=f'browse_{category}')])
-    
-    # Add option to create a new category
-    buttons.append([InlineKeyboardButton("➕ Create New Category", callback_data='create_new_category')])
-    
-    # Add back button
-    buttons.append([InlineKeyboardButton("« Back to Menu", callback_data='back_to_menu')])
-    
-    reply_markup = InlineKeyboardMarkup(buttons)
+    reply_markup = get_browse_keyboard(category_stats)
     
     query.edit_message_text(
         '📂 *Browse Files*\n\nSelect a category to view files:',
@@ -559,9 +756,9 @@ def browse_files_from_query(update: Update, context: CallbackContext) -> int:
 def browse_files(update: Update, context: CallbackContext) -> None:
     """Browse files by category."""
     user_id = update.effective_user.id
-    categories = db.get_user_categories(user_id)
+    category_stats = db.get_category_stats(user_id)
     
-    if not categories:
+    if not category_stats:
         # If no categories exist, suggest creating one
         update.message.reply_text(
             "📂 *Browse Files*\n\nYou don't have any categories yet. Would you like to create one?",
@@ -573,20 +770,7 @@ def browse_files(update: Update, context: CallbackContext) -> None:
         )
         return CHOOSING_CATEGORY
     
-    buttons = []
-    for category in categories:
-        # Get file count for this category
-        files = db.get_files_in_category(user_id, category)
-        file_count = len(files)
-        buttons.append([InlineKeyboardButton(f"{category} ({file_count})", callback_data=f'browse_{category}')])
-    
-    # Add option to create a new category
-    buttons.append([InlineKeyboardButton("➕ Create New Category", callback_data='create_new_category')])
-    
-    # Add back button
-    buttons.append([InlineKeyboardButton("« Back to Menu", callback_data='back_to_menu')])
-    
-    reply_markup = InlineKeyboardMarkup(buttons)
+    reply_markup = get_browse_keyboard(category_stats)
     
     update.message.reply_text(
         '📂 *Browse Files*\n\nSelect a category to view files:',
@@ -604,23 +788,31 @@ def handle_browse_selection(update: Update, context: CallbackContext) -> None:
     if query.data == 'back_to_menu':
         return show_menu(update, context)
     
+    action, category_id, category_name, args = decode_category_callback(update)
+    if category_name is None:
+        return show_missing_category(update, context)
+    
     # Check if this is an add files action
-    if query.data.startswith('add_files_'):
-        category_name = query.data.replace('add_files_', '')
-        return handle_add_files_to_category(update, context, category_name)
-    
-    # Check if this is a pagination request
-    if query.data.startswith('page_'):
-        # Extract category name and page number
-        _, category_name, page = query.data.split('_')
-        page = int(page)
-        show_files_page(update, context, category_name, page)
-        return
+    if action == 'add_files':
+        return handle_add_files_to_category(update, context, category_id, category_name)
     
-    category_name = query.data.replace('browse_', '')
-    show_files_page(update, context, category_name, 1)  # Start with page 1
+    if action == 'browse':
+        # "View Files" and "Back to Browse" end an upload session: reset the file upload counter
+        if 'files_uploaded' in context.user_data:
+            del context.user_data['files_uploaded']
+        
+        # Clear last confirmation message ID; it is about to show another screen
+        confirmation_editor.discard(update.effective_chat.id)
+        if 'last_confirmation_message_id' in context.user_data:
+            del context.user_data['last_confirmation_message_id']
+    
+    # A pagination request carries the page number, browsing starts with page 1
+    page = args[0] if action == 'page' and args else 1
+    
+    # Sending a page takes many round trips, so it runs after this user's pending saves
+    run_in_background(update.effective_user.id, show_files_page, update, context, category_id, category_name, page)
 
-def handle_add_files_to_category(update: Update, context: CallbackContext, category_name: str) -> int:
+def handle_add_files_to_category(update: Update, context: CallbackContext, category_id: int, category_name: str) -> int:
     """Handle adding files to a specific category."""
     query = update.callback_query
     
@@ -634,12 +826,12 @@ def handle_add_files_to_category(update: Update, context: CallbackContext, categ
         parse_mode='Markdown',
         reply_markup=InlineKeyboardMarkup([
             [InlineKeyboardButton("✅ Done", callback_data='done')],
-            [InlineKeyboardButton("« Back to Browse", callback_data=f'browse_{category_name}')]
+            [InlineKeyboardButton("« Back to Browse", callback_data=callbacks.encode('browse', category_id))]
         ])
     )
     return CHOOSING_FILE
 
-def show_files_page(update: Update, context: CallbackContext, category_name: str, page: int) -> None:
+def show_files_page(update: Update, context: CallbackContext, category_id: int, category_name: str, page: int) -> None:
     """Show files for a specific page of a category."""
     query = update.callback_query
     user_id = update.effective_user.id
@@ -654,7 +846,7 @@ def show_files_page(update: Update, context: CallbackContext, category_name: str
             text=f"📂 *Category: {category_name}*\n\nNo files in this category.",
             parse_mode='Markdown',
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("➕ Add Files", callback_data=f'add_files_{category_name}')],
+                [InlineKeyboardButton("➕ Add Files", callback_data=callbacks.encode('add_files', category_id))],
                 [InlineKeyboardButton("« Back to Categories", callback_data='menu_files')],
                 [InlineKeyboardButton("« Back to Menu", callback_data='back_to_menu')]
             ])
@@ -668,17 +860,17 @@ def show_files_page(update: Update, context: CallbackContext, category_name: str
     if total_pages > 1:
         pag_buttons = []
         if page > 1:
-            pag_buttons.append(InlineKeyboardButton("« Prev", callback_data=f'page_{category_name}_{page-1}'))
+            pag_buttons.append(InlineKeyboardButton("« Prev", callback_data=callbacks.encode('page', category_id, page - 1)))
         
         pag_buttons.append(InlineKeyboardButton(f"{page}/{total_pages}", callback_data=f'ignore'))
         
         if page < total_pages:
-            pag_buttons.append(InlineKeyboardButton("Next »", callback_data=f'page_{category_name}_{page+1}'))
+            pag_buttons.append(InlineKeyboardButton("Next »", callback_data=callbacks.encode('page', category_id, page + 1)))
         
         nav_buttons.append(pag_buttons)
     
     # Add "Add Files" button
-    nav_buttons.append([InlineKeyboardButton("➕ Add Files", callback_data=f'add_files_{category_name}')])
+    nav_buttons.append([InlineKeyboardButton("➕ Add Files", callback_data=callbacks.encode('add_files', category_id))])
     
     # Add back buttons
     nav_buttons.append([InlineKeyboardButton("« Back to Categories", callback_data='menu_files')])
@@ -696,31 +888,29 @@ def show_files_page(update: Update, context: CallbackContext, category_name: str
         parse_mode='Markdown'
     )
     
-    # Copy each file from the channel to the user with numbering
+    # Copy the files from the channel to the user with numbering
     channel_id = os.getenv("CHANNEL_ID")
     
+    items = []
     for i, file_info in enumerate(files):
-        try:
-            # Create a caption with the file number
-            file_number = start_idx + i
-            file_caption = f"File #{file_number} of {total_files}"
-            
-            # Add filename if available
-            if "file_name" in file_info:
-                file_caption += f"\nFilename: {file_info['file_name']}"
-            
-            # Use copy_message with caption instead of forward_message
-            context.bot.copy_message(
-                chat_id=update.effective_user.id,
-                from_chat_id=channel_id,
-                message_id=file_info["message_id"],
-                caption=file_caption
-            )
-        except Exception as e:
-            logger.error(f"Error copying message: {e}")
+        # Create a caption with the file number
+        file_number = start_idx + i
+        file_caption = f"File #{file_number} of {total_files}"
+        
+        # Add filename if available
+        if "file_name" in file_info:
+            file_caption += f"\nFilename: {file_info['file_name']}"
+        
+        items.append((file_info, file_caption))
+    
+    errors = delivery.deliver_files(context.bot, update.effective_user.id, channel_id, items)
+    
+    # Report failed files in page order once every copy has finished
+    for i, error in enumerate(errors):
+        if error is not None:
             context.bot.send_message(
                 chat_id=update.effective_user.id,
-                text=f"Error retrieving file #{start_idx + i}: {e}"
+                text=f"Error retrieving file #{start_idx + i}: {error}"
             )
     
     # Send a follow-up message with navigation buttons
@@ -731,6 +921,157 @@ def show_files_page(update: Update, context: CallbackContext, category_name: str
         reply_markup=InlineKeyboardMarkup(nav_buttons)
     )
 
+def parse_search_query(text: str) -> Dict[str, Any]:
+    """Split a /search query into words and the type:/category: filters.
+    
+    Quotes group words, e.g. `report category:"Work docs" type:document`.
+    """
+    try:
+        tokens = shlex.split(text)
+    except ValueError:
+        tokens = text.split()
+    
+    words = []
+    search = {"text": "", "file_type": None, "category": None}
+    for token in tokens:
+        key, _, value = token.partition(':')
+        if value and key.lower() == 'type':
+            search["file_type"] = value.lower()
+        elif value and key.lower() in ('category', 'cat'):
+            search["category"] = value
+        else:
+            words.append(token)
+    search["text"] = " ".join(words)
+    return search
+
+def get_search_page(user_id: int, search: Dict[str, Any], page: int):
+    """Return the text, keyboard and files of one page of search results."""
+    files, total_pages, total_files = db.search_files(
+        user_id, search["text"], search["file_type"], search["category"], page, SEARCH_PAGE_SIZE
+    )
+    page = max(1, min(page, total_pages))
+    
+    description = escape_markdown(search["text"]) or "all files"
+    if search["file_type"]:
+        description += f", type {escape_markdown(search['file_type'])}"
+    if search["category"]:
+        description += f", in {escape_markdown(search['category'])}"
+    
+    if not files:
+        text = f"🔍 *Search: {description}*\n\nNo matching files."
+        return text, InlineKeyboardMarkup([[InlineKeyboardButton("« Back to Menu", callback_data='back_to_menu')]]), []
+    
+    start_idx = (page - 1) * SEARCH_PAGE_SIZE + 1
+    text = f"🔍 *Search: {description}*\n\n"
+    text += f"Showing matches {start_idx}-{start_idx + len(files) - 1} of {total_files}\n\n"
+    for i, file_info in enumerate(files):
+        name = file_info.get("file_name") or file_info["file_type"].capitalize()
+        text += f"{start_idx + i}. {escape_markdown(name)} ({file_info['file_type']}) in _{escape_markdown(file_info['category'])}_\n"
+    
+    buttons = []
+    if total_pages > 1:
+        pag_buttons = []
+        if page > 1:
+            pag_buttons.append(InlineKeyboardButton("« Prev", callback_data=callbacks.encode('search_page', page - 1)))
+        pag_buttons.append(InlineKeyboardButton(f"{page}/{total_pages}", callback_data='ignore'))
+        if page < total_pages:
+            pag_buttons.append(InlineKeyboardButton("Next »", callback_data=callbacks.encode('search_page', page + 1)))
+        buttons.append(pag_buttons)
+    
+    buttons.append([InlineKeyboardButton("📤 Send These Files", callback_data=callbacks.encode('search_send', page))])
+    buttons.append([InlineKeyboardButton("« Back to Menu", callback_data='back_to_menu')])
+    return text, InlineKeyboardMarkup(buttons), files
+
+def search_command(update: Update, context: CallbackContext) -> None:
+    """Search the user's files by name with /search."""
+    if not context.args:
+        update.message.reply_text(
+            "🔍 *Search Files*\n\n"
+            "Usage: `/search words [type:photo] [category:name]`\n"
+            "Finds files whose names contain the words, across all your categories.",
+            parse_mode='Markdown'
+        )
+        return
+    
+    # Remember the query so the page buttons can return to it
+    search = parse_search_query(" ".join(context.args))
+    context.user_data['search'] = search
+    
+    text, reply_markup, _ = get_search_page(update.effective_user.id, search, 1)
+    update.message.reply_text(text, parse_mode='Markdown', reply_markup=reply_markup)
+
+def send_search_page(update: Update, context: CallbackContext, search: Dict[str, Any], page: int) -> None:
+    """Send the files of one page of search results to the user."""
+    user_id = update.effective_user.id
+    _, _, files = get_search_page(user_id, search, page)
+    
+    items = []
+    for file_info in files:
+        caption = f"Category: {file_info['category']}"
+        if "file_name" in file_info:
+            caption += f"\nFilename: {file_info['file_name']}"
+        items.append((file_info, caption))
+    
+    errors = delivery.deliver_files(context.bot, user_id, os.getenv("CHANNEL_ID"), items)
+    for file_info, error in zip(files, errors):
+        if error is not None:
+            context.bot.send_message(
+                chat_id=user_id,
+                text=f"Error retrieving {file_info.get('file_name', 'file')}: {error}"
+            )
+
+def handle_search_callback(update: Update, context: CallbackContext) -> None:
+    """Handle the page and send buttons of search results."""
+    query = update.callback_query
+    query.answer()
+    
+    search = context.user_data.get('search')
+    if not search:
+        query.edit_message_text("This search has expired. Send /search again.")
+        return
+    
+    try:
+        action, (page,) = callbacks.decode(query.data)
+    except ValueError:
+        query.edit_message_text("This search has expired. Send /search again.")
+        return
+    
+    if action == 'search_send':
+        # Sending files takes many round trips, so it runs after this user's pending saves
+        run_in_background(update.effective_user.id, send_search_page, update, context, search, page)
+        return
+    
+    text, reply_markup, _ = get_search_page(update.effective_user.id, search, page)
+    query.edit_message_text(text, parse_mode='Markdown', reply_markup=reply_markup)
+
+def inline_query(update: Update, context: CallbackContext) -> None:
+    """Answer `@bot query` with the user's matching files as cached results.
+    
+    The query accepts the same words and filters as /search. Results are
+    paged by next_offset, INLINE_PAGE_SIZE at a time.
+    """
+    query = update.inline_query
+    user_id = query.from_user.id
+    text = query.query.strip()
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    
+    page = inline.result_cache.get(user_id, text, offset)
+    if page is None:
+        search = parse_search_query(text)
+        page_number = offset // inline.INLINE_PAGE_SIZE + 1
+        files, total_pages, _ = db.search_files(
+            user_id, search["text"], search["file_type"], search["category"], page_number, inline.INLINE_PAGE_SIZE
+        )
+        
+        # search_files() clamps the page, so a stale offset past the end gets nothing
+        results = inline.build_results(files, offset) if page_number <= total_pages else []
+        next_offset = str(offset + inline.INLINE_PAGE_SIZE) if page_number < total_pages else ""
+        page = (results, next_offset)
+        inline.result_cache.put(user_id, text, offset, page)
+    
+    results, next_offset = page
+    query.answer(results, cache_time=inline.INLINE_CACHE_TTL, is_personal=True, next_offset=next_offset)
+
 def delete_category_command(update: Update, context: CallbackContext) -> None:
     """Show categories to delete from the /delete command."""
     user_id = update.effective_user.id
@@ -744,14 +1085,7 @@ def delete_category_command(update: Update, context: CallbackContext) -> None:
         )
         return
     
-    buttons = []
-    for category in categories:
-        buttons.append([InlineKeyboardButton(category, callback_data=f'delete_{category}')])
-    
-    # Add back button
-    buttons.append([InlineKeyboardButton("« Back to Menu", callback_data='back_to_menu')])
-    
-    reply_markup = InlineKeyboardMarkup(buttons)
+    reply_markup = get_category_keyboard(user_id, 'delete_list')
     
     update.message.reply_text(
         '🗑 *Delete Category*\n\nSelect a category to delete:',
@@ -775,14 +1109,7 @@ def delete_categories_from_query(update: Update, context: CallbackContext) -> in
         )
         return MAIN_MENU
     
-    buttons = []
-    for category in categories:
-        buttons.append([InlineKeyboardButton(category, callback_data=f'delete_{category}')])
-    
-    # Add back button
-    buttons.append([InlineKeyboardButton("« Back to Menu", callback_data='back_to_menu')])
-    
-    reply_markup = InlineKeyboardMarkup(buttons)
+    reply_markup = get_category_keyboard(user_id, 'delete_list')
     
     query.edit_message_text(
         '🗑 *Delete Category*\n\nSelect a category to delete:',
@@ -800,11 +1127,14 @@ def handle_delete_selection(update: Update, context: CallbackContext) -> None:
     if query.data == 'back_to_menu':
         return show_menu(update, context)
     
-    category_name = query.data.replace('delete_', '')
+    _, _, category_name, _ = decode_category_callback(update)
+    if category_name is None:
+        return show_missing_category(update, context)
     user_id = update.effective_user.id
     
     # Delete the category
     success = db.delete_category(user_id, category_name)
+    inline.result_cache.invalidate(user_id)
     
     if success:
         query.edit_message_text(
@@ -861,53 +1191,58 @@ def handle_pending_file(update: Update, context: CallbackContext) -> int:
     
     return CHOOSING_FILE
 
-def main() -> None:
-    """Start the bot."""
-    # Initialize the database
-    db.init_db()
+def start_polling(updater) -> None:
+    """Delete any webhook and start fetching updates with getUpdates.
     
-    # Print environment variables for debugging (masking sensitive values)
-    logger.info(f"Environment variables:")
-    logger.info(f"IS_DOCKER: {os.environ.get('IS_DOCKER')}")
-    logger.info(f"RENDER: {os.environ.get('RENDER')}")
-    logger.info(f"PORT: {os.environ.get('PORT')}")
-    logger.info(f"HEALTH_PORT: {os.environ.get('HEALTH_PORT')}")
-    logger.info(f"RENDER_EXTERNAL_URL: {os.environ.get('RENDER_EXTERNAL_URL')}")
-    logger.info(f"BOT_TOKEN set: {'Yes' if os.environ.get('BOT_TOKEN') else 'No'}")
-    logger.info(f"CHANNEL_ID set: {'Yes' if os.environ.get('CHANNEL_ID') else 'No'}")
-    
-    # Start health check server if running in Docker/Render
-    if os.environ.get('IS_DOCKER') == 'true' or os.environ.get('RENDER') == 'true':
-        run_health_server()
-        logger.info("Health check server started")
+    Only one process may poll a bot at a time; run several replicas in
+    webhook mode instead.
+    """
+    try:
+        updater.bot.delete_webhook()
+        logger.info("Deleted existing webhook")
+    except Exception as e:
+        logger.error(f"Error deleting webhook: {e}")
     
-    # Create the Updater and pass it your bot's token
-    bot_token = os.getenv("BOT_TOKEN")
-    if not bot_token:
-        logger.error("No BOT_TOKEN environment variable found! Exiting...")
+    updater.start_polling()
+    logger.info("Polling mode started")
+
+def profile_command(update: Update, context: CallbackContext) -> None:
+    """Profile this bot process for N seconds with /profile N and send the results; admins only."""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        logger.warning(f"User {update.effective_user.id} tried /profile without being an admin")
         return
     
-    updater = Updater(bot_token)
-    
-    # Log bot information
     try:
-        bot_info = updater.bot.get_me()
-        logger.info(f"Bot connected successfully: @{bot_info.username} (ID: {bot_info.id})")
-    except Exception as e:
-        logger.error(f"Failed to get bot information: {e}")
-        logger.error("Please check your BOT_TOKEN")
+        seconds = float(context.args[0]) if context.args else 10
+    except ValueError:
+        update.message.reply_text(f"Usage: /profile [seconds], at most {profiler.MAX_PROFILE_SECONDS}")
         return
     
-    # Get the dispatcher to register handlers
-    dispatcher = updater.dispatcher
+    seconds = max(1, min(seconds, profiler.MAX_PROFILE_SECONDS))
+    update.message.reply_text(f"⏱ Profiling for {seconds:g}s...")
     
-    # Set up the commands menu
+    # Sample on a thread of its own so that no update lane waits for it
+    threading.Thread(
+        target=send_profile, args=(context.bot, update.effective_chat.id, seconds), name="profiler", daemon=True
+    ).start()
+
+def send_profile(bot, chat_id: int, seconds: float) -> None:
+    """Run a profile and send its summary and collapsed stacks to the chat."""
     try:
-        set_bot_commands(updater)
-        logger.info("Bot commands set successfully")
-    except Exception as e:
-        logger.error(f"Failed to set bot commands: {e}")
-    
+        result = profiler.profile_to_file(seconds)
+        if result is None:
+            bot.send_message(chat_id, "A profile is already running, try again when it is done.")
+            return
+        
+        profile, path = result
+        bot.send_message(chat_id, profile.summary()[:4000])
+        with open(path, 'rb') as f:
+            bot.send_document(chat_id, f, filename=os.path.basename(path))
+    except Exception:
+        logger.exception("Error sending profile")
+
+def register_handlers(dispatcher) -> None:
+    """Add the bot's command, callback and conversation handlers to a dispatcher."""
     # Basic commands
     dispatcher.add_handler(CommandHandler("start", start_command))
     dispatcher.add_handler(CommandHandler("help", help_command))
@@ -919,19 +1254,42 @@ def main() -> None:
     # Category deletion
     dispatcher.add_handler(CommandHandler("delete", delete_category_command))
     
+    # File search
+    dispatcher.add_handler(CommandHandler("search", search_command))
+    dispatcher.add_handler(CallbackRouter({
+        'search_page': handle_search_callback,
+        'search_send': handle_search_callback,
+        # Page number buttons, in any state of the conversation
+        'ignore': answer_only,
+    }))
+    dispatcher.add_handler(InlineQueryHandler(inline_query))
+    
+    # Admin only: profile the running process
+    dispatcher.add_handler(CommandHandler("profile", profile_command))
+    
+    # Buttons of the menus that work from any point of the conversation
+    menu_routes = {
+        'back_to_menu': show_menu,
+        'help': help_from_query,
+        'menu_files': handle_menu_selection,
+        'menu_categories': handle_menu_selection,
+        'menu_delete': handle_menu_selection,
+        'browse': handle_browse_selection,
+        'add_files': handle_browse_selection,
+        'page': handle_browse_selection,
+        'delete': handle_delete_selection,
+        'category_list': handle_category_list_page,
+        'delete_list': handle_category_list_page,
+        'browse_list': handle_category_list_page,
+    }
+    
     # Conversation handler for categories and file storage
     conv_handler = ConversationHandler(
         entry_points=[
             CommandHandler("categories", show_categories),
             CommandHandler("menu", show_menu),
             CommandHandler("files", browse_files),
-            CallbackQueryHandler(show_menu, pattern='^back_to_menu$'),
-            CallbackQueryHandler(help_from_query, pattern='^help$'),
-            CallbackQueryHandler(handle_menu_selection, pattern='^menu_'),
-            CallbackQueryHandler(handle_browse_selection, pattern='^browse_'),
-            CallbackQueryHandler(handle_browse_selection, pattern='^add_files_'),
-            CallbackQueryHandler(handle_browse_selection, pattern='^page_'),
-            CallbackQueryHandler(handle_delete_selection, pattern='^delete_'),
+            CallbackRouter(menu_routes),
             MessageHandler(
                 Filters.photo | Filters.video | Filters.document | 
                 Filters.audio | Filters.voice | Filters.animation,
@@ -940,19 +1298,14 @@ def main() -> None:
         ],
         states={
             MAIN_MENU: [
-                CallbackQueryHandler(help_from_query, pattern='^help$'),
-                CallbackQueryHandler(handle_menu_selection, pattern='^menu_'),
-                CallbackQueryHandler(handle_browse_selection, pattern='^browse_'),
-                CallbackQueryHandler(handle_browse_selection, pattern='^add_files_'),
-                CallbackQueryHandler(handle_browse_selection, pattern='^page_'),
-                CallbackQueryHandler(handle_delete_selection, pattern='^delete_'),
+                CallbackRouter(menu_routes),
             ],
             CHOOSING_CATEGORY: [
                 CallbackQueryHandler(handle_category_selection),
             ],
             WAITING_FOR_CATEGORY_NAME: [
                 MessageHandler(Filters.text & ~Filters.command, create_new_category),
-                CallbackQueryHandler(show_menu, pattern='^back_to_menu$'),
+                CallbackRouter({'back_to_menu': show_menu}),
             ],
             CHOOSING_FILE: [
                 CommandHandler("done", done),
@@ -971,68 +1324,157 @@ def main() -> None:
             MessageHandler(Filters.text & ~Filters.command, handle_text_input),
         ],
         allow_reentry=True,
+        name="main",
+        persistent=MONGO_PERSISTENCE,
     )
     
     dispatcher.add_handler(conv_handler)
     
-    # Delete webhook before starting the bot
+    # Record the latency of every handler
+    instrument_handlers(dispatcher)
+
+def build_updater(bot_token: str) -> Updater:
+    """Create an Updater whose dispatcher handles updates concurrently, with all handlers added."""
+    # Route every outgoing request through the outbound rate limiter; the
+    # connection pool also has to serve the file delivery threads
+    request = Request(
+        con_pool_size=DISPATCH_LANES + BACKGROUND_LANES + delivery.DELIVERY_WORKERS + 4
+    )
+    bot = ThrottledBot(token=bot_token, request=request)
+    
+    # Handle updates of different users in parallel, each user's in order
+    job_queue = JobQueue()
+    # Keep conversation state in MongoDB so that several bot processes can serve the same users
+    persistence = MongoPersistence() if MONGO_PERSISTENCE else None
+    if MONGO_PERSISTENCE:
+        # Other processes may then change the categories of this process's users
+        db.enable_category_revalidation()
+    # No handler uses run_async, so the dispatcher needs no worker threads of its own
+    dispatcher = ConcurrentDispatcher(
+        bot, Queue(), workers=0, job_queue=job_queue, persistence=persistence
+    )
+    job_queue.set_dispatcher(dispatcher)
+    updater = Updater(dispatcher=dispatcher, workers=None)
+    
+    register_handlers(dispatcher)
+    # Save albums still waiting for their last item before the background lanes stop
+    dispatcher.drain_hooks.append(album_aggregator.flush_all)
+    start_metrics_export()
+    profiler.install_signal_handler()
+    return updater
+
+def main() -> None:
+    """Start the bot."""
+    # Initialize the database
+    db.init_db()
+    
+    # Move any users still stored in the embedded layout to the files collection
     try:
-        updater.bot.delete_webhook()
-        logger.info("Deleted existing webhook")
+        db.migrate_embedded_layout()
     except Exception as e:
-        logger.error(f"Error deleting webhook: {e}")
+        logger.error(f"Error migrating embedded user documents: {e}")
+    
+    # Fill in the file counters of categories created by older versions
+    try:
+        db.backfill_category_counters()
+    except Exception as e:
+        logger.error(f"Error backfilling category counters: {e}")
+    
+    # Print environment variables for debugging (masking sensitive values)
+    logger.info(f"Environment variables:")
+    logger.info(f"IS_DOCKER: {os.environ.get('IS_DOCKER')}")
+    logger.info(f"RENDER: {os.environ.get('RENDER')}")
+    logger.info(f"PORT: {os.environ.get('PORT')}")
+    logger.info(f"HEALTH_PORT: {os.environ.get('HEALTH_PORT')}")
+    logger.info(f"RENDER_EXTERNAL_URL: {os.environ.get('RENDER_EXTERNAL_URL')}")
+    logger.info(f"BOT_TOKEN set: {'Yes' if os.environ.get('BOT_TOKEN') else 'No'}")
+    logger.info(f"CHANNEL_ID set: {'Yes' if os.environ.get('CHANNEL_ID') else 'No'}")
     
-    # Check if we're running on Render
-    if os.environ.get('RENDER') == 'true':
-        # Get the Render URL from environment
+    # Start health check server if running in Docker/Render
+    if os.environ.get('IS_DOCKER') == 'true' or os.environ.get('RENDER') == 'true':
+        run_health_server()
+        logger.info("Health check server started")
+    
+    # Create the Updater and pass it your bot's token
+    bot_token = os.getenv("BOT_TOKEN")
+    if not bot_token:
+        logger.error("No BOT_TOKEN environment variable found! Exiting...")
+        return
+    
+    updater = build_updater(bot_token)
+    
+    # Log bot information
+    try:
+        bot_info = updater.bot.get_me()
+        logger.info(f"Bot connected successfully: @{bot_info.username} (ID: {bot_info.id})")
+    except Exception as e:
+        logger.error(f"Failed to get bot information: {e}")
+        logger.error("Please check your BOT_TOKEN")
+        return
+    
+    # Set up the commands menu
+    try:
+        set_bot_commands(updater)
+        logger.info("Bot commands set successfully")
+    except Exception as e:
+        logger.error(f"Failed to set bot commands: {e}")
+    
+    # Webhook mode: any deployment can set WEBHOOK_URL, Render provides RENDER_EXTERNAL_URL
+    webhook_base_url = os.environ.get('WEBHOOK_URL')
+    if not webhook_base_url and os.environ.get('RENDER') == 'true':
+        webhook_base_url = os.environ.get('RENDER_EXTERNAL_URL')
+        if not webhook_base_url:
+            logger.warning("RENDER_EXTERNAL_URL not found, falling back to polling")
+    
+    if webhook_base_url:
+        # Every replica registers the same URL, so the webhook is not deleted
+        # first: that would briefly cut off the replicas that are already running
         PORT = int(os.environ.get('PORT', 10000))
-        RENDER_URL = os.environ.get('RENDER_EXTERNAL_URL')
         
-        if RENDER_URL:
-            try:
-                # Set webhook with proper path
-                webhook_url = f"{RENDER_URL}/telegram"
-                logger.info(f"Attempting to set webhook to {webhook_url}")
+        try:
+            # Set webhook with proper path
+            webhook_url = f"{webhook_base_url.rstrip('/')}/telegram"
+            logger.info(f"Attempting to set webhook to {webhook_url}")
+            
+            # Set the webhook with more detailed error messages
+            webhook_result = updater.bot.set_webhook(url=webhook_url)
+            
+            if webhook_result:
+                logger.info(f"Successfully set webhook to {webhook_url}")
                 
-                # Set the webhook with more detailed error messages
-                webhook_result = updater.bot.set_webhook(url=webhook_url)
+                # Verify webhook was set
+                webhook_info = updater.bot.get_webhook_info()
+                logger.info(f"Webhook verification - URL: {webhook_info.url}, Pending updates: {webhook_info.pending_update_count}")
                 
-                if webhook_result:
-                    logger.info(f"Successfully set webhook to {webhook_url}")
-                    
-                    # Verify webhook was set
-                    webhook_info = updater.bot.get_webhook_info()
-                    logger.info(f"Webhook verification - URL: {webhook_info.url}, Pending updates: {webhook_info.pending_update_count}")
-                    
-                    # Start webhook server
-                    updater.start_webhook(
-                        listen="0.0.0.0",
-                        port=PORT,
-                        url_path="telegram",
-                        webhook_url=webhook_url
-                    )
-                    logger.info(f"Webhook server started on port {PORT}")
+                if SHARD_WORKERS > 1:
+                    # This process only receives updates; worker processes with
+                    # their own MongoDB pools handle them, each user on one worker
+                    db.close_connection()
+                    run_sharded(build_updater, SHARD_WORKERS, PORT, "telegram")
                 else:
-                    raise Exception("Webhook returned False")
-                    
-            except Exception as e:
-                logger.error(f"Failed to set up webhook: {e}")
-                # Fallback to polling if webhook setup fails
-                logger.info("Falling back to polling mode due to webhook setup failure")
-                updater.start_polling()
-                logger.info("Polling mode started")
-        else:
-            # Fallback to polling if RENDER_EXTERNAL_URL is not available
-            logger.warning("RENDER_EXTERNAL_URL not found, falling back to polling")
-            updater.start_polling()
-            logger.info("Polling mode started")
+                    # Receive updates through the bounded ingest queue until a stop signal
+                    serve_webhook(updater, PORT, "telegram")
+                
+                # Write any buffered files before exiting
+                db.close_connection()
+                return
+            else:
+                raise Exception("Webhook returned False")
+                
+        except Exception as e:
+            logger.error(f"Failed to set up webhook: {e}")
+            # Fallback to polling if webhook setup fails
+            logger.info("Falling back to polling mode due to webhook setup failure")
+            start_polling(updater)
     else:
         # Start the Bot in polling mode
-        updater.start_polling()
-        logger.info("Bot started successfully in polling mode")
+        start_polling(updater)
     
     # Run the bot until you press Ctrl-C or the process receives SIGINT, SIGTERM or SIGABRT
     updater.idle()
+    
+    # Write any buffered files before exiting
+    db.close_connection()
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
@@ -0,0 +1,89 @@
+import base64
+from typing import Any, Callable, Dict, Optional, Tuple
+from telegram import Update
+from telegram.ext import Handler
+
+# Telegram rejects callback data longer than this many bytes
+MAX_CALLBACK_DATA = 64
+
+def _pack(values: Tuple[int, ...]) -> bytes:
+    """Encode non-negative integers as LEB128 varints."""
+    packed = bytearray()
+    for value in values:
+        if value < 0:
+            raise ValueError(f"callback arguments must be non-negative, got {value}")
+        while True:
+            byte = value & 0x7F
+            value >>= 7
+            if value:
+                packed.append(byte | 0x80)
+            else:
+                packed.append(byte)
+                break
+    return bytes(packed)
+
+def _unpack(packed: bytes) -> Tuple[int, ...]:
+    """Inverse of _pack()."""
+    values = []
+    value = shift = 0
+    for byte in packed:
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            values.append(value)
+            value = shift = 0
+    if shift:
+        raise ValueError("truncated callback arguments")
+    return tuple(values)
+
+def encode(action: str, *args: int) -> str:
+    """Build the callback data of a button.
+    
+    Integer arguments such as a category id and a page number are packed as
+    varints and base64url encoded after a colon, e.g. `page:AwU`, so the data
+    stays a few bytes long whatever the category is called.
+    """
+    if not args:
+        return action
+    
+    packed = base64.urlsafe_b64encode(_pack(args)).rstrip(b'=').decode('ascii')
+    data = f"{action}:{packed}"
+    if len(data.encode('utf-8')) > MAX_CALLBACK_DATA:
+        raise ValueError(f"callback data too long: {data}")
+    return data
+
+def decode(data: str) -> Tuple[str, Tuple[int, ...]]:
+    """Split callback data into its action and arguments.
+    
+    Raises:
+        ValueError: If the arguments are not valid encode() output
+    """
+    action, _, packed = data.partition(':')
+    if not packed:
+        return action, ()
+    return action, _unpack(base64.urlsafe_b64decode(packed + '=' * (-len(packed) % 4)))
+
+class CallbackRouter(Handler):
+    """Handler that picks the callback for a callback query by the action of its data.
+    
+    One dict lookup replaces trying a regex CallbackQueryHandler per action.
+    Queries whose action has no route go to `default`, or are left to the
+    next handler if there is none. Like any handler, the router returns the
+    callback's result, so it can be used inside a ConversationHandler.
+    """
+    
+    def __init__(self, routes: Dict[str, Callable], default: Optional[Callable] = None):
+        super().__init__(default)
+        self.routes = routes
+        self.default = default
+    
+    def check_update(self, update: Any) -> Optional[Callable]:
+        """Return the callback for the update, or None if the router does not handle it."""
+        if isinstance(update, Update) and update.callback_query and update.callback_query.data:
+            action = update.callback_query.data.partition(':')[0]
+            return self.routes.get(action, self.default)
+        return None
+    
+    def handle_update(self, update: Any, dispatcher, check_result: Callable, context=None):
+        """Call the callback chosen by check_update()."""
+        return check_result(update, context)
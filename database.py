@@ -1,11 +1,20 @@
 import os
+import time
+import functools
 import logging
+import threading
+from collections import OrderedDict
 from typing import Dict, List, Optional, Any, Tuple
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, TEXT, ReturnDocument
 from pymongo.collection import Collection
 from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError
 from dotenv import load_dotenv
 
+import metrics
+from instrumentation import MongoCommandTimer
+from pools import TrackedExecutor
+
 # Load environment variables
 load_dotenv()
 
@@ -17,43 +26,145 @@ logger = logging.getLogger(__name__)
 MONGO_URI = os.environ.get('MONGO_URI')
 DB_NAME = 'telegram_storage_bot'
 USERS_COLLECTION = 'users'
+CATEGORIES_COLLECTION = 'categories'
+FILES_COLLECTION = 'files'
+SESSIONS_COLLECTION = 'sessions'
+
+# Maximum number of concurrent MongoDB operations (threads and connections)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+
+# Write-behind buffer for uploads: records per flush and seconds before a flush
+WRITE_BUFFER_SIZE = max(1, int(os.environ.get('WRITE_BUFFER_SIZE', 50)))
+WRITE_BUFFER_DELAY = float(os.environ.get('WRITE_BUFFER_DELAY', 1.0))
+
+# Category index cache settings
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 1024))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 300))
+
+# Seconds a cached category list is used before its version is compared with
+# MongoDB again, once enable_category_revalidation() was called
+CATEGORY_VERSION_CHECK_INTERVAL = float(os.environ.get('CATEGORY_VERSION_CHECK_INTERVAL', 2))
 
 # Global connection objects
 mongo_client = None
 db = None
 users_collection = None
+categories_collection = None
+files_collection = None
+sessions_collection = None
+
+# Client of ping() once the main client is closed
+_ping_client = None
+
+# In-process LRU cache of category indexes: user_id -> (expires_at, checked_at, (version, [category, ...]))
+_user_cache: "OrderedDict[str, Tuple[float, float, Tuple[int, List[Dict[str, Any]]]]]" = OrderedDict()
+# Whether other processes may change the categories of this process's users
+_revalidate_categories = False
+_user_cache_lock = threading.Lock()
+# Invalidations so far, and per user the count at their latest one, so that a
+# list read before a write to that user's categories is not cached
+_user_cache_generation = 0
+_user_invalidations: "OrderedDict[str, int]" = OrderedDict()
+# Latest count dropped from _user_invalidations; older reads of any user are not cached
+_forgotten_generation = 0
+_cache_lookups = metrics.counter("user_cache_lookups_total", "Category index cache lookups, by result: hit or miss")
+_cache_events = metrics.counter("user_cache_events_total", "Category index cache removals, by event: eviction or invalidation")
+metrics.register_gauge(
+    "user_cache_size",
+    "Users whose category index is cached",
+    lambda: len(_user_cache)
+)
+
+# Files waiting to be written: (user_id, category) -> [file_info, ...]
+_pending_files: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+_pending_timers: Dict[Tuple[str, str], threading.Timer] = {}
+_pending_lock = threading.Lock()
+_flush_lock = threading.Lock()
 
-# Database structure in MongoDB will be similar to the JSON structure:
-# {
-#   "_id": "user_id",
-#   "categories": {
-#     "category_name": [
-#       {"message_id": 123, "file_type": "photo", "file_name": "example.jpg"},
-#     ]
-#   }
-# }
+# Bounded pool that runs every MongoDB-bound call made by the handlers
+_db_pool = TrackedExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="mongo")
+metrics.register_gauge(
+    "mongo_pool_queue_depth",
+    "MongoDB calls waiting or running in the database pool",
+    lambda: _db_pool.queue_depth
+)
+
+# Database structure in MongoDB:
+#
+# categories: one document per user category
+#   {"_id": ObjectId, "user_id": "123", "name": "Photos", "cid": 0, "next_seq": 2, "created_at": 1700000000.0,
+#    "file_count": 2, "total_bytes": 104622, "last_added_at": 1700000100.0}
+#   cid is a short per-user id that is never reused, so buttons can refer to a
+#   category without embedding its name; it is assigned on first listing
+#   file_count, total_bytes and last_added_at are kept up to date on every insert,
+#   so listings never have to count the files collection
+#
+# files: one document per stored file, ordered inside a category by seq
+#   {"_id": ObjectId, "user_id": "123", "category": "Photos", "seq": 0,
+#    "message_id": 123, "file_type": "photo", "file_name": "example.jpg", "file_id": "AgAC...",
+#    "file_unique_id": "AQAD...", "file_size": 52311, "mime_type": "image/jpeg"}
+#
+# sessions: conversation state and user_data of each user, shared by all bot processes
+#   {"_id": "123", "user_data": {"current_category": "Photos"},
+#    "conversations": {"main": {"123:123": 3}}, "updated_at": 1700000000.0}
+#
+# users: legacy embedded layout, migrated by migrate_embedded_layout(),
+# and the counter that hands out category ids
+#   {"_id": "123", "categories": {"Photos": [{"message_id": 123, ...}]}, "next_cid": 1, "category_version": 4}
+#   category_version is raised whenever a category is created or deleted, so a
+#   copy of the category list is current as long as the version is unchanged
+
+# Fields that are internal to the files collection and not part of a file record
+_FILE_PROJECTION = {"_id": 0, "user_id": 0, "category": 0, "seq": 0}
 
 def init_db() -> None:
     """Initialize the MongoDB connection if it's not already initialized."""
-    global mongo_client, db, users_collection
+    global mongo_client, db, users_collection, categories_collection, files_collection, sessions_collection
     
     if not MONGO_URI:
         logger.error("MONGO_URI environment variable is not set!")
         raise ValueError("MONGO_URI environment variable must be set")
-        
+    
     try:
         if mongo_client is None:
-            # Create a MongoDB client
-            mongo_client = MongoClient(MONGO_URI)
+            # Create a MongoDB client that times every command it sends
+            mongo_client = MongoClient(MONGO_URI, maxPoolSize=DB_POOL_SIZE, event_listeners=[MongoCommandTimer()])
             
             # Access the database
             db = mongo_client[DB_NAME]
             
-            # Access the users collection
+            # Access the collections
             users_collection = db[USERS_COLLECTION]
+            categories_collection = db[CATEGORIES_COLLECTION]
+            files_collection = db[FILES_COLLECTION]
+            sessions_collection = db[SESSIONS_COLLECTION]
+            
+            # One category per name and user, files ordered within their category
+            categories_collection.create_index(
+                [("user_id", ASCENDING), ("name", ASCENDING)], unique=True
+            )
+            categories_collection.create_index(
+                [("user_id", ASCENDING), ("cid", ASCENDING)],
+                unique=True,
+                partialFilterExpression={"cid": {"$exists": True}}
+            )
+            files_collection.create_index(
+                [("user_id", ASCENDING), ("category", ASCENDING), ("seq", ASCENDING)], unique=True
+            )
+            
+            # Word search on file names within one user's files; "none" keeps
+            # file names from being stemmed or losing stop words
+            files_collection.create_index(
+                [("user_id", ASCENDING), ("file_name", TEXT), ("file_type", ASCENDING), ("category", ASCENDING)],
+                name="file_name_search",
+                default_language="none"
+            )
             
-            # Create an index on user_id for faster lookups
-            users_collection.create_index("_id")
+            # Finds a file the user has stored before, to reuse its channel message
+            files_collection.create_index(
+                [("user_id", ASCENDING), ("file_unique_id", ASCENDING)],
+                partialFilterExpression={"file_unique_id": {"$exists": True}}
+            )
             
             logger.info(f"Successfully connected to MongoDB database '{DB_NAME}'")
             
@@ -64,37 +175,352 @@ def init_db() -> None:
         logger.error(f"Error connecting to MongoDB: {e}")
         raise
 
-def get_user_data(user_id: int) -> Dict[str, Any]:
-    """Get data for a specific user."""
+def _on_db_pool(func):
+    """Run a database function on the bounded MongoDB pool and wait for its result.
+    
+    Calls made from inside the pool run directly, so database functions can
+    call each other without waiting on a free pool thread.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _db_pool.in_worker():
+            return func(*args, **kwargs)
+        return _db_pool.submit(func, *args, **kwargs).result()
+    return wrapper
+
+def _cache_get(user_id_str: str) -> Optional[Tuple[bool, Tuple[int, List[Dict[str, Any]]]]]:
+    """Return (current, (version, category index)) from the cache, or None if missing or expired.
+    
+    `current` is False when the entry's version is due to be compared with
+    the one in MongoDB.
+    """
+    with _user_cache_lock:
+        entry = _user_cache.get(user_id_str)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        expires_at, checked_at, categories = entry
+        if expires_at <= now:
+            del _user_cache[user_id_str]
+            return None
+        _user_cache.move_to_end(user_id_str)
+        current = not _revalidate_categories or now - checked_at < CATEGORY_VERSION_CHECK_INTERVAL
+        return current, categories
+
+def _cache_checked(user_id_str: str, version: int) -> None:
+    """Note that a cached entry of the given version was found to be current."""
+    with _user_cache_lock:
+        entry = _user_cache.get(user_id_str)
+        if entry is not None and entry[2][0] == version:
+            _user_cache[user_id_str] = (entry[0], time.monotonic(), entry[2])
+
+def _cache_put(user_id_str: str, categories: Tuple[int, List[Dict[str, Any]]], generation: int) -> None:
+    """Store a (version, category index) pair unless the user's categories were written since it was read."""
+    if USER_CACHE_SIZE <= 0:
+        return
+    
+    with _user_cache_lock:
+        if _user_invalidations.get(user_id_str, _forgotten_generation) > generation:
+            return
+        now = time.monotonic()
+        _user_cache[user_id_str] = (now + USER_CACHE_TTL, now, categories)
+        _user_cache.move_to_end(user_id_str)
+        while len(_user_cache) > USER_CACHE_SIZE:
+            _user_cache.popitem(last=False)
+            _cache_events.inc(event="eviction")
+
+def _record_invalidation(user_id_str: str) -> None:
+    """Refuse to cache lists of the user read before now; called with the cache lock held."""
+    global _user_cache_generation, _forgotten_generation
+    _user_cache_generation += 1
+    _user_invalidations[user_id_str] = _user_cache_generation
+    _user_invalidations.move_to_end(user_id_str)
+    while len(_user_invalidations) > max(1, USER_CACHE_SIZE):
+        _forgotten_generation = _user_invalidations.popitem(last=False)[1]
+
+def invalidate_user_cache(user_id: Optional[int] = None) -> None:
+    """Drop one user's cached category index, or the whole cache if no user is given."""
+    global _user_cache_generation, _forgotten_generation
+    with _user_cache_lock:
+        _cache_events.inc(event="invalidation")
+        if user_id is None:
+            _user_cache_generation += 1
+            _user_cache.clear()
+            _user_invalidations.clear()
+            _forgotten_generation = _user_cache_generation
+            return
+        
+        _user_cache.pop(str(user_id), None)
+        _record_invalidation(str(user_id))
+
+def _cache_apply(user_id_str: str, version: int, added: Optional[Dict[str, Any]] = None,
+                 removed: Optional[str] = None) -> None:
+    """Apply a category this process created or deleted to the user's cached list.
+    
+    Args:
+        user_id_str: The user's id
+        version: The category list version the change raised it to
+        added: The {"name", "cid"} of a created category
+        removed: The name of a deleted category
+    
+    The entry is only updated if it holds the version right before the
+    change; if any other change came in between it is dropped instead.
+    """
+    with _user_cache_lock:
+        _record_invalidation(user_id_str)
+        entry = _user_cache.get(user_id_str)
+        if entry is None:
+            return
+        expires_at, _, (cached_version, categories) = entry
+        if cached_version != version - 1:
+            del _user_cache[user_id_str]
+            _cache_events.inc(event="invalidation")
+            return
+        
+        if removed is not None:
+            categories = [category for category in categories if category["name"] != removed]
+        if added is not None and all(category["name"] != added["name"] for category in categories):
+            categories = categories + [added]
+        _user_cache[user_id_str] = (expires_at, time.monotonic(), (version, categories))
+
+def enable_category_revalidation() -> None:
+    """Compare cached category lists with their version in MongoDB every CATEGORY_VERSION_CHECK_INTERVAL seconds.
+    
+    Needed when other processes, such as webhook replicas, serve the same
+    users; otherwise only this process changes them and keeps its cache current.
+    """
+    global _revalidate_categories
+    _revalidate_categories = True
+
+def get_cache_stats() -> Dict[str, Any]:
+    """Get hit/miss counters for the category index cache, as also exposed on /metrics."""
+    stats = {
+        "hits": _cache_lookups.value(result="hit"),
+        "misses": _cache_lookups.value(result="miss"),
+        "evictions": _cache_events.value(event="eviction"),
+        "invalidations": _cache_events.value(event="invalidation"),
+        "size": len(_user_cache),
+    }
+    
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
+
+def _assign_category_ids(user_id_str: str, categories: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Give the categories that have no cid yet one, updating the dicts in place.
+    
+    Returns:
+        The categories that have a cid, in their order; a category deleted
+        before its cid could be read back is left out
+    """
+    missing = [category for category in categories if "cid" not in category]
+    if not missing:
+        return categories
+    
+    # Reserve a block of ids from the user's counter, so ids are never reused
+    before = users_collection.find_one_and_update(
+        {"_id": user_id_str},
+        {"$inc": {"next_cid": len(missing)}},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
+    first_cid = before.get("next_cid", 0) if before else 0
+    
+    for offset, category in enumerate(missing):
+        result = categories_collection.update_one(
+            {"_id": category["_id"], "cid": {"$exists": False}},
+            {"$set": {"cid": first_cid + offset}}
+        )
+        if result.modified_count:
+            category["cid"] = first_cid + offset
+        else:
+            # Another process assigned one first
+            stored = categories_collection.find_one({"_id": category["_id"]}, {"cid": 1})
+            category["cid"] = stored.get("cid") if stored else None
+    
+    return [category for category in categories if category["cid"] is not None]
+
+def _bump_category_version(user_id_str: str) -> int:
+    """Mark a user's category list as changed, after a category was created or deleted.
+    
+    Returns:
+        int: The new version
+    """
+    user = users_collection.find_one_and_update(
+        {"_id": user_id_str},
+        {"$inc": {"category_version": 1}},
+        projection={"category_version": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return user["category_version"]
+
+def _get_versioned_category_index(user_id: int) -> Tuple[int, List[Dict[str, Any]]]:
+    """Get a user's category list version and categories in creation order, as {"name", "cid"} dicts.
+    
+    The categories are served from an in-process LRU/TTL cache, so callers
+    must treat them as read-only. This process keeps the cache current when
+    it changes a user's categories; after enable_category_revalidation() a
+    cached list is also checked against the version in MongoDB now and then,
+    for changes made by other processes.
+    """
     init_db()
     
     user_id_str = str(user_id)
-    user_data = users_collection.find_one({"_id": user_id_str})
+    generation = _user_cache_generation
+    cached = _cache_get(user_id_str)
+    if cached is not None and cached[0]:
+        _cache_lookups.inc(result="hit")
+        return cached[1]
+    
+    # The version is read before the list: a category written in between
+    # raises it again, so the list can be newer than its version but never older
+    user = users_collection.find_one({"_id": user_id_str}, {"category_version": 1})
+    version = user.get("category_version", 0) if user else 0
     
-    if not user_data:
-        # Create new user document if it doesn't exist
-        user_data = {"_id": user_id_str, "categories": {}}
-        users_collection.insert_one(user_data)
-        logger.info(f"Created new user document for user {user_id}")
+    if cached is not None and cached[1][0] == version:
+        _cache_checked(user_id_str, version)
+        _cache_lookups.inc(result="hit")
+        return cached[1]
+    _cache_lookups.inc(result="miss")
     
-    return user_data
+    categories = list(categories_collection.find(
+        {"user_id": user_id_str},
+        {"name": 1, "cid": 1}
+    ).sort("_id", ASCENDING))
+    categories = _assign_category_ids(user_id_str, categories)
+    categories = [{"name": category["name"], "cid": category["cid"]} for category in categories]
+    
+    _cache_put(user_id_str, (version, categories), generation)
+    return version, categories
+
+def _get_category_index(user_id: int) -> List[Dict[str, Any]]:
+    """Get a user's categories in creation order, as {"name", "cid"} dicts."""
+    return _get_versioned_category_index(user_id)[1]
 
+@_on_db_pool
+def get_user_data(user_id: int) -> Dict[str, Any]:
+    """Get data for a specific user in the embedded `{"categories": {...}}` shape.
+    
+    This loads every file record of the user, so handlers should prefer the
+    per-category functions below.
+    """
+    user_id_str = str(user_id)
+    categories = {category["name"]: [] for category in _get_category_index(user_id)}
+    
+    for file_doc in files_collection.find({"user_id": user_id_str}).sort(
+        [("category", ASCENDING), ("seq", ASCENDING)]
+    ):
+        categories.setdefault(file_doc["category"], []).append(_to_file_info(file_doc))
+    
+    return {"_id": user_id_str, "categories": categories}
+
+@_on_db_pool
 def get_user_categories(user_id: int) -> List[str]:
     """Get all categories for a user."""
-    user_data = get_user_data(user_id)
+    flush_pending_files(user_id)
+    return [category["name"] for category in _get_category_index(user_id)]
+
+@_on_db_pool
+def get_category_list(user_id: int) -> Tuple[int, List[Tuple[str, int]]]:
+    """Get all categories for a user as (name, cid) pairs, with the list's version.
     
-    # Check if categories field exists
-    if "categories" not in user_data:
-        return []
+    The version only changes when a category is created or deleted, so
+    anything derived from the list can be reused while it stays the same.
     
-    return list(user_data["categories"].keys())
+    Returns:
+        Tuple containing (version, [(name, cid), ...])
+    """
+    flush_pending_files(user_id)
+    version, categories = _get_versioned_category_index(user_id)
+    return version, [(category["name"], category["cid"]) for category in categories]
 
-def add_file_to_category(user_id: int, category: str, message_id: int, file_type: str, file_name: Optional[str] = None) -> None:
-    """Add a file to a category."""
+@_on_db_pool
+def get_category_name(user_id: int, cid: int) -> Optional[str]:
+    """Get the name of a user's category by its cid, or None if it no longer exists."""
+    for category in _get_category_index(user_id):
+        if category["cid"] == cid:
+            return category["name"]
+    return None
+
+@_on_db_pool
+def get_category_stats(user_id: int) -> List[Dict[str, Any]]:
+    """Get every category for a user together with its counters.
+    
+    Reads one document per category, however many files they hold.
+    
+    Returns:
+        List of {"name", "cid", "file_count", "total_bytes", "last_added_at"}
+        dicts in creation order; last_added_at is None for categories without files
+    """
     init_db()
+    flush_pending_files(user_id)
     user_id_str = str(user_id)
     
-    # Prepare the file info
+    categories = list(categories_collection.find(
+        {"user_id": user_id_str},
+        {"name": 1, "cid": 1, "file_count": 1, "total_bytes": 1, "last_added_at": 1}
+    ).sort("_id", ASCENDING))
+    categories = _assign_category_ids(user_id_str, categories)
+    
+    return [
+        {
+            "name": category["name"],
+            "cid": category["cid"],
+            "file_count": category.get("file_count", 0),
+            "total_bytes": category.get("total_bytes", 0),
+            "last_added_at": category.get("last_added_at"),
+        }
+        for category in categories
+    ]
+
+@_on_db_pool
+def get_category_counts(user_id: int) -> List[Tuple[str, int]]:
+    """Get every category for a user together with its file count."""
+    return [(category["name"], category["file_count"]) for category in get_category_stats(user_id)]
+
+def _to_file_info(file_doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Strip the storage fields from a files document."""
+    return {key: value for key, value in file_doc.items() if key not in _FILE_PROJECTION}
+
+def _reserve_seq(user_id_str: str, category: str, count: int = 1, total_bytes: int = 0) -> Tuple[int, bool]:
+    """Reserve `count` sequence numbers in a category, creating it if needed.
+    
+    The category counters are raised in the same atomic update, by `count`
+    files of `total_bytes` bytes together.
+    
+    Returns:
+        Tuple containing (first_seq, created)
+    """
+    now = time.time()
+    update = {
+        "$inc": {"next_seq": count, "file_count": count, "total_bytes": total_bytes},
+        "$max": {"last_added_at": now},
+        "$setOnInsert": {"created_at": now}
+    }
+    
+    try:
+        before = categories_collection.find_one_and_update(
+            {"user_id": user_id_str, "name": category},
+            update,
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+    except DuplicateKeyError:
+        # Another writer created the category concurrently, so it exists now
+        before = categories_collection.find_one_and_update(
+            {"user_id": user_id_str, "name": category},
+            update,
+            return_document=ReturnDocument.BEFORE
+        )
+    
+    if before is None:
+        return 0, True
+    return before.get("next_seq", 0), False
+
+def _make_file_info(message_id: int, file_type: str, file_name: Optional[str] = None, file_id: Optional[str] = None,
+                    file_unique_id: Optional[str] = None, file_size: Optional[int] = None, mime_type: Optional[str] = None) -> Dict[str, Any]:
+    """Build the record stored for one file."""
     file_info = {
         "message_id": message_id,
         "file_type": file_type,
@@ -103,37 +529,236 @@ def add_file_to_category(user_id: int, category: str, message_id: int, file_type
     if file_name:
         file_info["file_name"] = file_name
     
-    # Update the user document - push the new file to the category array
-    result = users_collection.update_one(
-        {"_id": user_id_str},
-        {
-            "$push": {f"categories.{category}": file_info},
-        },
-        upsert=True
-    )
+    # The Telegram file_id lets browsing resend the file without the channel;
+    # file_unique_id identifies the same file across uploads and bots
+    if file_id:
+        file_info["file_id"] = file_id
+    if file_unique_id:
+        file_info["file_unique_id"] = file_unique_id
+    if file_size:
+        file_info["file_size"] = file_size
+    if mime_type:
+        file_info["mime_type"] = mime_type
+    
+    return file_info
+
+def _insert_files(user_id_str: str, category: str, file_infos: List[Dict[str, Any]]) -> None:
+    """Append file records to a category with one seq reservation and one insert."""
+    total_bytes = sum(file_info.get("file_size", 0) for file_info in file_infos)
+    seq, created = _reserve_seq(user_id_str, category, len(file_infos), total_bytes)
+    if created:
+        _bump_category_version(user_id_str)
+        invalidate_user_cache(user_id_str)
     
-    if result.modified_count > 0 or result.upserted_id:
-        logger.info(f"Added file to category '{category}' for user {user_id}")
+    file_docs = [
+        dict(file_info, user_id=user_id_str, category=category, seq=seq + offset)
+        for offset, file_info in enumerate(file_infos)
+    ]
+    
+    try:
+        if len(file_docs) == 1:
+            result = files_collection.insert_one(file_docs[0])
+            inserted = 1 if result.inserted_id else 0
+        else:
+            result = files_collection.insert_many(file_docs)
+            inserted = len(result.inserted_ids)
+    except Exception:
+        # Take back the counts of files that were not stored; seq numbers stay reserved
+        categories_collection.update_one(
+            {"user_id": user_id_str, "name": category},
+            {"$inc": {"file_count": -len(file_docs), "total_bytes": -total_bytes}}
+        )
+        raise
+    
+    if inserted == len(file_docs):
+        logger.info(f"Added {inserted} file(s) to category '{category}' for user {user_id_str}")
     else:
-        logger.warning(f"Failed to add file to category '{category}' for user {user_id}")
+        logger.warning(f"Failed to add files to category '{category}' for user {user_id_str}")
+
+@_on_db_pool
+def add_file_to_category(user_id: int, category: str, message_id: int, file_type: str, file_name: Optional[str] = None, file_id: Optional[str] = None,
+                         file_unique_id: Optional[str] = None, file_size: Optional[int] = None, mime_type: Optional[str] = None) -> None:
+    """Add a file to a category."""
+    init_db()
+    file_info = _make_file_info(message_id, file_type, file_name, file_id, file_unique_id, file_size, mime_type)
+    _insert_files(str(user_id), category, [file_info])
 
+@_on_db_pool
+def add_files_to_category(user_id: int, category: str, files: List[Dict[str, Any]]) -> None:
+    """Add several files to a category with a single write.
+    
+    Args:
+        user_id: Telegram user ID
+        category: Category name
+        files: Dicts with the arguments of add_file_to_category(), message_id and file_type required
+    """
+    if not files:
+        return
+    init_db()
+    _insert_files(str(user_id), category, [_make_file_info(**f) for f in files])
+
+def buffer_file_for_category(user_id: int, category: str, message_id: int, file_type: str, file_name: Optional[str] = None, file_id: Optional[str] = None,
+                             file_unique_id: Optional[str] = None, file_size: Optional[int] = None, mime_type: Optional[str] = None) -> None:
+    """Queue a file for a category and write it together with the files sent right after it.
+    
+    Records are grouped per (user, category) and written with one seq
+    reservation and one insert_many when WRITE_BUFFER_SIZE records are
+    pending, WRITE_BUFFER_DELAY seconds after the first one arrived, or when
+    flush_pending_files() is called (on /done, before reads of the user,
+    at shutdown).
+    
+    Durability: a buffered record lives only in this process until it is
+    flushed. If the process dies inside the window, the forwarded message
+    stays in the storage channel but is not listed in the category. The
+    window is bounded by WRITE_BUFFER_DELAY; set it to 0 to write every file
+    immediately.
+    """
+    buffer_files_for_category(user_id, category, [{
+        "message_id": message_id,
+        "file_type": file_type,
+        "file_name": file_name,
+        "file_id": file_id,
+        "file_unique_id": file_unique_id,
+        "file_size": file_size,
+        "mime_type": mime_type,
+    }])
+
+def buffer_files_for_category(user_id: int, category: str, files: List[Dict[str, Any]]) -> None:
+    """Queue several files at once, e.g. a whole album; see buffer_file_for_category()."""
+    if not files:
+        return
+    if WRITE_BUFFER_DELAY <= 0:
+        add_files_to_category(user_id, category, files)
+        return
+    
+    file_infos = [_make_file_info(**f) for f in files]
+    
+    key = (str(user_id), category)
+    with _pending_lock:
+        pending = _pending_files.setdefault(key, [])
+        pending.extend(file_infos)
+        full = len(pending) >= WRITE_BUFFER_SIZE
+        if not full and key not in _pending_timers:
+            timer = threading.Timer(WRITE_BUFFER_DELAY, _flush_key, args=(key,))
+            timer.daemon = True
+            _pending_timers[key] = timer
+            timer.start()
+    
+    if full:
+        _flush_key(key)
+
+def _flush_key(key: Tuple[str, str]) -> None:
+    """Write everything buffered for one (user, category) pair."""
+    # Flushes are serialized so batches of the same category keep their order.
+    # The write runs on the flushing thread itself: going through the pool
+    # while holding the lock could deadlock against pool threads that are
+    # flushing before a read.
+    with _flush_lock:
+        with _pending_lock:
+            file_infos = _pending_files.pop(key, [])
+            timer = _pending_timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        if not file_infos:
+            return
+        
+        user_id_str, category = key
+        try:
+            _insert_files(user_id_str, category, file_infos)
+        except Exception as e:
+            message_ids = [file_info["message_id"] for file_info in file_infos]
+            logger.error(f"Error writing buffered files {message_ids} to '{category}' for user {user_id_str}: {e}")
+
+def flush_pending_files(user_id: Optional[int] = None) -> None:
+    """Write buffered files of one user, or of every user if none is given."""
+    with _pending_lock:
+        keys = [key for key in _pending_files if user_id is None or key[0] == str(user_id)]
+    
+    for key in keys:
+        _flush_key(key)
+
+@_on_db_pool
+def find_stored_message_ids(user_id: int, file_unique_ids: List[Optional[str]]) -> Dict[str, int]:
+    """Find the channel messages that already hold some of a user's files.
+    
+    Args:
+        user_id: Telegram user ID
+        file_unique_ids: Telegram file_unique_ids to look up; None entries are ignored
+        
+    Returns:
+        Dict mapping each file_unique_id the user has stored before to its channel message_id
+    """
+    wanted = {unique_id for unique_id in file_unique_ids if unique_id}
+    if not wanted:
+        return {}
+    
+    user_id_str = str(user_id)
+    found = {}
+    
+    # Records still waiting in the write buffer are not in the collection yet
+    with _pending_lock:
+        for (pending_user_id, _), file_infos in _pending_files.items():
+            if pending_user_id != user_id_str:
+                continue
+            for file_info in file_infos:
+                unique_id = file_info.get("file_unique_id")
+                if unique_id in wanted:
+                    found.setdefault(unique_id, file_info["message_id"])
+    
+    missing = wanted - found.keys()
+    if missing:
+        init_db()
+        file_docs = files_collection.find(
+            {"user_id": user_id_str, "file_unique_id": {"$in": list(missing)}},
+            {"_id": 0, "file_unique_id": 1, "message_id": 1}
+        )
+        for file_doc in file_docs:
+            found.setdefault(file_doc["file_unique_id"], file_doc["message_id"])
+    
+    return found
+
+@_on_db_pool
 def get_files_in_category(user_id: int, category: str) -> List[Dict[str, Any]]:
     """Get all files in a category."""
-    user_data = get_user_data(user_id)
+    init_db()
+    flush_pending_files(user_id)
     
-    if "categories" not in user_data or category not in user_data["categories"]:
-        return []
+    cursor = files_collection.find(
+        {"user_id": str(user_id), "category": category},
+        _FILE_PROJECTION
+    ).sort("seq", ASCENDING)
     
-    return user_data["categories"][category]
+    return list(cursor)
 
+def _get_category_page(user_id_str: str, category: str, skip: int, limit: int) -> List[Dict[str, Any]]:
+    """Fetch one page of a category by walking the (user_id, category, seq) index."""
+    cursor = files_collection.find(
+        {"user_id": user_id_str, "category": category},
+        _FILE_PROJECTION
+    ).sort("seq", ASCENDING).skip(skip).limit(limit)
+    
+    return list(cursor)
+
+@_on_db_pool
 def get_files_in_category_paginated(user_id: int, category: str, page: int = 1, page_size: int = 5) -> Tuple[List[Dict[str, Any]], int, int]:
     """Get files in a category with pagination.
     
+    Only `page_size` file records are transferred regardless of how large
+    the category is.
+    
     Returns:
         Tuple containing (files_list, total_pages, total_files)
     """
-    all_files = get_files_in_category(user_id, category)
-    total_files = len(all_files)
+    init_db()
+    flush_pending_files(user_id)
+    user_id_str = str(user_id)
+    
+    # The category's counter saves counting its files
+    category_doc = categories_collection.find_one(
+        {"user_id": user_id_str, "name": category},
+        {"_id": 0, "file_count": 1}
+    )
+    total_files = category_doc.get("file_count", 0) if category_doc else 0
     
     # Calculate total pages
     total_pages = (total_files + page_size - 1) // page_size if total_files > 0 else 1
@@ -141,57 +766,220 @@ def get_files_in_category_paginated(user_id: int, category: str, page: int = 1,
     # Ensure page is within valid range
     page = max(1, min(page, total_pages))
     
-    # Get files for the requested page
-    start_idx = (page - 1) * page_size
-    end_idx = min(start_idx + page_size, total_files)
+    if total_files == 0:
+        return [], total_pages, total_files
     
-    return all_files[start_idx:end_idx], total_pages, total_files
+    files = _get_category_page(user_id_str, category, (page - 1) * page_size, page_size)
+    return files, total_pages, total_files
 
+@_on_db_pool
+def search_files(user_id: int, text: str = "", file_type: Optional[str] = None, category: Optional[str] = None,
+                 page: int = 1, page_size: int = 10) -> Tuple[List[Dict[str, Any]], int, int]:
+    """Search a user's files across categories by words in their file names.
+    
+    Args:
+        user_id: Telegram user ID
+        text: Words to look for in file names; empty matches every file
+        file_type: Only return files of this type
+        category: Only return files of this category
+        page: Page number, starting at 1
+        page_size: Number of files per page
+        
+    Returns:
+        Tuple containing (files_list, total_pages, total_files); each file
+        record also carries its "category"
+    """
+    init_db()
+    flush_pending_files(user_id)
+    
+    query: Dict[str, Any] = {"user_id": str(user_id)}
+    if text:
+        query["$text"] = {"$search": text}
+    if file_type:
+        query["file_type"] = file_type
+    if category:
+        query["category"] = category
+    
+    total_files = files_collection.count_documents(query)
+    total_pages = (total_files + page_size - 1) // page_size if total_files > 0 else 1
+    page = max(1, min(page, total_pages))
+    if total_files == 0:
+        return [], total_pages, total_files
+    
+    projection = {"_id": 0, "user_id": 0, "seq": 0}
+    sort = [("category", ASCENDING), ("seq", ASCENDING)]
+    if text:
+        # Best matches first
+        projection["score"] = {"$meta": "textScore"}
+        sort.insert(0, ("score", {"$meta": "textScore"}))
+    
+    cursor = files_collection.find(query, projection).sort(sort).skip((page - 1) * page_size).limit(page_size)
+    files = []
+    for file_doc in cursor:
+        file_doc.pop("score", None)
+        files.append(file_doc)
+    return files, total_pages, total_files
+
+@_on_db_pool
 def create_category(user_id: int, category: str) -> None:
     """Create a new category for a user."""
     init_db()
     user_id_str = str(user_id)
     
     # Check if the category already exists
-    user_data = get_user_data(user_id)
-    categories = user_data.get("categories", {})
-    
-    if category not in categories:
-        # Update the user document to include the new empty category
-        result = users_collection.update_one(
-            {"_id": user_id_str},
-            {"$set": {f"categories.{category}": []}},
+    if category in get_user_categories(user_id):
+        return
+    
+    try:
+        result = categories_collection.update_one(
+            {"user_id": user_id_str, "name": category},
+            {"$setOnInsert": {"next_seq": 0, "created_at": time.time(), "file_count": 0, "total_bytes": 0}},
             upsert=True
         )
-        
-        if result.modified_count > 0 or result.upserted_id:
-            logger.info(f"Created category '{category}' for user {user_id}")
-        else:
-            logger.warning(f"Failed to create category '{category}' for user {user_id}")
+    except DuplicateKeyError:
+        # Created concurrently by another request
+        result = None
+    if result is not None and result.upserted_id:
+        created = {"_id": result.upserted_id, "name": category}
+        resolved = _assign_category_ids(user_id_str, [created])
+        version = _bump_category_version(user_id_str)
+        # Deleted again before its cid was read back, nothing to add
+        _cache_apply(user_id_str, version, added={"name": category, "cid": created["cid"]} if resolved else None)
+    else:
+        invalidate_user_cache(user_id)
+    
+    if result is not None and result.upserted_id:
+        logger.info(f"Created category '{category}' for user {user_id}")
+    else:
+        logger.warning(f"Failed to create category '{category}' for user {user_id}")
 
+@_on_db_pool
 def delete_category(user_id: int, category: str) -> bool:
     """Delete a category for a user."""
     init_db()
+    flush_pending_files(user_id)
     user_id_str = str(user_id)
     
-    # Check if the category exists
-    user_data = get_user_data(user_id)
-    if "categories" not in user_data or category not in user_data["categories"]:
-        return False
+    # Remove the category and every file stored in it
+    result = categories_collection.delete_one({"user_id": user_id_str, "name": category})
+    files_collection.delete_many({"user_id": user_id_str, "category": category})
+    if result.deleted_count:
+        version = _bump_category_version(user_id_str)
+        _cache_apply(user_id_str, version, removed=category)
     
-    # Remove the category field
-    result = users_collection.update_one(
-        {"_id": user_id_str},
-        {"$unset": {f"categories.{category}": ""}}
-    )
-    
-    if result.modified_count > 0:
+    if result.deleted_count > 0:
         logger.info(f"Deleted category '{category}' for user {user_id}")
         return True
     else:
         logger.warning(f"Failed to delete category '{category}' for user {user_id}")
         return False
 
+def _replace_user_categories(user_id_str: str, categories: Dict[str, List[Dict[str, Any]]]) -> int:
+    """Replace everything stored for a user with an embedded-layout categories dict.
+    
+    Safe to re-run: existing category and file documents of the user are
+    removed first, so a retried import or migration does not duplicate files.
+    
+    Returns:
+        int: Number of file documents written
+    """
+    categories_collection.delete_many({"user_id": user_id_str})
+    files_collection.delete_many({"user_id": user_id_str})
+    
+    file_count = 0
+    now = time.time()
+    for name, files in categories.items():
+        categories_collection.insert_one({
+            "user_id": user_id_str,
+            "name": name,
+            "next_seq": len(files),
+            "created_at": now,
+            "file_count": len(files),
+            "total_bytes": sum(file_info.get("file_size", 0) for file_info in files),
+            "last_added_at": now if files else None
+        })
+        
+        file_docs = [
+            dict(file_info, user_id=user_id_str, category=name, seq=seq)
+            for seq, file_info in enumerate(files)
+        ]
+        if file_docs:
+            files_collection.insert_many(file_docs, ordered=False)
+            file_count += len(file_docs)
+    
+    _bump_category_version(user_id_str)
+    return file_count
+
+def migrate_embedded_layout() -> int:
+    """Move users still stored in the embedded layout to the files/categories collections.
+    
+    Each user document is converted and then stripped of its `categories`
+    field, so the migration can be interrupted and run again at any time.
+    
+    Returns:
+        int: Number of users migrated
+    """
+    init_db()
+    
+    migrated_users = 0
+    for user in users_collection.find({"categories": {"$exists": True}}):
+        user_id_str = user["_id"]
+        file_count = _replace_user_categories(user_id_str, user.get("categories") or {})
+        users_collection.update_one({"_id": user_id_str}, {"$unset": {"categories": ""}})
+        migrated_users += 1
+        logger.info(f"Migrated {file_count} files of user {user_id_str} to the files collection")
+    
+    if migrated_users:
+        invalidate_user_cache()
+        logger.info(f"Migrated {migrated_users} users from the embedded layout")
+    
+    return migrated_users
+
+def backfill_category_counters() -> int:
+    """Compute the counters of categories created before they were maintained.
+    
+    Only categories without a file_count are touched, so this is cheap once
+    every category has been backfilled and can run on every start. It must
+    run before files are added to such a category, which the bot ensures by
+    calling it at startup before handling updates.
+    
+    Returns:
+        int: Number of categories backfilled
+    """
+    init_db()
+    
+    backfilled = 0
+    for category in categories_collection.find({"file_count": {"$exists": False}}, {"user_id": 1, "name": 1}):
+        pipeline = [
+            {"$match": {"user_id": category["user_id"], "category": category["name"]}},
+            {"$group": {
+                "_id": None,
+                "file_count": {"$sum": 1},
+                "total_bytes": {"$sum": {"$ifNull": ["$file_size", 0]}},
+                "last_id": {"$max": "$_id"}
+            }}
+        ]
+        totals = next(files_collection.aggregate(pipeline), None)
+        
+        # Files carry no timestamp of their own; the newest ObjectId tells when it was inserted
+        counters = {"file_count": 0, "total_bytes": 0, "last_added_at": None}
+        if totals is not None:
+            counters = {
+                "file_count": totals["file_count"],
+                "total_bytes": totals["total_bytes"],
+                "last_added_at": totals["last_id"].generation_time.timestamp()
+            }
+        categories_collection.update_one(
+            {"_id": category["_id"], "file_count": {"$exists": False}},
+            {"$set": counters}
+        )
+        backfilled += 1
+    
+    if backfilled:
+        logger.info(f"Backfilled the counters of {backfilled} categories")
+    
+    return backfilled
+
 def import_from_json(json_file_path: str) -> bool:
     """Import data from a JSON file into MongoDB.
     
@@ -209,21 +997,11 @@ def import_from_json(json_file_path: str) -> bool:
         
         init_db()
         
-        # Process each user in the JSON
+        # Replace the stored categories of each user in the JSON
         for user_id, user_data in data.get("users", {}).items():
-            # Create a MongoDB document for this user
-            mongo_user = {
-                "_id": user_id,
-                "categories": user_data.get("categories", {})
-            }
-            
-            # Insert or update the user document
-            users_collection.replace_one(
-                {"_id": user_id},
-                mongo_user,
-                upsert=True
-            )
+            _replace_user_categories(user_id, user_data.get("categories", {}))
         
+        invalidate_user_cache()
         logger.info(f"Successfully imported data from {json_file_path}")
         return True
     except Exception as e:
@@ -243,16 +1021,18 @@ def export_to_json(json_file_path: str) -> bool:
     try:
         init_db()
         
-        # Fetch all users
-        all_users = list(users_collection.find({}))
-        
-        # Format into the expected structure
+        # Format into the expected structure, keeping categories in creation order
         export_data = {"users": {}}
-        for user in all_users:
-            user_id = user["_id"]
-            export_data["users"][user_id] = {
-                "categories": user.get("categories", {})
-            }
+        for category in categories_collection.find({}).sort("_id", ASCENDING):
+            user = export_data["users"].setdefault(category["user_id"], {"categories": {}})
+            user["categories"][category["name"]] = []
+        
+        # Stream files in index order and append them to their category
+        for file_doc in files_collection.find({}).sort(
+            [("user_id", ASCENDING), ("category", ASCENDING), ("seq", ASCENDING)]
+        ):
+            user = export_data["users"].setdefault(file_doc["user_id"], {"categories": {}})
+            user["categories"].setdefault(file_doc["category"], []).append(_to_file_info(file_doc))
         
         # Write to JSON file
         with open(json_file_path, 'w') as f:
@@ -264,10 +1044,79 @@ def export_to_json(json_file_path: str) -> bool:
         logger.error(f"Error exporting data to JSON: {e}")
         return False
 
+@_on_db_pool
+def get_session(user_id: int) -> Dict[str, Any]:
+    """Get the stored conversation state and user_data of a user.
+    
+    Args:
+        user_id: Telegram user ID
+        
+    Returns:
+        Dict with "user_data" and "conversations", empty for unknown users
+    """
+    init_db()
+    session = sessions_collection.find_one({"_id": str(user_id)}, {"_id": 0, "updated_at": 0})
+    return session or {}
+
+@_on_db_pool
+def save_session_user_data(user_id: int, user_data: Dict[str, Any]) -> None:
+    """Store the user_data of a user."""
+    init_db()
+    sessions_collection.update_one(
+        {"_id": str(user_id)},
+        {"$set": {"user_data": user_data, "updated_at": time.time()}},
+        upsert=True
+    )
+
+@_on_db_pool
+def save_session_conversation(user_id: int, name: str, key: str, state: Any) -> None:
+    """Store the state of one conversation of a user; a state of None ends it.
+    
+    Args:
+        user_id: Telegram user ID
+        name: Name of the ConversationHandler
+        key: Conversation key within that handler
+        state: New conversation state
+    """
+    init_db()
+    field = f"conversations.{name}.{key}"
+    if state is None:
+        update = {"$unset": {field: ""}, "$set": {"updated_at": time.time()}}
+    else:
+        update = {"$set": {field: state, "updated_at": time.time()}}
+    sessions_collection.update_one({"_id": str(user_id)}, update, upsert=True)
+
+def ping() -> bool:
+    """Check that MongoDB answers, bypassing the database pool.
+    
+    Uses the main client while it is open, and otherwise a single-connection
+    client of its own, so a process that hands all database work to others,
+    like the receiver of a sharded bot, can still report readiness.
+    
+    Returns:
+        bool: True if the server answered the ping, False otherwise
+    """
+    global _ping_client
+    client = mongo_client
+    if client is None:
+        if not MONGO_URI:
+            return False
+        if _ping_client is None:
+            _ping_client = MongoClient(MONGO_URI, maxPoolSize=1, serverSelectionTimeoutMS=5000)
+        client = _ping_client
+    
+    try:
+        client.admin.command('ping')
+        return True
+    except Exception as e:
+        logger.warning(f"MongoDB ping failed: {e}")
+        return False
+
 def close_connection():
-    """Close the MongoDB connection."""
+    """Flush buffered writes and close the MongoDB connection."""
     global mongo_client
     if mongo_client:
+        flush_pending_files()
         mongo_client.close()
         logger.info("MongoDB connection closed")
-        mongo_client = None 
\ No newline at end of file
+        mongo_client = None
@@ -0,0 +1,134 @@
+import os
+import time
+import logging
+import threading
+from typing import Any, Dict, Optional
+from telegram.error import BadRequest
+
+logger = logging.getLogger(__name__)
+
+# Minimum seconds between two edits of the same confirmation message
+CONFIRMATION_EDIT_INTERVAL = float(os.environ.get('CONFIRMATION_EDIT_INTERVAL', 2.0))
+
+class _EditState:
+    """Latest wanted and last shown text of one chat's tracked message."""
+    
+    def __init__(self, message_id: int):
+        self.message_id = message_id
+        self.bot = None
+        self.text: Optional[str] = None
+        self.kwargs: Dict[str, Any] = {}
+        self.sent_text: Optional[str] = None
+        self.last_sent = 0.0
+        self.timer: Optional[threading.Timer] = None
+        self.failed = False
+        self.send_lock = threading.Lock()
+
+class DebouncedMessageEditor:
+    """Coalesces frequent edits of a chat's status message into at most one per interval.
+    
+    The first change after a quiet period is edited right away; changes that
+    arrive within the interval only replace the pending text, and a trailing
+    edit at the end of the interval shows the latest one. A burst therefore
+    costs about one edit per interval and always ends with the final text.
+    """
+    
+    def __init__(self, interval: float = CONFIRMATION_EDIT_INTERVAL):
+        self.interval = interval
+        self._states: Dict[int, _EditState] = {}
+        self._lock = threading.Lock()
+    
+    def track(self, chat_id: int, message_id: int, text: str) -> None:
+        """Start tracking a message that was just sent with `text`."""
+        with self._lock:
+            self._drop(chat_id)
+            state = _EditState(message_id)
+            state.text = state.sent_text = text
+            state.last_sent = time.monotonic()
+            self._states[chat_id] = state
+    
+    def has_failed(self, chat_id: int, message_id: int) -> bool:
+        """Return True if the tracked message can no longer be edited."""
+        with self._lock:
+            state = self._states.get(chat_id)
+            return state is not None and state.message_id == message_id and state.failed
+    
+    def update(self, bot, chat_id: int, message_id: int, text: str, **kwargs) -> None:
+        """Ask for the message to show `text`, editing now or at the end of the interval."""
+        with self._lock:
+            state = self._states.get(chat_id)
+            if state is None or state.message_id != message_id:
+                self._drop(chat_id)
+                state = _EditState(message_id)
+                self._states[chat_id] = state
+            
+            state.bot = bot
+            state.text = text
+            state.kwargs = kwargs
+            if state.timer is not None:
+                return
+            
+            wait = state.last_sent + self.interval - time.monotonic()
+            if wait > 0:
+                state.timer = threading.Timer(wait, self._send, args=(chat_id, state))
+                state.timer.daemon = True
+                state.timer.start()
+                return
+        
+        self._send(chat_id, state)
+    
+    def flush(self, chat_id: int) -> None:
+        """Make the final edit for a chat now instead of waiting for the interval."""
+        with self._lock:
+            state = self._states.pop(chat_id, None)
+            if state is None:
+                return
+            if state.timer is not None:
+                state.timer.cancel()
+        
+        self._send(chat_id, state, final=True)
+    
+    def discard(self, chat_id: int) -> None:
+        """Forget a chat's message without editing it, e.g. once it shows another screen."""
+        with self._lock:
+            state = self._drop(chat_id)
+        
+        # Let an edit that is already in flight finish before the caller edits the message
+        if state is not None:
+            with state.send_lock:
+                pass
+    
+    def _drop(self, chat_id: int) -> Optional[_EditState]:
+        """Stop tracking a chat; the caller holds the lock."""
+        state = self._states.pop(chat_id, None)
+        if state is not None and state.timer is not None:
+            state.timer.cancel()
+        return state
+    
+    def _send(self, chat_id: int, state: _EditState, final: bool = False) -> None:
+        """Edit the message to the latest wanted text, if it is not shown already."""
+        with state.send_lock:
+            with self._lock:
+                state.timer = None
+                text, kwargs, bot = state.text, state.kwargs, state.bot
+                if not final and self._states.get(chat_id) is not state:
+                    return
+                if state.failed or bot is None or text == state.sent_text:
+                    return
+            
+            try:
+                bot.edit_message_text(chat_id=chat_id, message_id=state.message_id, text=text, **kwargs)
+                state.sent_text = text
+            except BadRequest as e:
+                if 'not modified' in str(e).lower():
+                    state.sent_text = text
+                else:
+                    logger.error(f"Error updating message {state.message_id} in chat {chat_id}: {e}")
+                    state.failed = True
+            except Exception as e:
+                logger.error(f"Error updating message {state.message_id} in chat {chat_id}: {e}")
+                state.failed = True
+            state.last_sent = time.monotonic()
+
+# Editor for the "N file(s) saved" confirmation of uploads
+confirmation_editor = DebouncedMessageEditor()
@@ -0,0 +1,222 @@
+import os
+import time
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+from telegram import InputMediaAudio, InputMediaDocument, InputMediaPhoto, InputMediaVideo
+from telegram.error import BadRequest
+
+import metrics
+from pools import TrackedExecutor
+
+logger = logging.getLogger(__name__)
+
+# Delivery settings; with a concurrency of 1 each chat gets its files strictly in order,
+# sent by the calling thread, and the pool is only used for higher concurrency
+DELIVERY_WORKERS = int(os.environ.get('DELIVERY_WORKERS', 16))
+DELIVERY_CONCURRENCY = max(1, int(os.environ.get('DELIVERY_CONCURRENCY', 1)))
+BROWSE_MEDIA_GROUPS = os.environ.get('BROWSE_MEDIA_GROUPS', 'true').lower() == 'true'
+BROWSE_BY_FILE_ID = os.environ.get('BROWSE_BY_FILE_ID', 'true').lower() == 'true'
+
+# Idle per-chat semaphores are dropped after this many seconds
+CHAT_SEMAPHORE_TTL = 600
+
+# Telegram accepts between 2 and 10 items per media group
+MEDIA_GROUP_SIZE = 10
+
+# Input media class for each groupable file type
+INPUT_MEDIA_TYPES = {
+    "photo": InputMediaPhoto,
+    "video": InputMediaVideo,
+    "document": InputMediaDocument,
+    "audio": InputMediaAudio,
+}
+
+# Bot method that sends each file type by its file_id
+SEND_METHODS = {
+    "photo": "send_photo",
+    "video": "send_video",
+    "document": "send_document",
+    "audio": "send_audio",
+    "voice": "send_voice",
+    "animation": "send_animation",
+}
+
+# File types that may share an album; documents and audio only group with themselves
+MEDIA_GROUP_KINDS = {
+    "photo": "visual",
+    "video": "visual",
+    "document": "document",
+    "audio": "audio",
+}
+
+# Shared pool that performs the Telegram round trips
+_executor = TrackedExecutor(max_workers=DELIVERY_WORKERS, thread_name_prefix="delivery")
+metrics.register_gauge(
+    "telegram_pool_queue_depth",
+    "Telegram delivery requests waiting or running in the delivery pool",
+    lambda: _executor.queue_depth
+)
+
+# Per-chat limits on requests in flight, shared by every page sent to that chat
+_chat_semaphores: Dict[int, threading.BoundedSemaphore] = {}
+_chat_last_used: Dict[int, float] = {}
+_chat_semaphores_lock = threading.Lock()
+
+def _get_chat_semaphore(chat_id: int) -> threading.BoundedSemaphore:
+    """Return the semaphore limiting concurrent requests to a chat."""
+    with _chat_semaphores_lock:
+        now = time.monotonic()
+        semaphore = _chat_semaphores.get(chat_id)
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(DELIVERY_CONCURRENCY)
+            _chat_semaphores[chat_id] = semaphore
+            _expire_semaphores(now)
+        _chat_last_used[chat_id] = now
+        return semaphore
+
+def _release_chat_semaphore(chat_id: int, semaphore: threading.BoundedSemaphore) -> None:
+    """Free a request slot of a chat, counting it as used until now."""
+    with _chat_semaphores_lock:
+        _chat_last_used[chat_id] = time.monotonic()
+    semaphore.release()
+
+def _expire_semaphores(now: float) -> None:
+    """Forget the semaphores of chats nothing was sent to for a while."""
+    for chat_id, last_used in list(_chat_last_used.items()):
+        if now - last_used > CHAT_SEMAPHORE_TTL:
+            del _chat_last_used[chat_id]
+            _chat_semaphores.pop(chat_id, None)
+
+def _group_kind(file_info: Dict[str, Any]) -> Optional[str]:
+    """Return the album kind of a file, or None if it must be copied on its own."""
+    if not file_info.get("file_id"):
+        return None
+    return MEDIA_GROUP_KINDS.get(file_info.get("file_type"))
+
+def plan_batches(items: List[Tuple[Dict[str, Any], str]]) -> List[List[int]]:
+    """Split a page into consecutive runs that can be sent as one request.
+    
+    Only neighbouring files of a compatible kind are grouped, so sending the
+    batches in order keeps the files in page order.
+    
+    Returns:
+        List of batches, each a list of indexes into `items`
+    """
+    batches = []
+    current = []
+    current_kind = None
+    
+    for index, (file_info, _) in enumerate(items):
+        kind = _group_kind(file_info) if BROWSE_MEDIA_GROUPS else None
+        if kind is None or kind != current_kind or len(current) >= MEDIA_GROUP_SIZE:
+            if current:
+                batches.append(current)
+            current = []
+        current.append(index)
+        current_kind = kind
+    
+    if current:
+        batches.append(current)
+    
+    return batches
+
+def _copy_one(bot, chat_id: int, from_chat_id, file_info: Dict[str, Any], caption: str) -> Optional[Exception]:
+    """Copy a single stored message to the chat."""
+    try:
+        bot.copy_message(
+            chat_id=chat_id,
+            from_chat_id=from_chat_id,
+            message_id=file_info["message_id"],
+            caption=caption
+        )
+        return None
+    except Exception as e:
+        logger.error(f"Error copying message to chat {chat_id}: {e}")
+        return e
+
+def _send_one(bot, chat_id: int, from_chat_id, file_info: Dict[str, Any], caption: str) -> Optional[Exception]:
+    """Send a single file by its file_id, or copy it from the storage channel."""
+    method = SEND_METHODS.get(file_info.get("file_type"))
+    if BROWSE_BY_FILE_ID and method and file_info.get("file_id"):
+        try:
+            getattr(bot, method)(chat_id, file_info["file_id"], caption=caption)
+            return None
+        except BadRequest as e:
+            # The file_id is no longer accepted; the channel still holds the message
+            logger.warning(f"Sending file by file_id to chat {chat_id} failed, copying it instead: {e}")
+    
+    return _copy_one(bot, chat_id, from_chat_id, file_info, caption)
+
+def _send_batch(bot, chat_id: int, from_chat_id, batch: List[Tuple[Dict[str, Any], str]]) -> List[Optional[Exception]]:
+    """Send one batch as a media group, or file by file if that is not possible."""
+    if len(batch) > 1:
+        media = [
+            INPUT_MEDIA_TYPES[file_info["file_type"]](media=file_info["file_id"], caption=caption)
+            for file_info, caption in batch
+        ]
+        try:
+            bot.send_media_group(chat_id=chat_id, media=media)
+            return [None] * len(batch)
+        except Exception as e:
+            logger.warning(f"Media group to chat {chat_id} failed, sending files one by one: {e}")
+    
+    return [_send_one(bot, chat_id, from_chat_id, file_info, caption) for file_info, caption in batch]
+
+def deliver_files(bot, chat_id: int, from_chat_id, items: List[Tuple[Dict[str, Any], str]]) -> List[Optional[Exception]]:
+    """Send stored files to a chat concurrently and wait for all of them.
+    
+    Args:
+        bot: The Telegram bot used to send the files
+        chat_id: Chat receiving the files
+        from_chat_id: Storage channel holding the original messages
+        items: (file_info, caption) pairs in the order they should be sent
+    
+    Photos, videos, documents and audio with a known file_id are sent as
+    albums of up to MEDIA_GROUP_SIZE items and other files with a file_id
+    are sent by it; files without one, or whose file_id Telegram rejects,
+    are copied from the storage channel.
+    
+    With the default DELIVERY_CONCURRENCY of 1 the batches are sent one
+    after another on the calling thread, so the chat shows the files in page
+    order; deliveries to different chats overlap because they run in
+    different background lanes. Higher limits hand the batches to the shared
+    pool, at most DELIVERY_CONCURRENCY in flight per chat, which is faster
+    but may reorder files.
+    
+    Returns:
+        List with None for every delivered item or the exception it failed with
+    """
+    semaphore = _get_chat_semaphore(chat_id)
+    batches = plan_batches(items)
+    
+    if DELIVERY_CONCURRENCY == 1:
+        # Each batch has to wait for the previous one anyway, so a pool thread would only add a hop
+        errors = []
+        semaphore.acquire()
+        try:
+            for batch in batches:
+                errors.extend(_send_batch(bot, chat_id, from_chat_id, [items[index] for index in batch]))
+        finally:
+            _release_chat_semaphore(chat_id, semaphore)
+        return errors
+    
+    futures = []
+    for batch in batches:
+        # Block the calling handler, not a pool worker, until a slot is free
+        semaphore.acquire()
+        try:
+            future = _executor.submit(
+                _send_batch, bot, chat_id, from_chat_id, [items[index] for index in batch]
+            )
+        except Exception:
+            _release_chat_semaphore(chat_id, semaphore)
+            raise
+        future.add_done_callback(lambda _: _release_chat_semaphore(chat_id, semaphore))
+        futures.append(future)
+    
+    errors = []
+    for future in futures:
+        errors.extend(future.result())
+    
+    return errors
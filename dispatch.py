@@ -0,0 +1,147 @@
+import os
+import logging
+import threading
+from typing import Any, Callable, Dict, List
+from telegram import Update
+from telegram.ext import Dispatcher
+
+import metrics
+import tracing
+from instrumentation import timed_callback
+from persistence import MongoPersistence
+from pools import KeyedExecutor
+
+logger = logging.getLogger(__name__)
+
+# Number of parallel update lanes
+DISPATCH_LANES = max(1, int(os.environ.get('DISPATCH_LANES', 8)))
+
+# Updates that may wait on the lanes before the dispatcher stops taking more
+DISPATCH_BACKLOG = max(1, int(os.environ.get('DISPATCH_BACKLOG', 1000)))
+
+# Number of lanes for slow work handed off by handlers (page delivery, saving files)
+BACKGROUND_LANES = max(1, int(os.environ.get('BACKGROUND_LANES', 8)))
+
+# Slow handler work runs here, in order per user, so it does not hold up the update lanes
+background = KeyedExecutor(BACKGROUND_LANES, "background")
+metrics.register_gauge(
+    "background_queue_depth",
+    "Handler tasks waiting or running on the background lanes",
+    lambda: background.queue_depth
+)
+
+def run_in_background(key: Any, fn, *args, **kwargs):
+    """Run slow handler work on the background lane of `key`, timing it and logging any error."""
+    fn = timed_callback(fn)
+    
+    def task():
+        try:
+            fn(*args, **kwargs)
+        except Exception:
+            logger.exception(f"Error in background task {getattr(fn, '__name__', fn)}")
+    
+    return background.submit(key, task)
+
+def update_shard_key(update: Any) -> int:
+    """Return the id that decides which lane handles an update.
+    
+    Updates of the same user always map to the same key, so routing by this
+    key keeps every user's updates in order.
+    """
+    if isinstance(update, Update):
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+    return 0
+
+def shard_key_from_json(data: Dict[str, Any]) -> int:
+    """Return update_shard_key() of a raw update without building an Update from it.
+    
+    Cheap enough to run for every incoming update in the process that
+    distributes them; the payload of each update type carries the user as
+    "from" (or "user" for poll answers) and the chat as "chat".
+    """
+    for payload in data.values():
+        if not isinstance(payload, dict):
+            continue
+        user = payload.get('from') or payload.get('user')
+        if user:
+            return user['id']
+        chat = payload.get('chat') or (payload.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+    return 0
+
+class ConcurrentDispatcher(Dispatcher):
+    """Dispatcher that handles updates of different users in parallel.
+    
+    The stock dispatcher processes one update at a time, so a slow handler
+    (a page of copies, a burst of saves) makes every other user wait. Here
+    each update is handed to one of DISPATCH_LANES single-threaded lanes by
+    user id: a user's updates are still processed strictly in order, which
+    ConversationHandler and user_data rely on, while the Telegram and MongoDB
+    round trips of different users overlap.
+    """
+    
+    def __init__(self, *args, lanes: int = DISPATCH_LANES, backlog: int = DISPATCH_BACKLOG, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lanes = KeyedExecutor(lanes, "lane")
+        self._backlog = threading.BoundedSemaphore(backlog)
+        # Called on stop() once the lanes are drained, before the background
+        # lanes shut down, to hand over work still held back in memory
+        self.drain_hooks: List[Callable[[], None]] = []
+        metrics.register_gauge(
+            "dispatch_queue_depth",
+            "Updates waiting or being processed on the dispatch lanes",
+            lambda: self.lanes.queue_depth
+        )
+    
+    def _process_in_lane(self, update: Any) -> None:
+        """Process an update on its lane thread under a new trace, logging anything that escapes."""
+        with tracing.trace(update_id=getattr(update, 'update_id', None), user=update_shard_key(update)):
+            try:
+                # Pick up state another bot process may have stored for this user
+                if isinstance(self.persistence, MongoPersistence):
+                    self.persistence.load_session(update, self.user_data)
+                Dispatcher.process_update(self, update)
+            except Exception:
+                logger.exception("Unhandled error while processing an update")
+    
+    def update_persistence(self, update: Any = None) -> None:
+        """Store the state an update changed, without the dispatcher-wide lock.
+        
+        A user's updates never run concurrently, so storing the state of one
+        update needs no lock; the stock lock would make every lane wait on the
+        MongoDB writes of the others. Storing everything still takes it.
+        """
+        if update is None:
+            super().update_persistence()
+        else:
+            self._Dispatcher__update_persistence(update)
+    
+    def process_update(self, update: Any) -> None:
+        """Queue an update on the lane of its user.
+        
+        Blocks while DISPATCH_BACKLOG updates are already waiting, so that a
+        burst backs up into whatever feeds the dispatcher (the polling queue,
+        the webhook ingest queue) instead of into unbounded lane queues.
+        """
+        self._backlog.acquire()
+        try:
+            future = self.lanes.submit(update_shard_key(update), self._process_in_lane, update)
+        except Exception:
+            self._backlog.release()
+            raise
+        future.add_done_callback(lambda _: self._backlog.release())
+    
+    def stop(self) -> None:
+        """Stop taking updates, then let the lanes, the drain hooks and background work drain."""
+        super().stop()
+        self.lanes.shutdown(wait=True)
+        for hook in self.drain_hooks:
+            try:
+                hook()
+            except Exception:
+                logger.exception(f"Error in drain hook {getattr(hook, '__name__', hook)}")
+        background.shutdown(wait=True)
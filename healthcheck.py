@@ -1,84 +1,146 @@
 import os
-import http.server
-import socketserver
-import threading
 import json
+import time
+import logging
+import platform
 import datetime
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict
+
+import database as db
+import metrics
+
+logger = logging.getLogger(__name__)
 
 # Define port for health check server
 # Use a different port than the webhook server to avoid conflicts
 HEALTH_PORT = int(os.environ.get("HEALTH_PORT", 8080))
 
-class HealthCheckHandler(http.server.SimpleHTTPRequestHandler):
+# Seconds between the MongoDB pings behind /ready
+READY_CHECK_INTERVAL = float(os.environ.get('READY_CHECK_INTERVAL', 10))
+
+# Facts about the environment that do not change while the bot runs
+STATIC_INFO = {
+    "python_version": f"Python {platform.python_version()}",
+    "system": os.name,
+    "render": os.environ.get('RENDER', 'false'),
+    "render_url": os.environ.get('RENDER_EXTERNAL_URL', 'not set'),
+    "port": os.environ.get('PORT', '10000'),
+    "health_port": HEALTH_PORT
+}
+
+class ReadinessCheck:
+    """Pings MongoDB on a background thread so that probes only read the last result.
+    
+    The bot counts as ready while the latest ping succeeded and is no older
+    than three intervals, so a hung ping also turns readiness off.
+    """
+    
+    def __init__(self, interval: float = READY_CHECK_INTERVAL):
+        self.interval = interval
+        self._ok = False
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._thread = None
+    
+    def start(self) -> None:
+        """Start pinging, once."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="readiness_check", daemon=True)
+            self._thread.start()
+    
+    def _run(self) -> None:
+        while True:
+            ok = db.ping()
+            with self._lock:
+                self._ok = ok
+                self._checked_at = time.monotonic()
+            time.sleep(self.interval)
+    
+    @property
+    def ready(self) -> bool:
+        """True if MongoDB answered the latest, recent enough ping."""
+        with self._lock:
+            return self._ok and time.monotonic() - self._checked_at < 3 * self.interval
+    
+    def status(self) -> Dict[str, Any]:
+        """Readiness details for the /health page."""
+        with self._lock:
+            age = time.monotonic() - self._checked_at if self._checked_at else None
+        return {"ready": self.ready, "mongo_ping_age_seconds": age}
+
+# MongoDB readiness shared by all requests
+readiness = ReadinessCheck()
+
+class HealthCheckHandler(BaseHTTPRequestHandler):
+    """Serves probes and metrics; no request waits on MongoDB or on other requests."""
+    
     def do_GET(self):
-        # Very simple ping endpoint for basic testing
-        if self.path == '/ping':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(b'pong')
-            print("Ping request received and responded with pong")
-            return
-            
-        # Check if this is the root path or a specific path
-        if self.path == '/' or self.path == '/health':
-            # Basic health check
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            
-            # Gather system information
+        path = self.path.split('?', 1)[0]
+        
+        # Liveness: the process is up and serving; /ping is what Render probes
+        if path == '/ping':
+            self._reply(200, 'text/plain', b'pong')
+        elif path == '/live':
+            self._reply(200, 'text/plain', b'ok')
+        
+        # Readiness: MongoDB answered recently
+        elif path == '/ready':
+            if readiness.ready:
+                self._reply(200, 'text/plain', b'ready')
+            else:
+                self._reply(503, 'text/plain', b'not ready')
+        
+        elif path == '/metrics':
+            self._reply(200, 'text/plain; version=0.0.4; charset=utf-8', metrics.render_prometheus().encode())
+        
+        elif path == '/' or path == '/health':
             health_data = {
                 "status": "healthy",
                 "timestamp": datetime.datetime.now().isoformat(),
-                "environment": {
-                    "python_version": os.popen('python --version').read().strip(),
-                    "system": os.name,
-                    "render": os.environ.get('RENDER', 'false'),
-                    "render_url": os.environ.get('RENDER_EXTERNAL_URL', 'not set'),
-                    "port": os.environ.get('PORT', '10000'),
-                    "health_port": HEALTH_PORT
-                },
-                "message": "Bot health check endpoint is working"
+                "environment": STATIC_INFO,
+                "readiness": readiness.status(),
+                "message": "Bot health check endpoint is working",
+                "metrics": metrics.collect()
             }
-            
-            print(f"Health check requested, responding with: {json.dumps(health_data)[:100]}...")
-            self.wfile.write(json.dumps(health_data, indent=2).encode())
-        else:
-            # Handle other paths with a simple 404
-            self.send_response(404)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(b'Not found')
+            self._reply(200, 'application/json', json.dumps(health_data, indent=2).encode())
         
+        else:
+            self._reply(404, 'text/plain', b'Not found')
+    
+    def _reply(self, status: int, content_type: str, body: bytes) -> None:
+        """Send a complete response."""
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
     def log_message(self, format, *args):
-        # Log all requests to help with debugging
-        print(f"Health server: {args[0]} - {args[1]}")
+        logger.debug(f"Health server: {format % args}")
 
-def start_health_server():
+def run_health_server():
+    """Serve the health endpoints on HEALTH_PORT from a background thread."""
     try:
-        with socketserver.TCPServer(("", HEALTH_PORT), HealthCheckHandler) as httpd:
-            print(f"Health check server started at port {HEALTH_PORT}")
-            print(f"Health check URL: http://localhost:{HEALTH_PORT}/health")
-            print(f"Ping URL: http://localhost:{HEALTH_PORT}/ping")
-            httpd.serve_forever()
+        server = ThreadingHTTPServer(("", HEALTH_PORT), HealthCheckHandler)
     except Exception as e:
-        print(f"Error starting health server: {e}")
-
-def run_health_server():
-    # Start server in a separate thread
-    server_thread = threading.Thread(target=start_health_server)
-    server_thread.daemon = True  # Daemon thread will shut down with the main program
-    server_thread.start()
-    print(f"Health check thread started on port {HEALTH_PORT}")
+        logger.error(f"Error starting health server: {e}")
+        return
+    
+    # Each request gets its own thread, so a slow client cannot hold up Render's probe
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="health_server", daemon=True).start()
+    readiness.start()
+    logger.info(f"Health check server started on port {HEALTH_PORT} (/ping, /live, /ready, /health, /metrics)")
 
 if __name__ == "__main__":
     # For testing the health server directly
+    logging.basicConfig(level=logging.INFO)
     run_health_server()
     
     # Keep main thread alive for testing
     try:
-        while True:
-            pass
+        threading.Event().wait()
     except KeyboardInterrupt:
-        print("Health check server stopped") 
\ No newline at end of file
+        logger.info("Health check server stopped")
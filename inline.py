@@ -0,0 +1,116 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from telegram import (
+    InlineQueryResultCachedAudio, InlineQueryResultCachedDocument, InlineQueryResultCachedMpeg4Gif,
+    InlineQueryResultCachedPhoto, InlineQueryResultCachedVideo, InlineQueryResultCachedVoice
+)
+
+import metrics
+
+# Seconds a page of inline results is reused, by this process and by Telegram
+INLINE_CACHE_TTL = int(os.environ.get('INLINE_CACHE_TTL', 30))
+
+# Telegram shows at most 50 results per inline query answer
+INLINE_PAGE_SIZE = 50
+
+# Most result pages kept in memory per user and users kept in the cache
+INLINE_CACHE_PAGES_PER_USER = 20
+INLINE_CACHE_USERS = 1000
+
+class InlineResultCache:
+    """Short-lived per-user cache of inline query result pages.
+    
+    Typing `@bot query` sends a new inline query for nearly every keystroke
+    and scrolling asks for the following pages, so the same few pages are
+    requested again and again within seconds. Entries expire after `ttl`
+    seconds; a user's files saved meanwhile show up once the entry expires
+    or the user's entries are invalidated.
+    """
+    
+    def __init__(self, ttl: float = INLINE_CACHE_TTL):
+        self.ttl = ttl
+        self.lookups = metrics.counter("inline_cache_lookups_total", "Inline result cache lookups, by result: hit or miss")
+        self._users: "OrderedDict[int, OrderedDict[Tuple[str, int], Tuple[float, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, user_id: int, query: str, offset: int) -> Optional[Any]:
+        """Return a cached page, or None if missing or expired."""
+        with self._lock:
+            pages = self._users.get(user_id)
+            entry = pages.get((query, offset)) if pages is not None else None
+            if entry is not None:
+                expires_at, page = entry
+                if expires_at > time.monotonic():
+                    self._users.move_to_end(user_id)
+                    self.lookups.inc(result="hit")
+                    return page
+                del pages[(query, offset)]
+            self.lookups.inc(result="miss")
+            return None
+    
+    def put(self, user_id: int, query: str, offset: int, page: Any) -> None:
+        """Store a page, evicting the oldest pages and users beyond the limits."""
+        with self._lock:
+            pages = self._users.get(user_id)
+            if pages is None:
+                pages = self._users[user_id] = OrderedDict()
+            pages[(query, offset)] = (time.monotonic() + self.ttl, page)
+            pages.move_to_end((query, offset))
+            self._users.move_to_end(user_id)
+            
+            while len(pages) > INLINE_CACHE_PAGES_PER_USER:
+                pages.popitem(last=False)
+            while len(self._users) > INLINE_CACHE_USERS:
+                self._users.popitem(last=False)
+    
+    def invalidate(self, user_id: int) -> None:
+        """Forget a user's pages, e.g. after their files changed."""
+        with self._lock:
+            self._users.pop(user_id, None)
+
+def build_result(result_id: str, file_info: Dict[str, Any], caption: Optional[str] = None):
+    """Return the cached inline result that sends a stored file by its file_id.
+    
+    Returns None for files stored before file_ids were kept; those can only
+    be copied from the storage channel, which inline results cannot do.
+    """
+    file_id = file_info.get("file_id")
+    if not file_id:
+        return None
+    
+    file_type = file_info["file_type"]
+    title = file_info.get("file_name") or file_type.capitalize()
+    
+    if file_type == "photo":
+        return InlineQueryResultCachedPhoto(result_id, file_id, title=title, caption=caption)
+    if file_type == "video":
+        return InlineQueryResultCachedVideo(result_id, file_id, title, caption=caption)
+    if file_type == "document":
+        return InlineQueryResultCachedDocument(result_id, title, file_id, caption=caption)
+    if file_type == "audio":
+        return InlineQueryResultCachedAudio(result_id, file_id, caption=caption)
+    if file_type == "voice":
+        return InlineQueryResultCachedVoice(result_id, file_id, title, caption=caption)
+    if file_type == "animation":
+        return InlineQueryResultCachedMpeg4Gif(result_id, file_id, title=title, caption=caption)
+    return None
+
+def build_results(files: List[Dict[str, Any]], offset: int) -> List[Any]:
+    """Return the inline results of one page of files.
+    
+    Result ids only need to be unique within one answer, and the same
+    channel message may back files of several categories, so the position
+    in the result list is used.
+    """
+    results = []
+    for i, file_info in enumerate(files):
+        result = build_result(str(offset + i), file_info)
+        if result is not None:
+            results.append(result)
+    return results
+
+# Result pages shared by every inline query handled in this process
+result_cache = InlineResultCache()
@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import logging
+import functools
+from typing import Any, Callable, Dict, Optional
+from pymongo import monitoring
+from telegram.ext import ConversationHandler
+
+import metrics
+import tracing
+from callbacks import CallbackRouter
+
+logger = logging.getLogger(__name__)
+
+# Seconds between metric snapshots written to the log; 0 turns the export off
+METRICS_EXPORT_INTERVAL = float(os.environ.get('METRICS_EXPORT_INTERVAL', 0))
+
+handler_latency = metrics.histogram("handler_latency_seconds", "Time spent in update handlers and background tasks, by handler")
+handler_errors = metrics.counter("handler_errors_total", "Update handlers and background tasks that raised, by handler")
+mongo_latency = metrics.histogram("mongo_command_latency_seconds", "MongoDB command round trips, by command and collection")
+mongo_errors = metrics.counter("mongo_command_errors_total", "Failed MongoDB commands, by command and collection")
+
+def timed_callback(callback: Callable, name: Optional[str] = None) -> Callable:
+    """Wrap a handler callback so that its latency and errors are recorded under `name`, and traced.
+    
+    Callbacks that are already wrapped are returned as they are, so shared
+    callbacks are only timed once.
+    """
+    if getattr(callback, '__timed__', False):
+        return callback
+    name = name or getattr(callback, '__name__', repr(callback))
+    
+    @functools.wraps(callback)
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        error = None
+        try:
+            return callback(*args, **kwargs)
+        except Exception as e:
+            error = type(e).__name__
+            handler_errors.inc(handler=name)
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            handler_latency.observe(duration, handler=name)
+            tracing.record("handler", name, duration, error)
+    
+    timed.__timed__ = True
+    return timed
+
+def _instrument_handler(handler) -> None:
+    """Time the callbacks of one handler, looking inside conversations and routers."""
+    if isinstance(handler, ConversationHandler):
+        for inner in handler.entry_points + handler.fallbacks:
+            _instrument_handler(inner)
+        for state_handlers in handler.states.values():
+            for inner in state_handlers:
+                _instrument_handler(inner)
+        return
+    
+    if isinstance(handler, CallbackRouter):
+        for action, callback in handler.routes.items():
+            handler.routes[action] = timed_callback(callback)
+        if handler.default is not None:
+            handler.default = timed_callback(handler.default)
+    
+    if getattr(handler, 'callback', None) is not None:
+        handler.callback = timed_callback(handler.callback)
+
+def instrument_handlers(dispatcher) -> None:
+    """Record the latency of every handler callback added to the dispatcher so far."""
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            _instrument_handler(handler)
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """pymongo command listener that records the round trip of every MongoDB command.
+    
+    Pass it to MongoClient(event_listeners=...). pymongo calls it on the thread
+    that ran the command, so the command is also traced under the update that
+    issued it. Only the started event names the collection, so it is
+    remembered until the command completes.
+    """
+    
+    def __init__(self):
+        self._collections: Dict[Any, str] = {}
+    
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        target = event.command.get(event.command_name)
+        if not isinstance(target, str):
+            # getMore names its cursor first and the collection after it
+            target = event.command.get('collection', '')
+        self._collections[(event.connection_id, event.request_id)] = target
+    
+    def _collection(self, event) -> str:
+        return self._collections.pop((event.connection_id, event.request_id), '')
+    
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        collection = self._collection(event)
+        duration = event.duration_micros / 1e6
+        mongo_latency.observe(duration, command=event.command_name, collection=collection)
+        tracing.record("mongo", event.command_name, duration, collection=collection)
+    
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        collection = self._collection(event)
+        duration = event.duration_micros / 1e6
+        mongo_latency.observe(duration, command=event.command_name, collection=collection)
+        mongo_errors.inc(command=event.command_name, collection=collection)
+        tracing.record("mongo", event.command_name, duration, event.failure.get('codeName', 'CommandFailed'), collection=collection)
+
+def log_snapshot(snapshot: Dict[str, Any]) -> None:
+    """Exporter that writes a metrics snapshot to the log as one JSON line."""
+    logger.info(f"metrics {json.dumps(snapshot, sort_keys=True)}")
+
+def start_metrics_export() -> None:
+    """Log a metrics snapshot every METRICS_EXPORT_INTERVAL seconds, if set.
+    
+    Other exporters can be added with metrics.add_exporter(); they run on
+    the same thread and interval.
+    """
+    if METRICS_EXPORT_INTERVAL > 0:
+        metrics.add_exporter(log_snapshot)
+        metrics.start_export_thread(METRICS_EXPORT_INTERVAL)
@@ -0,0 +1,82 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, List, Tuple
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import callbacks
+import metrics
+
+# Category buttons shown on one page of a category keyboard
+CATEGORY_PAGE_SIZE = max(1, int(os.environ.get('CATEGORY_PAGE_SIZE', 20)))
+
+# Most keyboards kept in memory
+KEYBOARD_CACHE_SIZE = 2048
+
+def build_category_keyboard(items: List[Tuple[str, int]], select_action: str, list_action: str, page: int,
+                            footer: List[List[InlineKeyboardButton]]) -> InlineKeyboardMarkup:
+    """Build one page of a keyboard with a button per category.
+    
+    Args:
+        items: (label, cid) pairs of every category, in display order
+        select_action: Callback action of the category buttons, with the cid as argument
+        list_action: Callback action of the page buttons, with the page as argument
+        page: Page to show, starting at 1; out of range pages show the nearest one
+        footer: Rows of buttons added below the page controls
+    """
+    total_pages = max(1, (len(items) + CATEGORY_PAGE_SIZE - 1) // CATEGORY_PAGE_SIZE)
+    page = max(1, min(page, total_pages))
+    start = (page - 1) * CATEGORY_PAGE_SIZE
+    
+    buttons = [
+        [InlineKeyboardButton(label, callback_data=callbacks.encode(select_action, cid))]
+        for label, cid in items[start:start + CATEGORY_PAGE_SIZE]
+    ]
+    
+    if total_pages > 1:
+        pag_buttons = []
+        if page > 1:
+            pag_buttons.append(InlineKeyboardButton("« Prev", callback_data=callbacks.encode(list_action, page - 1)))
+        pag_buttons.append(InlineKeyboardButton(f"{page}/{total_pages}", callback_data='ignore'))
+        if page < total_pages:
+            pag_buttons.append(InlineKeyboardButton("Next »", callback_data=callbacks.encode(list_action, page + 1)))
+        buttons.append(pag_buttons)
+    
+    buttons.extend(footer)
+    return InlineKeyboardMarkup(buttons)
+
+class KeyboardCache:
+    """LRU cache of built keyboards, keyed on everything they were built from.
+    
+    Keys carry the user's category list version (see
+    database.get_category_list), so an entry is reused until the user
+    creates or deletes a category; entries of older versions are never
+    looked up again and age out of the LRU.
+    """
+    
+    def __init__(self, size: int = KEYBOARD_CACHE_SIZE):
+        self.size = size
+        self.lookups = metrics.counter("keyboard_cache_lookups_total", "Category keyboard cache lookups, by result: hit or miss")
+        self._keyboards: "OrderedDict[Hashable, InlineKeyboardMarkup]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get_or_build(self, key: Hashable, build: Callable[[], InlineKeyboardMarkup]) -> InlineKeyboardMarkup:
+        """Return the keyboard cached under `key`, building and storing it if missing."""
+        with self._lock:
+            keyboard = self._keyboards.get(key)
+            if keyboard is not None:
+                self._keyboards.move_to_end(key)
+                self.lookups.inc(result="hit")
+                return keyboard
+            self.lookups.inc(result="miss")
+        
+        keyboard = build()
+        with self._lock:
+            self._keyboards[key] = keyboard
+            self._keyboards.move_to_end(key)
+            while len(self._keyboards) > self.size:
+                self._keyboards.popitem(last=False)
+        return keyboard
+
+# Category keyboards shared by every handler of this process
+keyboard_cache = KeyboardCache()
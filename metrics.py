@@ -0,0 +1,274 @@
+import bisect
+import math
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Label values of one series, as sorted (name, value) pairs
+Labels = Tuple[Tuple[str, str], ...]
+
+# Upper bounds, in seconds, of the buckets of latency histograms
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Registered gauges: name -> (description, callback returning the current value)
+_gauges: Dict[str, Tuple[str, Callable[[], float]]] = {}
+_gauges_lock = threading.Lock()
+
+# Counters and histograms by name
+_counters: Dict[str, "Counter"] = {}
+_histograms: Dict[str, "Histogram"] = {}
+_registry_lock = threading.Lock()
+
+# One metric as (name, type, description, samples); samples are (sample name, labels, value),
+# e.g. a histogram's _bucket, _sum and _count lines
+Family = Tuple[str, str, str, List[Tuple[str, Labels, float]]]
+
+# Metrics reported by other processes, such as shard workers: source -> (labels added, families)
+_remote: Dict[str, Tuple[Labels, List[Family]]] = {}
+
+# Functions handed a snapshot() of every metric by the export thread
+_exporters: List[Callable[[Dict[str, Any]], None]] = []
+_export_thread = None
+
+def _label_key(labels: Dict[str, str]) -> Labels:
+    """Turn keyword labels into the key of a series."""
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+class Counter:
+    """Count that only goes up, kept separately for every combination of labels."""
+    
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Add `amount` to the series of the given labels."""
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+    
+    def value(self, **labels: str) -> float:
+        """Current value of the series of the given labels."""
+        with self._lock:
+            return self._values.get(_label_key(labels), 0.0)
+    
+    def samples(self) -> List[Tuple[Labels, float]]:
+        """Every series with its current value."""
+        with self._lock:
+            return list(self._values.items())
+
+class Histogram:
+    """Distribution of observed values, such as latencies, in fixed buckets per combination of labels."""
+    
+    def __init__(self, name: str, description: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        # Per series: count of each bucket (the last one is +Inf), then the sum
+        self._series: Dict[Labels, List[float]] = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, value: float, **labels: str) -> None:
+        """Record one value in the series of the given labels."""
+        key = _label_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0.0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+    
+    def samples(self) -> List[Tuple[Labels, List[float], float]]:
+        """Every series as (labels, cumulative bucket counts ending with +Inf, sum)."""
+        with self._lock:
+            series = [(key, list(values)) for key, values in self._series.items()]
+        
+        samples = []
+        for key, values in series:
+            cumulative = []
+            total = 0.0
+            for count in values[:-1]:
+                total += count
+                cumulative.append(total)
+            samples.append((key, cumulative, values[-1]))
+        return samples
+
+def register_gauge(name: str, description: str, callback: Callable[[], float]) -> None:
+    """Register a gauge whose value is read from `callback` on every collection."""
+    with _gauges_lock:
+        _gauges[name] = (description, callback)
+
+def counter(name: str, description: str) -> Counter:
+    """Return the counter with the given name, creating it on first use."""
+    with _registry_lock:
+        if name not in _counters:
+            _counters[name] = Counter(name, description)
+        return _counters[name]
+
+def histogram(name: str, description: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    """Return the histogram with the given name, creating it on first use."""
+    with _registry_lock:
+        if name not in _histograms:
+            _histograms[name] = Histogram(name, description, buckets)
+        return _histograms[name]
+
+def collect() -> Dict[str, float]:
+    """Read the current value of every registered gauge."""
+    with _gauges_lock:
+        gauges = list(_gauges.items())
+    
+    values = {}
+    for name, (_, callback) in gauges:
+        try:
+            values[name] = float(callback())
+        except Exception:
+            values[name] = float('nan')
+    return values
+
+def _format_value(value: float) -> str:
+    """Format a sample value for the Prometheus text format."""
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+def _format_labels(labels: Labels) -> str:
+    """Format a label set for the Prometheus text format, e.g. {method="sendMessage"}."""
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels:
+        value = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+def families() -> List[Family]:
+    """Return every gauge, counter and histogram of this process as plain, picklable data."""
+    result = []
+    
+    for name, value in sorted(collect().items()):
+        with _gauges_lock:
+            description = _gauges[name][0]
+        result.append((name, "gauge", description, [(name, (), value)]))
+    
+    with _registry_lock:
+        counters = sorted(_counters.values(), key=lambda metric: metric.name)
+        histograms = sorted(_histograms.values(), key=lambda metric: metric.name)
+    
+    for metric in counters:
+        samples = [(metric.name, labels, value) for labels, value in sorted(metric.samples())]
+        result.append((metric.name, "counter", metric.description, samples))
+    
+    for metric in histograms:
+        samples = []
+        for labels, cumulative, total in sorted(metric.samples()):
+            bounds = [_format_value(bound) for bound in metric.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, cumulative):
+                samples.append((f"{metric.name}_bucket", labels + (('le', bound),), count))
+            samples.append((f"{metric.name}_sum", labels, total))
+            samples.append((f"{metric.name}_count", labels, cumulative[-1]))
+        result.append((metric.name, "histogram", metric.description, samples))
+    
+    return result
+
+def report_remote(source: str, labels: Dict[str, str], remote_families: List[Family]) -> None:
+    """Include the families() of another process in render_prometheus(), replacing its previous report.
+    
+    Args:
+        source: Name of the reporting process
+        labels: Labels added to each of its series, e.g. {"shard": "0"}
+        remote_families: What families() returned in that process
+    """
+    with _registry_lock:
+        _remote[source] = (_label_key(labels), remote_families)
+
+def render_prometheus() -> str:
+    """Render every metric in the Prometheus text exposition format.
+    
+    Metrics reported by other processes are merged into the families of the
+    same name, their series told apart by the labels they were reported with.
+    """
+    merged: Dict[str, Family] = {}
+    order = []
+    
+    with _registry_lock:
+        remote = [_remote[source] for source in sorted(_remote)]
+    
+    for extra_labels, source_families in [((), families())] + remote:
+        for name, kind, description, samples in source_families:
+            if name not in merged:
+                merged[name] = (name, kind, description, [])
+                order.append(name)
+            merged[name][3].extend((sample, extra_labels + labels, value) for sample, labels, value in samples)
+    
+    lines = []
+    for name in order:
+        _, kind, description, samples = merged[name]
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for sample, labels, value in samples:
+            lines.append(f"{sample}{_format_labels(labels)} {_format_value(value)}")
+    
+    return "\n".join(lines) + "\n"
+
+def _format_key(labels: Labels) -> str:
+    """Format a label set as the key of a snapshot series, e.g. method=sendMessage."""
+    return ",".join(f"{name}={value}" for name, value in labels)
+
+def snapshot() -> Dict[str, Any]:
+    """Return the current value of every metric as plain data.
+    
+    Counters map each label set to its value; histograms map it to the
+    count, the sum and the cumulative count of every bucket bound.
+    """
+    with _registry_lock:
+        counters = list(_counters.values())
+        histograms = list(_histograms.values())
+    
+    data = {"time": time.time(), "gauges": collect(), "counters": {}, "histograms": {}}
+    for metric in counters:
+        data["counters"][metric.name] = {_format_key(labels): value for labels, value in metric.samples()}
+    for metric in histograms:
+        bounds = [str(bound) for bound in metric.buckets] + ["+Inf"]
+        data["histograms"][metric.name] = {
+            _format_key(labels): {"count": cumulative[-1], "sum": total, "buckets": dict(zip(bounds, cumulative))}
+            for labels, cumulative, total in metric.samples()
+        }
+    return data
+
+def add_exporter(export: Callable[[Dict[str, Any]], None]) -> None:
+    """Register a function that is handed a snapshot() on every export interval, once."""
+    with _registry_lock:
+        if export not in _exporters:
+            _exporters.append(export)
+
+def start_export_thread(interval: float) -> None:
+    """Hand a snapshot to every exporter each `interval` seconds, from a daemon thread; once per process."""
+    global _export_thread
+    with _registry_lock:
+        if _export_thread is not None:
+            return
+        _export_thread = threading.Thread(target=_export_loop, args=(interval,), name="metrics_export", daemon=True)
+    _export_thread.start()
+
+def _export_loop(interval: float) -> None:
+    while True:
+        time.sleep(interval)
+        with _registry_lock:
+            exporters = list(_exporters)
+        if not exporters:
+            continue
+        
+        data = snapshot()
+        for export in exporters:
+            try:
+                export(data)
+            except Exception:
+                logger.exception(f"Error in metrics exporter {getattr(export, '__name__', export)}")
@@ -0,0 +1,243 @@
+import os
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional
+from telegram import Bot
+from telegram.error import RetryAfter, TelegramError
+from telegram.utils.helpers import DEFAULT_NONE
+
+import metrics
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Outbound rate limits (requests per second and burst size)
+OUTBOUND_GLOBAL_RATE = float(os.environ.get('OUTBOUND_GLOBAL_RATE', 30))
+OUTBOUND_GLOBAL_BURST = float(os.environ.get('OUTBOUND_GLOBAL_BURST', 30))
+OUTBOUND_GROUP_RATE = float(os.environ.get('OUTBOUND_GROUP_RATE', 1))
+OUTBOUND_GROUP_BURST = float(os.environ.get('OUTBOUND_GROUP_BURST', 3))
+OUTBOUND_PRIVATE_RATE = float(os.environ.get('OUTBOUND_PRIVATE_RATE', 1))
+OUTBOUND_PRIVATE_BURST = float(os.environ.get('OUTBOUND_PRIVATE_BURST', 20))
+OUTBOUND_MAX_RETRIES = int(os.environ.get('OUTBOUND_MAX_RETRIES', 3))
+
+# Storage channel; every process running the bot sends to it
+STORAGE_CHANNEL_ID = os.environ.get('CHANNEL_ID')
+
+# Idle per-chat buckets are dropped after this many seconds
+CHAT_BUCKET_TTL = 600
+
+telegram_latency = metrics.histogram("telegram_request_latency_seconds", "Bot API request round trips, by method")
+telegram_errors = metrics.counter("telegram_request_errors_total", "Failed Bot API requests, by method and error; 429s count as RetryAfter")
+
+class TokenBucket:
+    """Thread-safe token bucket that blocks callers until tokens are available."""
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+    
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+    
+    def reserve(self, tokens: float = 1) -> float:
+        """Take tokens now and return how long the caller must wait before using them."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= min(tokens, self.capacity)
+            wait = max(0.0, -self.tokens / self.rate if self.rate > 0 else 0.0)
+            return max(wait, self.blocked_until - now)
+    
+    def block(self, seconds: float) -> None:
+        """Stop handing out tokens for the given time, e.g. after a flood error."""
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+class OutboundScheduler:
+    """Paces outgoing Bot API requests with a global and a per-chat token bucket.
+    
+    Requests that still hit Telegram's flood control are retried after the
+    `retry_after` the server asks for, up to OUTBOUND_MAX_RETRIES times.
+    """
+    
+    def __init__(self):
+        self.global_bucket = TokenBucket(OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_BURST)
+        # Number of processes sharing the bot's budget, see share()
+        self.parts = 1
+        self._chat_buckets: Dict[Any, TokenBucket] = {}
+        self._chat_last_used: Dict[Any, float] = {}
+        self._lock = threading.Lock()
+        self.events = metrics.counter(
+            "outbound_scheduler_events_total",
+            "Outbound scheduler events, by event: requests, throttled, retries, flood_errors"
+        )
+    
+    def _count(self, key: str) -> None:
+        """Increment one of the scheduler counters."""
+        self.events.inc(event=key)
+    
+    def share(self, parts: int) -> None:
+        """Limit this process to its part of budgets shared with `parts` processes in total.
+        
+        Telegram's global limit applies to the bot token, and every process
+        sends to the storage channel, so each gets 1/parts of both. Other
+        chats belong to users, whose updates all go to one process.
+        """
+        with self._lock:
+            self.parts = max(1, parts)
+            self.global_bucket = TokenBucket(OUTBOUND_GLOBAL_RATE / self.parts, OUTBOUND_GLOBAL_BURST / self.parts)
+            self._chat_buckets.pop(STORAGE_CHANNEL_ID, None)
+    
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        """Return the bucket for a chat; groups and channels get the stricter limit."""
+        with self._lock:
+            now = time.monotonic()
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                if STORAGE_CHANNEL_ID is not None and str(chat_id) == STORAGE_CHANNEL_ID:
+                    bucket = TokenBucket(OUTBOUND_GROUP_RATE / self.parts, OUTBOUND_GROUP_BURST / self.parts)
+                elif self._is_group(chat_id):
+                    bucket = TokenBucket(OUTBOUND_GROUP_RATE, OUTBOUND_GROUP_BURST)
+                else:
+                    bucket = TokenBucket(OUTBOUND_PRIVATE_RATE, OUTBOUND_PRIVATE_BURST)
+                self._chat_buckets[chat_id] = bucket
+                self._expire_buckets(now)
+            self._chat_last_used[chat_id] = now
+            return bucket
+    
+    def _expire_buckets(self, now: float) -> None:
+        """Forget buckets of chats that have been idle for a while."""
+        for chat_id, last_used in list(self._chat_last_used.items()):
+            if now - last_used > CHAT_BUCKET_TTL:
+                del self._chat_last_used[chat_id]
+                self._chat_buckets.pop(chat_id, None)
+    
+    @staticmethod
+    def _is_group(chat_id) -> bool:
+        """Group, supergroup and channel ids are negative, or @usernames."""
+        if isinstance(chat_id, str):
+            return not chat_id.lstrip('-').isdigit() or chat_id.startswith('-')
+        return chat_id < 0
+    
+    def acquire(self, chat_id=None, tokens: float = 1) -> None:
+        """Block until a request for the chat may be sent."""
+        wait = self.global_bucket.reserve(tokens)
+        if chat_id is not None:
+            wait = max(wait, self._chat_bucket(chat_id).reserve(tokens))
+        
+        if wait > 0:
+            self._count("throttled")
+            time.sleep(wait)
+    
+    def call(self, func: Callable, args: tuple, kwargs: Dict[str, Any], chat_id=None, tokens: float = 1) -> Any:
+        """Run `func(*args, **kwargs)` once the rate limits for the chat allow it."""
+        attempt = 0
+        while True:
+            self.acquire(chat_id, tokens)
+            self._count("requests")
+            try:
+                return func(*args, **kwargs)
+            except RetryAfter as e:
+                self._count("flood_errors")
+                if attempt >= OUTBOUND_MAX_RETRIES:
+                    raise
+                
+                # Hold back everything aimed at this chat until Telegram allows it again
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).block(e.retry_after)
+                else:
+                    self.global_bucket.block(e.retry_after)
+                
+                attempt += 1
+                self._count("retries")
+                logger.warning(f"Flood control for chat {chat_id}, retrying in {e.retry_after}s")
+
+# Scheduler shared by every bot instance in the process
+scheduler = OutboundScheduler()
+
+def _throttled(name: str, chat_position: Optional[int] = 0, media_position: Optional[int] = None) -> Callable:
+    """Wrap a Bot method so that it goes through the outbound scheduler.
+    
+    Args:
+        name: Name of the Bot method
+        chat_position: Positional index of `chat_id`, or None if it is keyword-only in practice
+        media_position: Positional index of `media` for calls that send several messages
+    """
+    def method(self, *args, **kwargs):
+        chat_id = kwargs.get('chat_id')
+        if chat_id is None and chat_position is not None and len(args) > chat_position:
+            chat_id = args[chat_position]
+        
+        tokens = 1
+        if media_position is not None:
+            media = kwargs.get('media', args[media_position] if len(args) > media_position else [])
+            tokens = max(1, len(media))
+        
+        return scheduler.call(getattr(super(ThrottledBot, self), name), args, kwargs, chat_id, tokens)
+    
+    method.__name__ = name
+    return method
+
+class ThrottledBot(Bot):
+    """Bot whose message sends, copies, forwards and edits are rate limited.
+    
+    CallbackQuery.edit_message_text, Message.reply_text, Message.forward and
+    the like all delegate to these methods, so every outgoing message in the
+    bot goes through the scheduler.
+    """
+    
+    send_message = _throttled('send_message')
+    copy_message = _throttled('copy_message')
+    forward_message = _throttled('forward_message')
+    send_media_group = _throttled('send_media_group', media_position=1)
+    send_photo = _throttled('send_photo')
+    send_video = _throttled('send_video')
+    send_document = _throttled('send_document')
+    send_audio = _throttled('send_audio')
+    send_voice = _throttled('send_voice')
+    send_animation = _throttled('send_animation')
+    edit_message_text = _throttled('edit_message_text', chat_position=None)
+    edit_message_caption = _throttled('edit_message_caption', chat_position=None)
+    edit_message_reply_markup = _throttled('edit_message_reply_markup', chat_position=None)
+    
+    def _post(self, endpoint: str, data=None, timeout=None, api_kwargs=None):
+        """Send one Bot API request, recording its latency and any error by method, and tracing it.
+        
+        Every Bot method, throttled or not, ends up here, so this covers the
+        whole API; a request retried after flood control is counted per attempt.
+        """
+        start = time.perf_counter()
+        error = None
+        try:
+            return super()._post(endpoint, data=data, timeout=timeout, api_kwargs=api_kwargs)
+        except TelegramError as e:
+            error = type(e).__name__
+            telegram_errors.inc(method=endpoint, error=error)
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            telegram_latency.observe(duration, method=endpoint)
+            tracing.record("telegram", endpoint, duration, error)
+    
+    def forward_messages(self, chat_id, from_chat_id, message_ids: Iterable[int], disable_notification=None, timeout=DEFAULT_NONE) -> List[int]:
+        """Forward several messages of one chat with a single forwardMessages request.
+        
+        The library has no wrapper for this Bot API method yet, so the request
+        is posted directly. `message_ids` must be in increasing order; the ids
+        of the new messages are returned in the same order.
+        """
+        data = {
+            'chat_id': chat_id,
+            'from_chat_id': from_chat_id,
+            'message_ids': list(message_ids),
+            'disable_notification': disable_notification,
+        }
+        tokens = max(1, len(data['message_ids']))
+        result = scheduler.call(self._post, ('forwardMessages', data), {'timeout': timeout}, chat_id, tokens)
+        return [entry['message_id'] for entry in result]
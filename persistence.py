@@ -0,0 +1,139 @@
+import os
+import threading
+from collections import defaultdict
+from typing import Any, DefaultDict, Dict, Optional, Set, Tuple
+from telegram import Update
+from telegram.ext import BasePersistence
+from telegram.ext.utils.types import ConversationDict
+
+import database as db
+
+# Keep conversation state and user_data in MongoDB instead of process memory;
+# only needed when several webhook replicas serve the same users
+MONGO_PERSISTENCE = os.environ.get('MONGO_PERSISTENCE', 'false').lower() == 'true'
+
+# user_data entries that change with every file of an upload burst; they stay in
+# process memory like the confirmation edits they drive, so a burst costs no session writes
+LOCAL_USER_DATA_KEYS = frozenset({'files_uploaded', 'last_confirmation_message_id'})
+
+def _stored_user_data(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Return the part of a user's data that is kept in MongoDB."""
+    return {key: value for key, value in data.items() if key not in LOCAL_USER_DATA_KEYS}
+
+def _key_to_str(key: Tuple[int, ...]) -> str:
+    """Turn a ConversationHandler key into a MongoDB field name."""
+    return ":".join(str(part) for part in key)
+
+def _key_from_str(key: str) -> Tuple[int, ...]:
+    """Inverse of _key_to_str()."""
+    return tuple(int(part) for part in key.split(":"))
+
+class MongoPersistence(BasePersistence):
+    """Stores conversation states and user_data in the sessions collection.
+    
+    State is loaded per user right before each of their updates is processed
+    (see load_session), not once at startup, so any number of bot processes
+    can serve the same users: whichever process gets the next update sees the
+    state left by the previous one. Only user_data and conversations are
+    stored; chat_data and bot_data are not used by the bot. The
+    LOCAL_USER_DATA_KEYS entries of user_data are neither stored nor
+    replaced on load.
+    
+    Conversation keys must contain the user id as their last element, which
+    holds for ConversationHandlers with per_user=True (the default) and
+    per_message=False.
+    """
+    
+    def __init__(self):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self._conversations: Dict[str, ConversationDict] = {}
+        # Last stored values, to skip writes for updates that changed nothing
+        self._saved_user_data: Dict[int, Dict[str, Any]] = {}
+        self._saved_states: Dict[Tuple[str, Tuple[int, ...]], Any] = {}
+        self._keys_by_user: Dict[int, Set[Tuple[str, Tuple[int, ...]]]] = {}
+        self._lock = threading.Lock()
+    
+    def load_session(self, update: Any, user_data: DefaultDict[int, Dict[str, Any]]) -> None:
+        """Refresh the user_data and conversation states of the update's user from MongoDB."""
+        if not isinstance(update, Update) or not update.effective_user:
+            return
+        user_id = update.effective_user.id
+        session = db.get_session(user_id)
+        
+        # Replace the contents in place, handlers may hold on to the dict itself
+        stored_user_data = session.get("user_data", {})
+        data = user_data[user_id]
+        local = {key: data[key] for key in LOCAL_USER_DATA_KEYS if key in data}
+        data.clear()
+        data.update(stored_user_data)
+        data.update(local)
+        
+        with self._lock:
+            self._saved_user_data[user_id] = dict(stored_user_data)
+            
+            # Drop the states known so far, the stored ones are authoritative
+            for name, key in self._keys_by_user.pop(user_id, set()):
+                self._conversations[name].pop(key, None)
+                self._saved_states.pop((name, key), None)
+            
+            keys = set()
+            for name, states in session.get("conversations", {}).items():
+                conversations = self._conversations.get(name)
+                if conversations is None:
+                    continue
+                for key_str, state in states.items():
+                    key = _key_from_str(key_str)
+                    conversations[key] = state
+                    self._saved_states[(name, key)] = state
+                    keys.add((name, key))
+            self._keys_by_user[user_id] = keys
+    
+    def get_user_data(self) -> DefaultDict[int, Dict[str, Any]]:
+        """Start empty; each user's data is loaded with their next update."""
+        return defaultdict(dict)
+    
+    def get_chat_data(self) -> DefaultDict[int, Dict[Any, Any]]:
+        """chat_data is not stored."""
+        return defaultdict(dict)
+    
+    def get_bot_data(self) -> Dict[Any, Any]:
+        """bot_data is not stored."""
+        return {}
+    
+    def get_conversations(self, name: str) -> ConversationDict:
+        """Return the (initially empty) state dict that load_session keeps current."""
+        with self._lock:
+            return self._conversations.setdefault(name, {})
+    
+    def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]) -> None:
+        """Store a conversation state if it differs from the stored one."""
+        with self._lock:
+            if self._saved_states.get((name, key)) == new_state:
+                return
+        
+        db.save_session_conversation(key[-1], name, _key_to_str(key), new_state)
+        with self._lock:
+            keys = self._keys_by_user.setdefault(key[-1], set())
+            if new_state is None:
+                self._saved_states.pop((name, key), None)
+                keys.discard((name, key))
+            else:
+                self._saved_states[(name, key)] = new_state
+                keys.add((name, key))
+    
+    def update_user_data(self, user_id: int, data: Dict[str, Any]) -> None:
+        """Store a user's data, without the LOCAL_USER_DATA_KEYS entries, if it differs from the stored copy."""
+        data = _stored_user_data(data)
+        with self._lock:
+            if self._saved_user_data.get(user_id, {}) == data:
+                return
+        
+        db.save_session_user_data(user_id, data)
+        with self._lock:
+            self._saved_user_data[user_id] = data
+    
+    def update_chat_data(self, chat_id: int, data: Dict[Any, Any]) -> None:
+        """chat_data is not stored."""
+    
+    def update_bot_data(self, data: Dict[Any, Any]) -> None:
+        """bot_data is not stored."""
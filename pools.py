@@ -0,0 +1,76 @@
+import threading
+import zlib
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, List
+
+class TrackedExecutor(ThreadPoolExecutor):
+    """Thread pool that keeps count of the tasks queued or running in it.
+
+    Tasks run in a copy of the submitter's context, so context variables such
+    as the trace id of the update being handled carry over to the pool.
+    """
+
+    def __init__(self, max_workers: int, thread_name_prefix: str = ""):
+        super().__init__(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._local = threading.local()
+
+    def _run(self, fn: Callable, args, kwargs) -> Any:
+        self._local.inside = True
+        return fn(*args, **kwargs)
+
+    def _task_done(self, _: Future) -> None:
+        with self._pending_lock:
+            self._pending -= 1
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        with self._pending_lock:
+            self._pending += 1
+        try:
+            future = super().submit(contextvars.copy_context().run, self._run, fn, args, kwargs)
+        except Exception:
+            with self._pending_lock:
+                self._pending -= 1
+            raise
+        future.add_done_callback(self._task_done)
+        return future
+
+    def in_worker(self) -> bool:
+        """Return True when called from one of this pool's threads."""
+        return getattr(self._local, "inside", False)
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of tasks submitted but not finished yet."""
+        return self._pending
+
+class KeyedExecutor:
+    """Set of single-threaded lanes; tasks with the same key run in submission order."""
+
+    def __init__(self, lanes: int, name: str):
+        self.lanes: List[TrackedExecutor] = [
+            TrackedExecutor(max_workers=1, thread_name_prefix=f"{name}_{i}")
+            for i in range(max(1, lanes))
+        ]
+
+    def lane_for(self, key: Any) -> TrackedExecutor:
+        """Return the lane that runs tasks for `key`."""
+        if not isinstance(key, int):
+            key = zlib.crc32(str(key).encode())
+        return self.lanes[key % len(self.lanes)]
+
+    def submit(self, key: Any, fn: Callable, *args, **kwargs) -> Future:
+        """Run `fn` on the lane of `key`, after everything queued there before."""
+        return self.lane_for(key).submit(fn, *args, **kwargs)
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of tasks submitted to any lane but not finished yet."""
+        return sum(lane.queue_depth for lane in self.lanes)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stop every lane, by default after its queued tasks have run."""
+        for lane in self.lanes:
+            lane.shutdown(wait=wait)
@@ -0,0 +1,138 @@
+import os
+import sys
+import time
+import signal
+import logging
+import threading
+from collections import Counter
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two samples of every thread's stack
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+# Longest profile that may be asked for
+MAX_PROFILE_SECONDS = 300
+
+# Directory the collapsed stacks of every profile are written to
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '.')
+
+# Seconds profiled when the process receives SIGUSR1
+PROFILE_SIGNAL_SECONDS = float(os.environ.get('PROFILE_SIGNAL_SECONDS', 30))
+
+def _frame_name(frame) -> str:
+    """Name a stack frame by function, file and first line, e.g. find (collection.py:1450)."""
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class Profile:
+    """Stack samples gathered by a StackSampler."""
+    
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.samples = 0
+        # Collapsed stacks, "thread;outermost;...;innermost" -> samples, as flame graph tools read them
+        self.stacks: Counter = Counter()
+        # Function -> samples in which it was running, and in which it was anywhere on the stack
+        self.own: Counter = Counter()
+        self.total: Counter = Counter()
+    
+    def add(self, thread_name: str, names: List[str]) -> None:
+        """Count one sampled stack, given outermost frame first."""
+        self.samples += 1
+        self.stacks[";".join([thread_name] + names)] += 1
+        self.own[names[-1]] += 1
+        for name in set(names):
+            self.total[name] += 1
+    
+    def summary(self, top: int = 15) -> str:
+        """Return the functions that were running most often, as plain text."""
+        lines = [f"{self.samples} samples over {self.seconds:g}s, idle pool threads left out", "own%  total%  function"]
+        samples = max(1, self.samples)
+        for name, count in self.own.most_common(top):
+            own = 100 * count / samples
+            total = 100 * self.total[name] / samples
+            lines.append(f"{own:5.1f} {total:6.1f}  {name}")
+        return "\n".join(lines)
+    
+    def write_collapsed(self, path: str) -> None:
+        """Write the collapsed stacks, one `stack count` line each."""
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+class StackSampler:
+    """Wall-clock profiler that samples the Python stack of every thread at a fixed interval.
+    
+    Unlike cProfile, which only sees the thread that enables it, this covers
+    the dispatch lanes and every pool at once, and costs nothing while it is
+    not running. Samples of pool threads waiting for work are left out.
+    """
+    
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self._running = threading.Lock()
+    
+    def run(self, seconds: float) -> Optional[Profile]:
+        """Sample for `seconds` on the calling thread; return None if another profile is running."""
+        if not self._running.acquire(blocking=False):
+            return None
+        
+        try:
+            profile = Profile(seconds)
+            own_id = threading.get_ident()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own_id:
+                        continue
+                    names = []
+                    while frame is not None:
+                        names.append(_frame_name(frame))
+                        frame = frame.f_back
+                    # An idle ThreadPoolExecutor worker waits in _worker itself
+                    if names[0].startswith("_worker (thread.py:"):
+                        continue
+                    names.reverse()
+                    profile.add(thread_names.get(thread_id, str(thread_id)), names)
+                time.sleep(self.interval)
+            return profile
+        finally:
+            self._running.release()
+
+# Profiler shared by the admin command and the signal handler
+sampler = StackSampler()
+
+def profile_to_file(seconds: float) -> Optional[Tuple[Profile, str]]:
+    """Profile the process and write the collapsed stacks to PROFILE_DIR.
+    
+    Returns:
+        The profile and the path of the file, or None if another profile is running
+    """
+    seconds = max(1.0, min(seconds, MAX_PROFILE_SECONDS))
+    logger.info(f"Profiling for {seconds:g}s")
+    profile = sampler.run(seconds)
+    if profile is None:
+        logger.warning("Profile requested while another one is running")
+        return None
+    
+    path = os.path.join(PROFILE_DIR, f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.txt")
+    profile.write_collapsed(path)
+    logger.info(f"Profile written to {path}\n{profile.summary()}")
+    return profile, path
+
+def install_signal_handler() -> None:
+    """Profile for PROFILE_SIGNAL_SECONDS whenever the process receives SIGUSR1.
+    
+    Signal handlers can only be set from the main thread, and SIGUSR1 does
+    not exist on Windows; the handler is skipped in either case.
+    """
+    if not hasattr(signal, 'SIGUSR1') or threading.current_thread() is not threading.main_thread():
+        return
+    
+    def handle(signum, frame):
+        threading.Thread(target=profile_to_file, args=(PROFILE_SIGNAL_SECONDS,), name="profiler", daemon=True).start()
+    
+    signal.signal(signal.SIGUSR1, handle)
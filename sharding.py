@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import signal
+import logging
+import threading
+import multiprocessing
+from queue import Full
+from typing import Callable, List, Optional
+from telegram import Update
+
+import database as db
+import metrics
+import outbound
+from dispatch import shard_key_from_json
+from webhook import WEBHOOK_QUEUE_SIZE, QueueLatency, WebhookReceiver, wait_for_stop_signal
+
+logger = logging.getLogger(__name__)
+
+# Number of worker processes that handle updates in webhook mode (1 handles them in-process)
+SHARD_WORKERS = max(1, int(os.environ.get('SHARD_WORKERS', 1)))
+
+# Seconds between checks that every worker process is still alive
+SUPERVISE_INTERVAL = 5
+
+# Seconds a worker gets to finish its queued updates on shutdown
+WORKER_STOP_TIMEOUT = 30
+
+# Seconds between the metric reports a worker sends to the receiver's /metrics
+SHARD_METRICS_INTERVAL = float(os.environ.get('SHARD_METRICS_INTERVAL', 5))
+
+def shard_for(key: int, shards: int) -> int:
+    """Return the worker that handles updates with the given shard key."""
+    return key % shards
+
+def _report_metrics(index: int, reports) -> None:
+    """Send this worker's metrics to the receiver every SHARD_METRICS_INTERVAL seconds."""
+    while True:
+        time.sleep(SHARD_METRICS_INTERVAL)
+        try:
+            reports.put_nowait((index, metrics.families()))
+        except Full:
+            # The receiver is behind; it gets the next report instead
+            pass
+        except Exception as e:
+            logger.error(f"Shard worker {index} could not report its metrics: {e}")
+
+def _collect_reports(reports) -> None:
+    """Hand the workers' metric reports to the receiver's /metrics."""
+    while True:
+        index, worker_families = reports.get()
+        metrics.report_remote(f"shard_{index}", {"shard": str(index)}, worker_families)
+
+def _worker_main(index: int, workers: int, updates, reports, latency: QueueLatency, build_updater: Callable) -> None:
+    """Handle the updates of one shard until the receiver sends None.
+    
+    Runs in a freshly spawned process, so the worker opens its own MongoDB
+    connection pool and keeps its own in-memory state; every update of a
+    given user reaches the same worker, in order.
+    """
+    # The receiver coordinates shutdown, so that no queued update is dropped
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    
+    # The workers send with the same bot token, so they split its rate limits
+    outbound.scheduler.share(workers)
+    
+    db.init_db()
+    updater = build_updater(os.environ['BOT_TOKEN'])
+    dispatcher = updater.dispatcher
+    if updater.job_queue:
+        updater.job_queue.start()
+    threading.Thread(target=_report_metrics, args=(index, reports), name="metrics_report", daemon=True).start()
+    logger.info(f"Shard worker {index} started (pid {os.getpid()})")
+    
+    while True:
+        item = updates.get()
+        if item is None:
+            break
+        body, received_at = item
+        latency.observe(time.time() - received_at)
+        try:
+            update = Update.de_json(json.loads(body), dispatcher.bot)
+            dispatcher.process_update(update)
+        except Exception:
+            logger.exception(f"Shard worker {index} failed to queue an update")
+    
+    # Let the lanes and background work drain before closing the database
+    dispatcher.stop()
+    if updater.job_queue:
+        updater.job_queue.stop()
+    db.close_connection()
+    logger.info(f"Shard worker {index} stopped")
+
+def run_sharded(build_updater: Callable, workers: int, port: int, url_path: str) -> None:
+    """Receive webhook updates and spread them over worker processes by user.
+    
+    Each worker has a bounded queue of WEBHOOK_QUEUE_SIZE updates. Blocks
+    until SIGINT, SIGTERM or SIGABRT, then stops taking updates and waits
+    for the workers to handle the ones already queued. A worker that dies
+    is restarted with the same queue.
+    
+    Args:
+        build_updater: Picklable function that creates a worker's Updater from the bot token
+        workers: Number of worker processes
+        port: Port the webhook receiver listens on
+        url_path: Path Telegram posts updates to
+    """
+    # Spawned, not forked: MongoClient and the bot's thread pools are not fork-safe
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue(maxsize=WEBHOOK_QUEUE_SIZE) for _ in range(workers)]
+    processes: List[Optional[multiprocessing.Process]] = [None] * workers
+    # Every worker's metrics, shown with a shard label on the receiver's /metrics
+    reports = context.Queue(maxsize=2 * workers)
+    threading.Thread(target=_collect_reports, args=(reports,), name="metrics_collect", daemon=True).start()
+    latency = QueueLatency()
+    metrics.register_gauge(
+        "webhook_queue_latency_seconds",
+        "Moving average of the time updates wait before a shard worker takes them",
+        lambda: latency.value
+    )
+    
+    def start_worker(index: int) -> None:
+        process = context.Process(
+            target=_worker_main,
+            args=(index, workers, queues[index], reports, latency, build_updater),
+            name=f"shard_{index}",
+            daemon=True
+        )
+        process.start()
+        processes[index] = process
+    
+    def submit(body: bytes) -> None:
+        try:
+            key = shard_key_from_json(json.loads(body))
+        except AttributeError as e:
+            raise ValueError(f"not an update object: {e}")
+        
+        # The worker decodes the update again; passing the raw body keeps this
+        # process, which every update goes through, as cheap as possible
+        queues[shard_for(key, workers)].put_nowait((body, time.time()))
+    
+    def supervise() -> None:
+        for index, process in enumerate(processes):
+            if not process.is_alive():
+                logger.error(f"Shard worker {index} exited with code {process.exitcode}, restarting it")
+                start_worker(index)
+    
+    for index in range(workers):
+        start_worker(index)
+    
+    # A shard whose queue is full makes the receiver refuse that shard's updates
+    receiver = WebhookReceiver(port, url_path, submit, lambda: sum(q.qsize() for q in queues))
+    receiver.start()
+    logger.info(f"Handing webhook updates to {workers} shard workers")
+    
+    wait_for_stop_signal(SUPERVISE_INTERVAL, supervise)
+    
+    logger.info("Stopping webhook receiver and shard workers")
+    receiver.stop()
+    for queue in queues:
+        queue.put(None)
+    for process in processes:
+        process.join(timeout=WORKER_STOP_TIMEOUT)
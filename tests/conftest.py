@@ -0,0 +1,21 @@
+import os
+
+# database.py reads MONGO_URI on import; the tests never connect to it
+os.environ.setdefault('MONGO_URI', 'mongodb://localhost:27017')
+
+import mongomock
+import pytest
+
+import database as db
+
+@pytest.fixture
+def mongo(monkeypatch):
+    """An empty in-memory MongoDB behind the database module, with a cold category cache."""
+    monkeypatch.setattr(db, 'MongoClient', mongomock.MongoClient)
+    monkeypatch.setattr(db, 'mongo_client', None)
+    db.invalidate_user_cache()
+    db.init_db()
+    yield db
+    db.flush_pending_files()
+    db.invalidate_user_cache()
+    db.mongo_client = None
@@ -0,0 +1,70 @@
+import threading
+from types import SimpleNamespace
+
+from album import MAX_ALBUM_SIZE, AlbumAggregator
+
+def _item(message_id, media_group_id="g1"):
+    return SimpleNamespace(message_id=message_id, media_group_id=media_group_id)
+
+class Collector:
+    def __init__(self):
+        self.albums = []
+        self.received = threading.Event()
+    
+    def __call__(self, user_id, category, messages):
+        self.albums.append((user_id, category, [m.message_id for m in messages]))
+        self.received.set()
+
+def test_items_of_an_album_are_handed_over_together_after_the_window():
+    collector = Collector()
+    aggregator = AlbumAggregator(collector, window=0.05)
+    
+    for message_id in (1, 2, 3):
+        aggregator.add(7, "photos", _item(message_id))
+    assert collector.albums == []
+    
+    assert collector.received.wait(2)
+    assert collector.albums == [(7, "photos", [1, 2, 3])]
+
+def test_single_files_and_a_zero_window_pass_straight_through():
+    collector = Collector()
+    AlbumAggregator(collector, window=60).add(7, "c", _item(1, media_group_id=None))
+    AlbumAggregator(collector, window=0).add(7, "c", _item(2))
+    
+    assert collector.albums == [(7, "c", [1]), (7, "c", [2])]
+
+def test_full_album_is_handed_over_at_once():
+    collector = Collector()
+    aggregator = AlbumAggregator(collector, window=60)
+    
+    for message_id in range(MAX_ALBUM_SIZE):
+        aggregator.add(7, "c", _item(message_id))
+    
+    assert collector.albums == [(7, "c", list(range(MAX_ALBUM_SIZE)))]
+
+def test_flush_user_hands_over_only_that_users_albums():
+    collector = Collector()
+    aggregator = AlbumAggregator(collector, window=60)
+    aggregator.add(7, "c", _item(1, "a"))
+    aggregator.add(8, "c", _item(2, "b"))
+    
+    aggregator.flush_user(7)
+    assert collector.albums == [(7, "c", [1])]
+    
+    aggregator.flush_all()
+    assert collector.albums == [(7, "c", [1]), (8, "c", [2])]
+    
+    # Nothing is handed over twice
+    aggregator.flush_all()
+    assert len(collector.albums) == 2
+
+def test_albums_of_different_groups_are_kept_apart():
+    collector = Collector()
+    aggregator = AlbumAggregator(collector, window=60)
+    aggregator.add(7, "c", _item(1, "a"))
+    aggregator.add(7, "c", _item(2, "b"))
+    aggregator.add(7, "c", _item(3, "a"))
+    
+    aggregator.flush_all()
+    
+    assert sorted(collector.albums) == [(7, "c", [1, 3]), (7, "c", [2])]
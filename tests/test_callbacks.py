@@ -0,0 +1,51 @@
+from types import SimpleNamespace
+
+import pytest
+from telegram import Update
+
+import callbacks
+from callbacks import CallbackRouter
+
+@pytest.mark.parametrize("args", [(), (0,), (5, 1), (127, 128), (2 ** 40, 0, 300)])
+def test_encode_decode_round_trip(args):
+    data = callbacks.encode('page', *args)
+    
+    assert callbacks.decode(data) == ('page', args)
+
+def test_encode_without_arguments_is_the_action():
+    assert callbacks.encode('back_to_menu') == 'back_to_menu'
+    assert callbacks.decode('back_to_menu') == ('back_to_menu', ())
+
+def test_encoded_data_stays_short():
+    # A category id and a page number fit in a few bytes whatever the category is called
+    assert len(callbacks.encode('page', 1000, 250)) <= 12
+
+def test_encode_rejects_negative_arguments():
+    with pytest.raises(ValueError):
+        callbacks.encode('page', -1)
+
+def test_encode_rejects_data_over_the_telegram_limit():
+    with pytest.raises(ValueError):
+        callbacks.encode('page', *range(100, 150))
+
+def test_decode_rejects_truncated_arguments():
+    # 0x80 announces a further varint byte that never comes
+    with pytest.raises(ValueError):
+        callbacks.decode('page:gA')
+
+def _query_update(data):
+    return Update(1, callback_query=SimpleNamespace(data=data))
+
+def test_router_picks_the_route_of_the_action():
+    browse, page = object(), object()
+    router = CallbackRouter({'browse': browse, 'page': page})
+    
+    assert router.check_update(_query_update(callbacks.encode('page', 3, 2))) is page
+    assert router.check_update(_query_update('browse')) is browse
+
+def test_router_falls_back_to_default_or_passes():
+    default = object()
+    
+    assert CallbackRouter({}, default).check_update(_query_update('other:AQ')) is default
+    assert CallbackRouter({}).check_update(_query_update('other:AQ')) is None
+    assert CallbackRouter({'page': object()}).check_update(Update(1)) is None
@@ -0,0 +1,126 @@
+def _embedded_user(user_id, categories):
+    return {"_id": str(user_id), "categories": categories}
+
+def _file(message_id, size=0, **extra):
+    return dict({"message_id": message_id, "file_type": "document", "file_size": size}, **extra)
+
+def test_migration_moves_embedded_files_to_the_files_collection(mongo):
+    mongo.users_collection.insert_one(_embedded_user(1, {
+        "Photos": [_file(10, 100), _file(11, 50)],
+        "Empty": [],
+    }))
+    
+    assert mongo.migrate_embedded_layout() == 1
+    
+    assert "categories" not in mongo.users_collection.find_one({"_id": "1"})
+    assert [f["message_id"] for f in mongo.get_files_in_category(1, "Photos")] == [10, 11]
+    stats = {category["name"]: category for category in mongo.get_category_stats(1)}
+    assert (stats["Photos"]["file_count"], stats["Photos"]["total_bytes"]) == (2, 150)
+    assert (stats["Empty"]["file_count"], stats["Empty"]["last_added_at"]) == (0, None)
+
+def test_migration_can_run_again_without_duplicating_files(mongo):
+    mongo.users_collection.insert_one(_embedded_user(1, {"Photos": [_file(10)]}))
+    mongo.migrate_embedded_layout()
+    
+    # An interrupted run leaves the embedded copy in place; converting it again replaces the first result
+    mongo.users_collection.update_one({"_id": "1"}, {"$set": {"categories": {"Photos": [_file(10)]}}})
+    mongo.migrate_embedded_layout()
+    
+    assert mongo.files_collection.count_documents({"user_id": "1"}) == 1
+    assert mongo.migrate_embedded_layout() == 0
+
+def test_category_ids_follow_creation_order_and_are_never_reused(mongo):
+    for name in ("a", "b", "c"):
+        mongo.create_category(1, name)
+    
+    assert mongo.get_category_list(1)[1] == [("a", 0), ("b", 1), ("c", 2)]
+    
+    mongo.delete_category(1, "b")
+    mongo.create_category(1, "d")
+    
+    assert mongo.get_category_list(1)[1] == [("a", 0), ("c", 2), ("d", 3)]
+    assert mongo.get_category_name(1, 3) == "d"
+    assert mongo.get_category_name(1, 1) is None
+
+def test_migrated_categories_get_ids_on_first_listing(mongo):
+    mongo.users_collection.insert_one(_embedded_user(1, {"x": [_file(1)], "y": []}))
+    mongo.migrate_embedded_layout()
+    
+    _, categories = mongo.get_category_list(1)
+    
+    assert categories == [("x", 0), ("y", 1)]
+    assert mongo.categories_collection.count_documents({"user_id": "1", "cid": {"$exists": True}}) == 2
+
+def test_category_list_version_changes_only_with_the_list(mongo):
+    mongo.create_category(1, "a")
+    version = mongo.get_category_list(1)[0]
+    
+    mongo.add_file_to_category(1, "a", 5, "photo")
+    assert mongo.get_category_list(1)[0] == version
+    
+    mongo.create_category(1, "b")
+    assert mongo.get_category_list(1)[0] > version
+
+def test_cached_category_list_follows_changes_of_other_processes(mongo, monkeypatch):
+    monkeypatch.setattr(mongo, "_revalidate_categories", True)
+    monkeypatch.setattr(mongo, "CATEGORY_VERSION_CHECK_INTERVAL", 0)
+    mongo.create_category(1, "a")
+    assert mongo.get_user_categories(1) == ["a"]
+    
+    # Another process creates a category and raises the version
+    mongo.categories_collection.insert_one({"user_id": "1", "name": "b", "next_seq": 0, "file_count": 0})
+    mongo.users_collection.update_one({"_id": "1"}, {"$inc": {"category_version": 1}})
+    
+    assert mongo.get_user_categories(1) == ["a", "b"]
+
+def test_adding_files_raises_the_counters(mongo):
+    mongo.add_file_to_category(1, "docs", 1, "document", file_size=10)
+    mongo.add_files_to_category(1, "docs", [
+        {"message_id": 2, "file_type": "document", "file_size": 20},
+        {"message_id": 3, "file_type": "photo"},
+    ])
+    
+    category = mongo.categories_collection.find_one({"user_id": "1", "name": "docs"})
+    assert (category["file_count"], category["total_bytes"], category["next_seq"]) == (3, 30, 3)
+    assert category["last_added_at"] is not None
+    assert [f["message_id"] for f in mongo.get_files_in_category(1, "docs")] == [1, 2, 3]
+    assert mongo.get_category_counts(1) == [("docs", 3)]
+
+def test_backfill_fills_in_counters_of_old_categories(mongo):
+    mongo.add_files_to_category(1, "old", [{"message_id": i, "file_type": "document", "file_size": 7} for i in range(4)])
+    mongo.categories_collection.update_one(
+        {"user_id": "1", "name": "old"},
+        {"$unset": {"file_count": "", "total_bytes": "", "last_added_at": ""}}
+    )
+    
+    assert mongo.backfill_category_counters() == 1
+    assert mongo.backfill_category_counters() == 0
+    
+    category = mongo.categories_collection.find_one({"user_id": "1", "name": "old"})
+    assert (category["file_count"], category["total_bytes"]) == (4, 28)
+
+def test_pages_are_read_in_upload_order(mongo):
+    mongo.add_files_to_category(1, "c", [{"message_id": i, "file_type": "photo"} for i in range(12)])
+    
+    files, total_pages, total_files = mongo.get_files_in_category_paginated(1, "c", page=3, page_size=5)
+    
+    assert (total_pages, total_files) == (3, 12)
+    assert [f["message_id"] for f in files] == [10, 11]
+    assert mongo.get_files_in_category_paginated(1, "missing") == ([], 1, 0)
+
+def test_stored_copies_are_found_by_file_unique_id(mongo):
+    mongo.add_files_to_category(1, "a", [
+        {"message_id": 10, "file_type": "photo", "file_unique_id": "u1"},
+        {"message_id": 11, "file_type": "photo"},
+    ])
+    mongo.add_file_to_category(1, "b", 12, "photo", file_unique_id="u2")
+    mongo.add_file_to_category(2, "a", 13, "photo", file_unique_id="u3")
+    
+    assert mongo.find_stored_message_ids(1, ["u1", "u2", "u3", None]) == {"u1": 10, "u2": 12}
+    assert mongo.find_stored_message_ids(1, [None]) == {}
+
+def test_stored_copies_include_files_still_in_the_write_buffer(mongo):
+    mongo.buffer_file_for_category(1, "a", 20, "document", file_unique_id="u1")
+    
+    assert mongo.find_stored_message_ids(1, ["u1"]) == {"u1": 20}
+    assert mongo.find_stored_message_ids(2, ["u1"]) == {}
@@ -0,0 +1,88 @@
+import time
+
+from telegram.error import BadRequest
+
+from debounce import DebouncedMessageEditor
+
+class FakeBot:
+    def __init__(self, error=None):
+        self.edits = []
+        self.error = error
+    
+    def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        if self.error is not None:
+            raise self.error
+        self.edits.append((chat_id, message_id, text))
+
+def _wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+def test_first_change_after_a_quiet_period_is_edited_at_once():
+    bot = FakeBot()
+    editor = DebouncedMessageEditor(interval=60)
+    
+    editor.update(bot, 1, 10, "1 file saved")
+    
+    assert bot.edits == [(1, 10, "1 file saved")]
+
+def test_burst_costs_one_trailing_edit_with_the_latest_text():
+    bot = FakeBot()
+    editor = DebouncedMessageEditor(interval=0.1)
+    editor.track(1, 10, "1 file saved")
+    
+    for count in range(2, 7):
+        editor.update(bot, 1, 10, f"{count} files saved")
+    assert bot.edits == []
+    
+    assert _wait_for(lambda: bot.edits)
+    time.sleep(0.15)
+    assert bot.edits == [(1, 10, "6 files saved")]
+
+def test_flush_makes_the_pending_edit_now():
+    bot = FakeBot()
+    editor = DebouncedMessageEditor(interval=60)
+    editor.track(1, 10, "1 file saved")
+    editor.update(bot, 1, 10, "2 files saved")
+    
+    editor.flush(1)
+    
+    assert bot.edits == [(1, 10, "2 files saved")]
+
+def test_discard_drops_the_pending_edit():
+    bot = FakeBot()
+    editor = DebouncedMessageEditor(interval=0.05)
+    editor.track(1, 10, "1 file saved")
+    editor.update(bot, 1, 10, "2 files saved")
+    
+    editor.discard(1)
+    time.sleep(0.1)
+    
+    assert bot.edits == []
+
+def test_unchanged_text_is_not_edited_again():
+    bot = FakeBot()
+    editor = DebouncedMessageEditor(interval=60)
+    editor.track(1, 10, "1 file saved")
+    editor.update(bot, 1, 10, "1 file saved")
+    
+    editor.flush(1)
+    
+    assert bot.edits == []
+
+def test_message_that_cannot_be_edited_is_marked_failed():
+    editor = DebouncedMessageEditor(interval=0)
+    
+    editor.update(FakeBot(BadRequest("Message to edit not found")), 1, 10, "2 files saved")
+    
+    assert editor.has_failed(1, 10)
+    assert not editor.has_failed(1, 11)
+
+def test_not_modified_answer_counts_as_shown():
+    editor = DebouncedMessageEditor(interval=0)
+    
+    editor.update(FakeBot(BadRequest("Message is not modified")), 1, 10, "2 files saved")
+    
+    assert not editor.has_failed(1, 10)
@@ -0,0 +1,60 @@
+import pytest
+
+import delivery
+
+def _items(*file_types):
+    return [({"file_type": file_type, "file_id": f"id{index}", "message_id": index}, "") for index, file_type in enumerate(file_types)]
+
+@pytest.fixture(autouse=True)
+def media_groups(monkeypatch):
+    monkeypatch.setattr(delivery, "BROWSE_MEDIA_GROUPS", True)
+
+def test_neighbouring_photos_and_videos_share_an_album():
+    items = _items("photo", "video", "photo", "document", "document", "voice", "audio")
+    
+    assert delivery.plan_batches(items) == [[0, 1, 2], [3, 4], [5], [6]]
+
+def test_albums_hold_at_most_ten_items():
+    items = _items(*["photo"] * 12)
+    
+    assert [len(batch) for batch in delivery.plan_batches(items)] == [10, 2]
+
+def test_files_without_a_file_id_are_sent_alone():
+    items = _items("photo", "photo")
+    del items[1][0]["file_id"]
+    
+    assert delivery.plan_batches(items) == [[0], [1]]
+
+def test_media_groups_can_be_turned_off(monkeypatch):
+    monkeypatch.setattr(delivery, "BROWSE_MEDIA_GROUPS", False)
+    
+    assert delivery.plan_batches(_items("photo", "photo")) == [[0], [1]]
+
+class FakeBot:
+    def __init__(self, fail_groups=False):
+        self.sent = []
+        self.fail_groups = fail_groups
+    
+    def send_media_group(self, chat_id, media):
+        if self.fail_groups:
+            raise RuntimeError("no albums")
+        self.sent.append(("album", [m.media for m in media]))
+    
+    def send_photo(self, chat_id, file_id, caption=None):
+        self.sent.append(("photo", file_id))
+    
+    def copy_message(self, chat_id, from_chat_id, message_id, caption=None):
+        self.sent.append(("copy", message_id))
+
+def test_page_is_delivered_in_order():
+    bot = FakeBot()
+    items = _items("photo", "photo", "voice2")
+    
+    assert delivery.deliver_files(bot, 1, -100, items) == [None, None, None]
+    assert bot.sent == [("album", ["id0", "id1"]), ("copy", 2)]
+
+def test_failed_album_is_sent_file_by_file():
+    bot = FakeBot(fail_groups=True)
+    
+    assert delivery.deliver_files(bot, 1, -100, _items("photo", "photo")) == [None, None]
+    assert bot.sent == [("photo", "id0"), ("photo", "id1")]
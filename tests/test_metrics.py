@@ -0,0 +1,37 @@
+import metrics
+
+def test_counters_and_histograms_render_in_the_prometheus_format():
+    metrics.counter("test_render_total", "Test counter").inc(kind="a")
+    metrics.histogram("test_render_seconds", "Test histogram", buckets=(0.1, 1.0)).observe(0.5, kind="a")
+    
+    text = metrics.render_prometheus()
+    
+    assert '# TYPE test_render_total counter\ntest_render_total{kind="a"} 1.0' in text
+    assert 'test_render_seconds_bucket{kind="a",le="0.1"} 0.0' in text
+    assert 'test_render_seconds_bucket{kind="a",le="1.0"} 1.0' in text
+    assert 'test_render_seconds_count{kind="a"} 1.0' in text
+
+def test_remote_reports_are_merged_with_a_label():
+    metrics.counter("test_remote_total", "Test counter").inc(kind="a")
+    worker_families = [
+        ("test_remote_total", "counter", "Test counter", [("test_remote_total", (("kind", "a"),), 5.0)]),
+        ("test_worker_only", "gauge", "Worker gauge", [("test_worker_only", (), 2.0)]),
+    ]
+    
+    metrics.report_remote("shard_0", {"shard": "0"}, worker_families)
+    text = metrics.render_prometheus()
+    
+    # One HELP/TYPE header per family, with the series of every process under it
+    assert text.count("# TYPE test_remote_total counter") == 1
+    assert 'test_remote_total{kind="a"} 1.0' in text
+    assert 'test_remote_total{shard="0",kind="a"} 5.0' in text
+    assert 'test_worker_only{shard="0"} 2.0' in text
+
+def test_newer_report_replaces_the_previous_one():
+    metrics.report_remote("shard_1", {"shard": "1"}, [("test_replaced", "gauge", "G", [("test_replaced", (), 1.0)])])
+    metrics.report_remote("shard_1", {"shard": "1"}, [("test_replaced", "gauge", "G", [("test_replaced", (), 2.0)])])
+    
+    text = metrics.render_prometheus()
+    
+    assert 'test_replaced{shard="1"} 2.0' in text
+    assert 'test_replaced{shard="1"} 1.0' not in text
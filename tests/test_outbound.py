@@ -0,0 +1,105 @@
+import pytest
+from telegram.error import RetryAfter
+
+import outbound
+from outbound import OutboundScheduler, TokenBucket
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+    
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(outbound.time, 'monotonic', clock)
+    return clock
+
+def test_bucket_allows_a_burst_then_paces_at_its_rate(clock):
+    bucket = TokenBucket(rate=2, capacity=3)
+    
+    assert [bucket.reserve() for _ in range(3)] == [0, 0, 0]
+    assert bucket.reserve() == pytest.approx(0.5)
+    assert bucket.reserve() == pytest.approx(1.0)
+
+def test_bucket_refills_over_time_up_to_its_capacity(clock):
+    bucket = TokenBucket(rate=2, capacity=3)
+    for _ in range(3):
+        bucket.reserve()
+    
+    clock.now += 1
+    assert bucket.reserve(2) == 0
+    assert bucket.reserve() == pytest.approx(0.5)
+    
+    clock.now += 60
+    bucket.reserve(0)
+    assert bucket.tokens == 3
+
+def test_bucket_block_holds_back_tokens(clock):
+    bucket = TokenBucket(rate=10, capacity=10)
+    bucket.block(4)
+    
+    assert bucket.reserve() == pytest.approx(4)
+    clock.now += 4
+    assert bucket.reserve() == 0
+
+def test_chat_buckets_by_chat_type(clock, monkeypatch):
+    monkeypatch.setattr(outbound, 'STORAGE_CHANNEL_ID', '-100123')
+    scheduler = OutboundScheduler()
+    
+    private = scheduler._chat_bucket(42)
+    group = scheduler._chat_bucket(-555)
+    channel = scheduler._chat_bucket(-100123)
+    
+    assert (private.rate, private.capacity) == (outbound.OUTBOUND_PRIVATE_RATE, outbound.OUTBOUND_PRIVATE_BURST)
+    assert (group.rate, group.capacity) == (outbound.OUTBOUND_GROUP_RATE, outbound.OUTBOUND_GROUP_BURST)
+    assert (channel.rate, channel.capacity) == (outbound.OUTBOUND_GROUP_RATE, outbound.OUTBOUND_GROUP_BURST)
+    assert scheduler._chat_bucket(42) is private
+
+def test_share_splits_the_global_and_storage_channel_budgets(clock, monkeypatch):
+    monkeypatch.setattr(outbound, 'STORAGE_CHANNEL_ID', '-100123')
+    scheduler = OutboundScheduler()
+    scheduler._chat_bucket('-100123')
+    scheduler.share(4)
+    
+    assert scheduler.global_bucket.rate == pytest.approx(outbound.OUTBOUND_GLOBAL_RATE / 4)
+    assert scheduler.global_bucket.capacity == pytest.approx(max(1, outbound.OUTBOUND_GLOBAL_BURST / 4))
+    assert scheduler._chat_bucket(-100123).rate == pytest.approx(outbound.OUTBOUND_GROUP_RATE / 4)
+    # Users' chats are served by one process each and keep their full limit
+    assert scheduler._chat_bucket(42).rate == outbound.OUTBOUND_PRIVATE_RATE
+
+def test_idle_chat_buckets_expire(clock):
+    scheduler = OutboundScheduler()
+    idle = scheduler._chat_bucket(1)
+    
+    clock.now += outbound.CHAT_BUCKET_TTL + 1
+    scheduler._chat_bucket(2)
+    
+    assert scheduler._chat_bucket(1) is not idle
+
+def test_call_retries_after_flood_control(clock):
+    scheduler = OutboundScheduler()
+    answers = [RetryAfter(0), RetryAfter(0), 'sent']
+    
+    def send():
+        answer = answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+    
+    assert scheduler.call(send, (), {}, chat_id=42) == 'sent'
+
+def test_call_gives_up_after_max_retries(clock, monkeypatch):
+    monkeypatch.setattr(outbound, 'OUTBOUND_MAX_RETRIES', 1)
+    scheduler = OutboundScheduler()
+    calls = []
+    
+    def send():
+        calls.append(1)
+        raise RetryAfter(0)
+    
+    with pytest.raises(RetryAfter):
+        scheduler.call(send, (), {}, chat_id=42)
+    assert len(calls) == 2
@@ -0,0 +1,149 @@
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import BadRequest, TimedOut
+
+import bot
+
+CHANNEL_ID = "-100123"
+
+class FakeBot:
+    """Records the forwards made to the storage channel, numbering new channel messages from 500."""
+    
+    def __init__(self):
+        self.forwarded = []
+        self.deleted = []
+        self.next_id = 500
+    
+    def _new_id(self):
+        self.next_id += 1
+        return self.next_id
+    
+    def forward_messages(self, chat_id, from_chat_id, message_ids):
+        self.forwarded.extend(message_ids)
+        return [self._new_id() for _ in message_ids]
+    
+    def delete_message(self, chat_id, message_id):
+        self.deleted.append(message_id)
+
+class FakeMessage:
+    def __init__(self, fake_bot, message_id, unique_id, media_group_id=None):
+        self.bot = fake_bot
+        self.message_id = message_id
+        self.chat_id = 42
+        self.media_group_id = media_group_id
+        self.photo = self.video = self.audio = self.voice = self.animation = None
+        self.document = SimpleNamespace(
+            file_id=f"file-{unique_id}", file_unique_id=unique_id, file_name=f"{unique_id}.pdf",
+            file_size=10, mime_type="application/pdf"
+        )
+        self.replies = []
+    
+    def forward(self, chat_id):
+        self.bot.forwarded.append(self.message_id)
+        return SimpleNamespace(message_id=self.bot._new_id())
+    
+    def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+@pytest.fixture
+def uploads(mongo, monkeypatch):
+    monkeypatch.setenv("CHANNEL_ID", CHANNEL_ID)
+    monkeypatch.setattr(bot, "DEDUP_UPLOADS", True)
+    return mongo
+
+def _stored(user_id, category):
+    return [(f["file_unique_id"], f["message_id"]) for f in bot.db.get_files_in_category(user_id, category)]
+
+def test_new_file_is_forwarded_to_the_channel(uploads):
+    fake_bot = FakeBot()
+    
+    bot.store_file(FakeMessage(fake_bot, 1, "u1"), 7, "docs")
+    
+    assert fake_bot.forwarded == [1]
+    assert _stored(7, "docs") == [("u1", 501)]
+
+def test_file_stored_before_reuses_its_channel_message(uploads):
+    uploads.add_file_to_category(7, "old", 300, "document", file_unique_id="u1")
+    fake_bot = FakeBot()
+    
+    bot.store_file(FakeMessage(fake_bot, 1, "u1"), 7, "docs")
+    
+    assert fake_bot.forwarded == []
+    assert _stored(7, "docs") == [("u1", 300)]
+
+def test_album_forwards_only_the_items_not_stored_before(uploads):
+    uploads.add_file_to_category(7, "old", 300, "document", file_unique_id="u2")
+    fake_bot = FakeBot()
+    messages = [FakeMessage(fake_bot, i, f"u{i}", "album") for i in (3, 1, 2)]
+    
+    bot.store_album(messages, 7, "docs")
+    
+    assert fake_bot.forwarded == [1, 3]
+    assert _stored(7, "docs") == [("u1", 501), ("u2", 300), ("u3", 502)]
+
+def test_deduplication_can_be_turned_off(uploads, monkeypatch):
+    monkeypatch.setattr(bot, "DEDUP_UPLOADS", False)
+    uploads.add_file_to_category(7, "old", 300, "document", file_unique_id="u1")
+    fake_bot = FakeBot()
+    
+    bot.store_file(FakeMessage(fake_bot, 1, "u1"), 7, "docs")
+    
+    assert fake_bot.forwarded == [1]
+
+class ShortBot(FakeBot):
+    """forwardMessages skips the first message, as Telegram does with one it cannot forward."""
+    
+    def forward_messages(self, chat_id, from_chat_id, message_ids):
+        return [self._new_id() for _ in message_ids[1:]]
+
+class RefusingBot(FakeBot):
+    def forward_messages(self, chat_id, from_chat_id, message_ids):
+        raise BadRequest("Method not found")
+
+class TimingOutBot(FakeBot):
+    def forward_messages(self, chat_id, from_chat_id, message_ids):
+        raise TimedOut()
+
+def test_album_with_skipped_items_is_forwarded_again_item_by_item(uploads):
+    fake_bot = ShortBot()
+    messages = [FakeMessage(fake_bot, i, f"u{i}", "album") for i in (1, 2, 3)]
+    
+    bot.store_album(messages, 7, "docs")
+    
+    # The copies that could not be matched to items are removed again
+    assert fake_bot.deleted == [501, 502]
+    assert fake_bot.forwarded == [1, 2, 3]
+    assert _stored(7, "docs") == [("u1", 503), ("u2", 504), ("u3", 505)]
+
+def test_refused_album_forward_falls_back_to_single_forwards(uploads):
+    fake_bot = RefusingBot()
+    messages = [FakeMessage(fake_bot, i, f"u{i}", "album") for i in (1, 2)]
+    
+    bot.store_album(messages, 7, "docs")
+    
+    assert fake_bot.forwarded == [1, 2]
+    assert _stored(7, "docs") == [("u1", 501), ("u2", 502)]
+
+def test_album_forward_that_timed_out_is_not_forwarded_again(uploads):
+    fake_bot = TimingOutBot()
+    messages = [FakeMessage(fake_bot, i, f"u{i}", "album") for i in (1, 2)]
+    
+    bot.store_album(messages, 7, "docs")
+    
+    assert fake_bot.forwarded == []
+    assert _stored(7, "docs") == []
+    assert messages[0].replies
+
+def test_album_items_that_fail_alone_are_reported_and_left_out(uploads, monkeypatch):
+    fake_bot = RefusingBot()
+    messages = [FakeMessage(fake_bot, i, f"u{i}", "album") for i in (1, 2)]
+    
+    def gone(chat_id):
+        raise BadRequest("Message to forward not found")
+    monkeypatch.setattr(messages[1], "forward", gone)
+    
+    bot.store_album(messages, 7, "docs")
+    
+    assert _stored(7, "docs") == [("u1", 501)]
+    assert "1 file(s)" in messages[0].replies[0]
@@ -0,0 +1,78 @@
+import os
+import json
+import time
+import random
+import secrets
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Fraction of updates whose spans are written to the log; every update gets a trace id regardless
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0.05))
+
+# Trace id of the update being handled and whether its spans are logged. Thread
+# pools copy it into their tasks (see pools.TrackedExecutor), so work handed off
+# by a handler keeps the trace of its update.
+_current: ContextVar[Optional[Tuple[str, bool]]] = ContextVar('trace', default=None)
+
+def current_trace_id() -> Optional[str]:
+    """Return the trace id of the update being handled, or None outside of one."""
+    current = _current.get()
+    return current[0] if current else None
+
+@contextmanager
+def trace(**attrs: Any) -> Iterator[str]:
+    """Run the block under a new trace id, recorded as an `update` span when it ends.
+    
+    Args:
+        attrs: Fields added to the span, e.g. the update id and user
+    """
+    trace_id = secrets.token_hex(8)
+    token = _current.set((trace_id, random.random() < TRACE_SAMPLE_RATE))
+    start = time.perf_counter()
+    error = None
+    try:
+        yield trace_id
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        record("update", "update", time.perf_counter() - start, error, **attrs)
+        _current.reset(token)
+
+def record(kind: str, name: str, seconds: float, error: Optional[str] = None, **attrs: Any) -> None:
+    """Write a finished span of the current trace to the log as one JSON line, if the trace is sampled.
+    
+    Args:
+        kind: What was timed: update, handler, mongo or telegram
+        name: Handler, command or Bot API method
+        seconds: Duration of the span
+        error: Class name of the error the span ended with, if any
+        attrs: Further fields of the span
+    """
+    current = _current.get()
+    if current is None or not current[1]:
+        return
+    
+    span = {
+        "trace": current[0],
+        "kind": kind,
+        "name": name,
+        "ms": round(seconds * 1000, 3),
+        "thread": threading.current_thread().name,
+    }
+    if error:
+        span["error"] = error
+    span.update(attrs)
+    logger.info(json.dumps(span, default=str))
+
+class TraceIdFilter(logging.Filter):
+    """Logging filter that adds the current trace id to records as `trace_id`, or - outside of an update."""
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = current_trace_id() or '-'
+        return True
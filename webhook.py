@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import queue
+import signal
+import logging
+import threading
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Optional
+from telegram import Update
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Updates accepted but not yet handed to the dispatcher; more are refused with 503
+WEBHOOK_QUEUE_SIZE = max(1, int(os.environ.get('WEBHOOK_QUEUE_SIZE', 1000)))
+
+# Seconds Telegram is asked to wait before resending a refused update
+WEBHOOK_RETRY_AFTER = 1
+
+# Largest request body accepted; Telegram updates are a few kilobytes
+MAX_BODY_SIZE = 1024 * 1024
+
+class QueueLatency:
+    """Moving average of the seconds updates spend queued before they are handled.
+    
+    The value lives in shared memory, so worker processes can report into the
+    instance that the receiver process exposes as a metric.
+    """
+    
+    def __init__(self, alpha: float = 0.1):
+        self.alpha = alpha
+        self._value = multiprocessing.get_context("spawn").Value('d', 0.0)
+    
+    def observe(self, seconds: float) -> None:
+        """Add one measurement."""
+        with self._value.get_lock():
+            self._value.value += self.alpha * (seconds - self._value.value)
+    
+    @property
+    def value(self) -> float:
+        """Current average in seconds."""
+        return self._value.value
+
+class _WebhookRequestHandler(BaseHTTPRequestHandler):
+    """Answers Telegram's POSTs as soon as the update is queued."""
+    
+    def do_POST(self):
+        receiver: WebhookReceiver = self.server.receiver
+        if self.path != receiver.url_path:
+            self._reply(404)
+            return
+        
+        length = int(self.headers.get('Content-Length') or 0)
+        if length <= 0 or length > MAX_BODY_SIZE:
+            receiver.count("rejected")
+            self._reply(400)
+            return
+        body = self.rfile.read(length)
+        
+        try:
+            receiver.submit(body)
+        except queue.Full:
+            # Telegram keeps the update and delivers it again later
+            receiver.count("shed")
+            self._reply(503, {'Retry-After': str(WEBHOOK_RETRY_AFTER)})
+            return
+        except ValueError as e:
+            logger.warning(f"Rejected malformed webhook update: {e}")
+            receiver.count("rejected")
+            self._reply(400)
+            return
+        
+        receiver.count("accepted")
+        self._reply(200)
+    
+    def _reply(self, status: int, headers: Optional[Dict[str, str]] = None) -> None:
+        """Send an empty response."""
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    
+    def log_message(self, format, *args):
+        logger.debug(f"Webhook receiver: {format % args}")
+
+class WebhookReceiver:
+    """HTTP server for Telegram's webhook that only queues updates.
+    
+    Every update is handed to `submit`, which must not block: it queues the
+    raw body, raises queue.Full when its queue is full and ValueError for a
+    body it cannot use. The handling itself happens elsewhere, so Telegram
+    gets its answer within a few milliseconds; a full queue answers 503 and
+    Telegram retries later, which sheds load instead of letting memory and
+    latency grow without bound.
+    """
+    
+    def __init__(self, port: int, url_path: str, submit: Callable[[bytes], None], queue_depth: Callable[[], int]):
+        self.port = port
+        self.url_path = f"/{url_path.lstrip('/')}"
+        self.submit = submit
+        self._server: Optional[ThreadingHTTPServer] = None
+        
+        metrics.register_gauge("webhook_queue_depth", "Webhook updates waiting to be handled", queue_depth)
+        self._updates = metrics.counter(
+            "webhook_updates_total",
+            "Webhook updates received, by result: accepted, shed or rejected"
+        )
+    
+    def count(self, result: str) -> None:
+        """Count one received update as accepted, shed or rejected."""
+        self._updates.inc(result=result)
+    
+    def start(self) -> None:
+        """Start serving on a background thread."""
+        self._server = ThreadingHTTPServer(("0.0.0.0", self.port), _WebhookRequestHandler)
+        self._server.daemon_threads = True
+        self._server.receiver = self
+        threading.Thread(target=self._server.serve_forever, name="webhook_receiver", daemon=True).start()
+        logger.info(f"Webhook receiver started on port {self.port} at {self.url_path}")
+    
+    def stop(self) -> None:
+        """Stop accepting updates."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+class UpdateIngestQueue:
+    """Bounded queue between the webhook receiver and the dispatcher of this process.
+    
+    A single consumer thread decodes the queued updates and hands them to the
+    dispatcher; when the dispatcher's backlog is full the consumer waits, the
+    queue fills up and the receiver starts refusing updates.
+    """
+    
+    def __init__(self, dispatcher, size: int = WEBHOOK_QUEUE_SIZE):
+        self.dispatcher = dispatcher
+        self.latency = QueueLatency()
+        self._queue: "queue.Queue[Any]" = queue.Queue(maxsize=size)
+        self._thread = threading.Thread(target=self._consume, name="webhook_ingest", daemon=True)
+        self._thread.start()
+        metrics.register_gauge(
+            "webhook_queue_latency_seconds",
+            "Moving average of the time updates wait in the webhook queue",
+            lambda: self.latency.value
+        )
+    
+    def submit(self, body: bytes) -> None:
+        """Queue a raw update, raising queue.Full if there is no room."""
+        self._queue.put_nowait((body, time.time()))
+    
+    @property
+    def queue_depth(self) -> int:
+        """Number of updates waiting for the consumer."""
+        return self._queue.qsize()
+    
+    def _consume(self) -> None:
+        """Decode queued updates and pass them on until stop() is called."""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            body, received_at = item
+            self.latency.observe(time.time() - received_at)
+            try:
+                update = Update.de_json(json.loads(body), self.dispatcher.bot)
+                self.dispatcher.process_update(update)
+            except Exception:
+                logger.exception("Failed to dispatch a webhook update")
+    
+    def stop(self) -> None:
+        """Hand the queued updates to the dispatcher, then stop the consumer."""
+        self._queue.put(None)
+        self._thread.join()
+
+def wait_for_stop_signal(interval: float = 1.0, on_tick: Optional[Callable[[], None]] = None) -> None:
+    """Block until SIGINT, SIGTERM or SIGABRT, calling `on_tick` every `interval` seconds."""
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        signal.signal(sig, lambda signum, frame: stop.set())
+    
+    while not stop.wait(interval):
+        if on_tick is not None:
+            on_tick()
+
+def serve_webhook(updater, port: int, url_path: str) -> None:
+    """Handle webhook updates in this process until a stop signal arrives.
+    
+    Replaces Updater.start_webhook/idle: updates go through the bounded
+    ingest queue, and on shutdown the queued ones are still handled and the
+    conversation state is stored before returning.
+    """
+    dispatcher = updater.dispatcher
+    if updater.job_queue:
+        updater.job_queue.start()
+    
+    ingest = UpdateIngestQueue(dispatcher)
+    receiver = WebhookReceiver(port, url_path, ingest.submit, lambda: ingest.queue_depth)
+    receiver.start()
+    
+    wait_for_stop_signal()
+    
+    logger.info("Stopping webhook receiver")
+    receiver.stop()
+    ingest.stop()
+    dispatcher.stop()
+    if updater.job_queue:
+        updater.job_queue.stop()
+    if dispatcher.persistence:
+        dispatcher.update_persistence()
+        dispatcher.persistence.flush()